@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+
+# The engine backends (module, class name) the tests run on; the numpy
+# backends are skipped when numpy is not installed
+
+import importlib
+
+import pytest
+
+backends = [
+    ("tetris_engine", "TetrisEngine"),
+    ("tetris_numpy", "NumpyTetrisEngine"),
+    ("tetris_quantum", "StatevectorTetrisEngine"),
+    ("tetris_entangled", "EntangledTetrisEngine"),
+]
+
+
+def engine_class(module, name):
+    if module != "tetris_engine":
+        pytest.importorskip("numpy")
+    return getattr(importlib.import_module(module), name)
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+# The modules are flat top-level scripts, so make the repository root
+# importable when pytest is run from any directory.
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# The rules of the original TetrisApp (tetris_pygame.py before the engine
+# was extracted), kept as the reference the engines are tested against. The code follows the original; only the board size is taken from
+# the board instead of the module constants.
+
+import random
+
+labels_dict = {0: None, 1: "0", 2: "1", 3: "+", 4: "-", 5: "H", 6: "Z", 7: "X"}
+labels_dict_inv = {v: k for k, v in labels_dict.items()}
+opperand_labels = ["0", "1", "+", "-"]
+opperator_labels = ["H", "Z", "X"]
+transitions = {
+    "H": {"0": "+", "1": "-", "+": "0", "-": "1"},
+    "X": {"0": "1", "1": "0", "+": "+", "-": "-"},
+    "Z": {"0": "0", "1": "1", "+": "-", "-": "+"},
+}
+
+
+def size(board):
+    "(cols, rows) (床の行を除く)"
+    return len(board[0]), len(board) - 1
+
+
+def rotate_clockwise(shape):
+    return [
+        [shape[y][x] for y in range(len(shape))]
+        for x in range(len(shape[0]) - 1, -1, -1)
+    ]
+
+
+def check_collision(board, shape, offset):
+    "元のcheck_collision (負のx座標は元のmoveで0に丸めていたため衝突とする)"
+    off_x, off_y = offset
+    if off_x < 0:
+        return True
+    for cy, row in enumerate(shape):
+        for cx, cell in enumerate(row):
+            try:
+                if cell and board[cy + off_y][cx + off_x]:
+                    return True
+            except IndexError:
+                return True
+    return False
+
+
+def judge_can_settle(board):
+    cols, rows = size(board)
+    for y in range(rows - 2, 0, -1):
+        for x in range(cols):
+            if board[y][x] != 0 and board[y + 1][x] == 0:
+                return True
+    return False
+
+
+def settle_board(board):
+    cols, rows = size(board)
+    for x in range(cols):
+        for y in range(rows - 2, 0, -1):
+            if board[y][x] == 0:
+                continue
+            for down_y in range(y + 1, rows):
+                if board[down_y][x] == 0:
+                    board[down_y][x] = board[down_y - 1][x]
+                    board[down_y - 1][x] = 0
+                else:
+                    break
+    return board
+
+
+def get_operator_target(board):
+    cols, rows = size(board)
+    targets = {}
+    for y in range(rows):
+        for x in range(cols):
+            gate_type = labels_dict[board[y][x]]
+            if gate_type not in opperator_labels:
+                continue
+            operands = []
+            if y != rows - 1:
+                qstate = labels_dict[board[y + 1][x]]
+                if qstate in opperand_labels:
+                    operands.append((x, y + 1, qstate))
+            if y == rows - 1 or operands:
+                targets[(x, y, gate_type)] = operands
+    return targets
+
+
+def operate_all_gates(board):
+    for (x, y, gate_type), operands in get_operator_target(board).items():
+        for tx, ty, qstate in operands:
+            board[ty][tx] = labels_dict_inv[transitions[gate_type][qstate]]
+        board[y][x] = 0
+    return board
+
+
+def find_idential_adjacent(board, x, y):
+    cols, rows = size(board)
+    cluster = {(x, y)}
+    while True:
+        before = cluster.copy()
+        for xx, yy in before:
+            if xx != 0 and board[yy][xx] == board[yy][xx - 1]:
+                cluster.add((xx - 1, yy))
+            if xx != cols - 1 and board[yy][xx] == board[yy][xx + 1]:
+                cluster.add((xx + 1, yy))
+            if yy != 0 and board[yy][xx] == board[yy - 1][xx]:
+                cluster.add((xx, yy - 1))
+            if yy != rows - 1 and board[yy][xx] == board[yy + 1][xx]:
+                cluster.add((xx, yy + 1))
+        if len(before) == len(cluster):
+            return cluster
+
+
+def find_cluster(board, threthold=3):
+    cols, rows = size(board)
+    clusters = set()
+    for x in range(cols):
+        for y in range(rows):
+            if board[y][x] == 0 or (x, y) in clusters:
+                continue
+            candidate = find_idential_adjacent(board, x, y)
+            if len(candidate) >= threthold:
+                clusters.update(candidate)
+    return clusters
+
+
+def cascade_step(board, threthold=3):
+    "元のrunループの1段階 (処理の種類, 削除数) (連鎖が終わっていれば (None, 0))"
+    if judge_can_settle(board):
+        settle_board(board)
+        return "settle", 0
+    if get_operator_target(board):
+        operate_all_gates(board)
+        return "gate", 0
+    clusters = find_cluster(board, threthold)
+    if clusters:
+        for x, y in clusters:
+            board[y][x] = 0
+        return "cluster", len(clusters)
+    return None, 0
+
+
+def resolve(board, threthold=3):
+    "連鎖を最後まで進めた (ボード, 連鎖数, 削除数)"
+    chain = cleared = 0
+    while True:
+        phase, n = cascade_step(board, threthold)
+        if phase is None:
+            return board, chain, cleared
+        if phase == "cluster":
+            chain += 1
+            cleared += n
+
+
+def random_board(rng, cols=10, rows=22, fill=0.6, values=7):
+    "床を含む(rows + 1)行のボード (値1-valuesのブロックが割合fillで浮いた状態を含む)"
+    board = [
+        [
+            rng.randrange(1, values + 1) if rng.random() < fill else 0
+            for x in range(cols)
+        ]
+        for y in range(rows)
+    ]
+    return board + [[1] * cols]
+
+
+def random_boards(n, seed=0, **kwargs):
+    rng = random.Random(seed)
+    return [random_board(rng, **kwargs) for _ in range(n)]
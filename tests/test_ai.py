@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# PlacementBot: legal moves and the Zobrist transposition table
+
+import pytest
+
+import reference_rules as ref
+from tetris_ai import PlacementBot, placements
+from tetris_engine import TetrisEngine
+
+
+def numpy_engine_class():
+    pytest.importorskip("numpy")
+    from tetris_numpy import NumpyTetrisEngine
+
+    return NumpyTetrisEngine
+
+
+def as_lists(board):
+    return [[int(v) for v in row] for row in board]
+
+
+def play(engine, bot, turns):
+    "botの選んだ配置でturns個のストーンを置き、各配置が列挙した配置に含まれるか確認"
+    for _ in range(turns):
+        if engine.gameover:
+            break
+        moves = {
+            (rotation, x)
+            for rotation, x, shape, y in placements(
+                engine.board, engine.stone, engine.stone_x
+            )
+        }
+        move = bot.choose(engine)
+        assert move in moves
+        engine.place_stone(*move)
+        assert not engine.board_updating
+
+
+@pytest.mark.parametrize("numpy_board", [False, True])
+def test_bot_chooses_legal_moves(numpy_board):
+    cls = numpy_engine_class() if numpy_board else TetrisEngine
+    engine = cls(seed=3)
+    bot = PlacementBot(seed=0)
+    play(engine, bot, 15)
+    assert bot.stats()["nodes"] > 0
+
+
+def test_transposition_hit_matches_fresh_resolve():
+    engine = TetrisEngine(seed=4)
+    bot = PlacementBot(seed=0)
+    play(engine, bot, 10)
+    assert bot.hits > 0
+    bot.prepare(engine)
+    base = bot.board_hash(engine.board)
+    for rotation, x, shape, y in placements(engine.board, engine.stone, engine.stone_x):
+        board, h, cells = bot.join(engine.board, base, shape, x, y)
+        expected = ref.resolve([row[:] for row in board])[0]
+        # 1回目は計算 (または登録済み)、2回目は必ず置換表から取得
+        first = bot.resolve(engine, [row[:] for row in board], h, cells)
+        hits = bot.hits
+        second = bot.resolve(engine, [row[:] for row in board], h, cells)
+        assert bot.hits == hits + 1
+        assert first[0] == second[0] == expected
+        assert second[3] == bot.board_hash(expected)
+
+
+def test_bot_on_numpy_engine_matches_list_engine():
+    "numpyのボードでも、リストのボードと同じ配置を選ぶ"
+    numpy_engine = numpy_engine_class()(seed=5)
+    engine = TetrisEngine(seed=5)
+    bots = PlacementBot(seed=0), PlacementBot(seed=0)
+    for _ in range(8):
+        if engine.gameover:
+            break
+        move = bots[0].choose(engine)
+        assert bots[1].choose(numpy_engine) == move
+        engine.place_stone(*move)
+        numpy_engine.place_stone(*move)
+        assert as_lists(numpy_engine.board) == engine.board
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+# BatchTetrisEngine in lockstep with single TetrisEngine games
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from tetris_batch import BatchTetrisEngine, stone_matrix  # noqa: E402
+from tetris_engine import TetrisConfig, TetrisEngine  # noqa: E402
+
+
+def next_stone(batch, i):
+    "バッチのi番目のゲームの次のストーン"
+    return stone_matrix(batch.next_shape[i], batch.next_values[i])
+
+
+@pytest.mark.parametrize(
+    "config", [TetrisConfig(10, 22, 3), TetrisConfig(7, 12, 2), TetrisConfig(12, 9, 4)]
+)
+def test_batch_matches_single_games(config):
+    n = 24
+    batch = BatchTetrisEngine(n, seed=31, config=config)
+    engines = [TetrisEngine(seed=i, config=config) for i in range(n)]
+    for i, engine in enumerate(engines):
+        # 最初のストーンをバッチと同じものに置き換える
+        engine.gameover = False
+        engine.next_stone = stone_matrix(batch.stone_shape[i], batch.stone_values[i])
+        engine.new_stone()
+    for _ in range(60):
+        if batch.gameover.all():
+            break
+        rotations, xs = batch.random_actions()
+        # 置いた時に出現するストーン (出現判定は連鎖前のボードで行われる)
+        stones = [next_stone(batch, i) for i in range(n)]
+        placed = batch.step(rotations, xs)
+        for i in placed:
+            engine = engines[i]
+            engine.next_stone = stones[i]
+            engine.place_stone(int(rotations[i]), int(xs[i]))
+        for i, engine in enumerate(engines):
+            assert batch.boards[i].tolist() == engine.board
+            assert batch.score[i] == engine.score
+            assert (batch.level[i], batch.lines[i]) == (engine.level, engine.lines)
+            assert batch.max_chain[i] == engine.max_chain
+            assert batch.gameover[i] == engine.gameover
+    assert batch.max_chain.max() > 0
+
+
+def test_threthold_overrides_config():
+    batch = BatchTetrisEngine(4, seed=0, threthold=5)
+    assert batch.threthold == 5
+    with pytest.raises(ValueError):
+        BatchTetrisEngine(4, shape_weights=[1, 2])
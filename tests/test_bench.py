@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Benchmark harness: boards, helpers and the save/compare round trip
+
+import io
+import json
+import sys
+
+import pytest
+
+import reference_rules as ref
+import tetris_bench
+from tetris_bench import compare, make_board, parse_sizes
+from tetris_stats import percentile
+
+
+def test_helpers():
+    assert parse_sizes("10x22,40X88") == [(10, 22), (40, 88)]
+    values = list(range(100))
+    assert (percentile(values, 0.5), percentile(values, 0.99)) == (50, 99)
+    assert percentile([7], 0.99) == 7
+    baseline = {"a": {"ops_per_sec": 100.0}, "b": {"ops_per_sec": 100.0}}
+    results = {
+        "a": {"ops_per_sec": 70.0},
+        "b": {"ops_per_sec": 95.0},
+        "c": {"ops_per_sec": 1.0},
+    }
+    assert compare(results, baseline, 0.2) == [("a", 0.7)]
+
+
+@pytest.mark.parametrize("cols, rows", [(10, 22), (13, 7)])
+def test_board_kinds(cols, rows):
+    "各種類のボードが説明どおりの性質を持つ"
+    cluster = make_board("cluster", cols, rows)
+    checker = make_board("checker", cols, rows)
+    gates = make_board("gates", cols, rows)
+    for board in (cluster, checker, gates, make_board("random", cols, rows)):
+        assert len(board) == rows + 1 and len(board[0]) == cols
+        assert board[-1] == [1] * cols
+    # 最上段は空けてある
+    assert len(ref.find_cluster(cluster, 3)) == cols * (rows - 1)
+    assert not ref.find_cluster(checker, 2)
+    operators = sum(val >= 5 for row in gates[:-1] for val in row)
+    assert operators and len(ref.get_operator_target(gates)) == operators
+
+
+def test_save_and_compare(tmp_path, monkeypatch, capsys):
+    path = str(tmp_path / "baseline.json")
+    monkeypatch.setattr(tetris_bench, "min_time", 0.001)
+    argv = ["tetris_bench.py", "--sizes", "6x8", "--only", "find_cluster"]
+    argv += ["--min-time", "0.001"]
+    monkeypatch.setattr(sys, "argv", argv + ["--save", path])
+    tetris_bench.main()
+    with open(path) as f:
+        results = json.load(f)["results"]
+    assert sorted(results) == [
+        "find_cluster/%s/6x8" % kind for kind in sorted(tetris_bench.board_kinds)
+    ]
+    # 基準を10倍速くすると全ての項目が遅くなったと判定される
+    for result in results.values():
+        result["ops_per_sec"] *= 10
+    with open(path, "w") as f:
+        json.dump({"results": results}, f)
+    monkeypatch.setattr(sys, "argv", argv + ["--compare", path])
+    with pytest.raises(SystemExit) as exc:
+        tetris_bench.main()
+    assert exc.value.code == 1
+    assert capsys.readouterr().out.count("SLOWER") == len(results)
+
+
+def test_run_reports_every_entry():
+    out = io.StringIO()
+    results = tetris_bench.run([(6, 8)], ["random"], ["settle_board"], out)
+    assert list(results) == ["settle_board/random/6x8"]
+    assert results["settle_board/random/6x8"]["ops_per_sec"] > 0
+    assert "settle_board/random/6x8" in out.getvalue()
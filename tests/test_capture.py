@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# Frame capture: PNG and raw sinks, duplicate frames and write errors
+
+import os
+import threading
+
+import pytest
+
+pygame = pytest.importorskip("pygame")
+
+from tetris_capture import (  # noqa: E402
+    CaptureError,
+    FrameCapture,
+    PngSink,
+    open_capture,
+)
+
+size = (7, 5)
+
+
+def surface(color):
+    s = pygame.Surface(size)
+    s.fill(color)
+    s.set_at((2, 3), (1, 2, 3))
+    return s
+
+
+def test_png_frames_round_trip(tmp_path):
+    directory = str(tmp_path / "clip")
+    capture = open_capture(size, png=directory)
+    frames = [surface((200, 10, 10)), surface((10, 200, 10))]
+    # 同じフレームが続いた場合は書き出さない
+    for t, s in enumerate([frames[0], frames[0], frames[1]]):
+        capture.add(s, t * 40, block=True)
+    capture.close()
+    assert (capture.emitted, capture.duplicates, capture.dropped) == (2, 1, 0)
+    for i, s in enumerate(frames):
+        loaded = pygame.image.load(os.path.join(directory, "frame_%06d.png" % i))
+        assert loaded.get_size() == size
+        expected = pygame.image.tobytes(s, "RGB")
+        assert pygame.image.tobytes(loaded, "RGB") == expected
+    with open(os.path.join(directory, "timestamps.txt")) as f:
+        assert f.read() == "# timestamp format v2\n0\n80\n"
+
+
+def test_raw_frames(tmp_path):
+    path = str(tmp_path / "clip.rgb")
+    capture = open_capture(size, raw=path)
+    frames = [surface((i * 40, 0, 255 - i * 40)) for i in range(4)]
+    for t, s in enumerate(frames):
+        capture.add(s, t, block=True)
+    capture.close()
+    with open(path, "rb") as f:
+        data = f.read()
+    assert data == b"".join(pygame.image.tobytes(s, "RGB") for s in frames)
+    assert os.path.exists(path + ".timestamps.txt")
+
+
+class FailingSink(object):
+    def write_frame(self, index, data, size):
+        raise OSError("disk full")
+
+    def close(self):
+        pass
+
+
+def test_write_errors_are_reported():
+    capture = FrameCapture(FailingSink(), size)
+    capture.add(surface((0, 0, 0)), 0, block=True)
+    with pytest.raises(CaptureError):
+        capture.close()
+
+
+def test_full_queue_drops_frames(tmp_path):
+    class SlowSink(PngSink):
+        def write_frame(self, index, data, size):
+            blocker.wait()
+            super().write_frame(index, data, size)
+
+    blocker = threading.Event()
+    capture = FrameCapture(SlowSink(str(tmp_path)), size, max_queue_bytes=1)
+    added = [capture.add(surface((i, i, i)), i) for i in range(10)]
+    blocker.set()
+    capture.close()
+    assert not all(added)
+    assert capture.dropped == added.count(False)
+    assert capture.emitted == added.count(True)
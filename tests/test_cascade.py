@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+# Cascade rules of the engines against the original rules (reference_rules)
+
+import random
+
+import pytest
+
+import reference_rules as ref
+from backends import backends, engine_class
+from tetris_engine import TetrisConfig, TetrisEngine
+
+
+def rest_board_with_changes(rng, cols=10, rows=22, changes=4):
+    """連鎖が止まったボードのいくつかのセルを変更したボードと、変更したセルのset
+    (差分判定に渡すdirtyと同じ意味)"""
+    board = ref.resolve(ref.random_board(rng, cols, rows))[0]
+    cells = set()
+    for _ in range(changes):
+        x, y = rng.randrange(cols), rng.randrange(1, rows)
+        board[y][x] = rng.randrange(0, 8)
+        cells.add((x, y))
+    return board, cells
+
+
+def copy_board(board):
+    if isinstance(board, list):
+        return [row[:] for row in board]
+    return board.copy()
+
+
+def as_lists(board):
+    return [[int(v) for v in row] for row in board]
+
+
+def test_full_scan_matches_reference():
+    engine = TetrisEngine(seed=0)
+    for board in ref.random_boards(300, seed=1):
+        expected = ref.resolve([row[:] for row in board])
+        result = engine.resolve_cascade(board)
+        assert (result.board, result.chain, result.cleared) == expected
+
+
+def test_incremental_matches_reference_and_full_scan():
+    engine = TetrisEngine(seed=0)
+    # 各段階を全体の走査と比較し、異なればAssertionError
+    engine.verify_incremental = True
+    rng = random.Random(2)
+    for _ in range(300):
+        board, cells = rest_board_with_changes(rng)
+        expected = ref.resolve([row[:] for row in board])
+        result = engine.resolve_cascade(board, dirty=cells)
+        assert (result.board, result.chain, result.cleared) == expected
+
+
+def test_incremental_matches_reference_with_config():
+    config = TetrisConfig(cols=13, rows=17, cluster_thold=4)
+    engine = TetrisEngine(seed=0, config=config)
+    engine.verify_incremental = True
+    rng = random.Random(3)
+    for _ in range(100):
+        board, cells = rest_board_with_changes(rng, 13, 17)
+        expected = ref.resolve([row[:] for row in board], 4)
+        result = engine.resolve_cascade(board, dirty=cells)
+        assert (result.board, result.chain, result.cleared) == expected
+
+
+@pytest.mark.parametrize("module, name", backends[:2])
+def test_dirty_cascade_matches_reference(module, name):
+    cls = engine_class(module, name)
+    engine = cls(seed=0)
+    rng = random.Random(4)
+    for _ in range(100):
+        board, cells = rest_board_with_changes(rng)
+        expected = ref.resolve([row[:] for row in board])
+        if module == "tetris_numpy":
+            import numpy as np
+
+            from tetris_numpy import board_dtype
+
+            board = np.array(board, dtype=board_dtype)
+        result = engine.resolve_cascade(board, dirty=cells)
+        assert (as_lists(result.board), result.chain, result.cleared) == expected
+
+
+@pytest.mark.parametrize("module, name", backends)
+def test_dirty_cascade_on_every_backend(module, name):
+    "差分判定のdirtyを渡しても、差分判定に対応しないエンジンは全体の走査で進める"
+    engine = engine_class(module, name)(seed=5)
+    for turn in range(40):
+        if engine.gameover:
+            break
+        x = turn % (engine.cols - 3)
+        engine.move(x - engine.stone_x)
+        engine.insta_drop()
+        # 全てのセルは常に正しいdirty (連鎖が止まってから変化したセルを全て含む)
+        engine.dirty = {(x, y) for x in range(engine.cols) for y in range(engine.rows)}
+        engine.resolve_board()
+        assert not engine.board_updating
+        assert not engine.judge_can_settle(engine.board)
+
+
+@pytest.mark.parametrize("module, name", backends[:2])
+def test_resolve_cascade_with_dirty_on_copy(module, name):
+    "エンジンのボードのコピーにdirtyを渡して連鎖を進めても、エンジン自身の連鎖と一致する"
+    engine = engine_class(module, name)(seed=6)
+    for turn in range(40):
+        if engine.gameover:
+            break
+        engine.move(turn % (engine.cols - 3) - engine.stone_x)
+        engine.insta_drop()
+        board = copy_board(engine.board)
+        cells = {(x, y) for x in range(engine.cols) for y in range(engine.rows)}
+        result = engine.resolve_cascade(board, dirty=cells)
+        engine.resolve_board()
+        assert as_lists(result.board) == as_lists(engine.board)
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+# Collisions on the walled bitboard against the original check_collision
+
+import random
+
+import pytest
+
+import reference_rules as ref
+from tetris_engine import (
+    TetrisConfig,
+    TetrisEngine,
+    check_collision,
+    tetris_shapes,
+)
+
+
+def random_stone(rng, shape):
+    return [[rng.randrange(1, 8) if cell else 0 for cell in row] for row in shape]
+
+
+@pytest.mark.parametrize("cols, rows", [(10, 22), (5, 9)])
+def test_collisions_match_reference(cols, rows):
+    rng = random.Random(41)
+    engine = TetrisEngine(seed=0, config=TetrisConfig(cols, rows, 3))
+    for board in ref.random_boards(20, seed=42, cols=cols, rows=rows, fill=0.3):
+        engine.board = board
+        for shape in tetris_shapes:
+            engine.stone = stone = random_stone(rng, shape)
+            engine.current_rotation()
+            for rotation in range(4):
+                # 回転表の値の並びは、元の回転を繰り返した結果と同じ
+                assert engine.rotations[rotation][0] == stone
+                for x in range(-2, cols + 1):
+                    for y in range(rows + 2):
+                        expected = ref.check_collision(board, stone, (x, y))
+                        assert check_collision(board, stone, (x, y)) == expected
+                        assert engine.stone_collides(rotation, (x, y)) == expected
+                stone = ref.rotate_clockwise(stone)
+
+
+def test_bitboard_follows_placed_stones():
+    "ストーンを置いて連鎖が終わった後のビットボードは、ボードから作り直したものと同じ"
+    engine = TetrisEngine(seed=43)
+    rng = random.Random(44)
+    for _ in range(60):
+        if engine.gameover:
+            break
+        engine.place_stone(rng.randrange(4), rng.randrange(engine.cols))
+        bitboard = list(engine.get_bitboard())
+        engine.board = engine.board
+        assert bitboard == engine.get_bitboard()
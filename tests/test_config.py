@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+# Per-game board geometry and cluster threshold on every engine backend
+
+import random
+
+import pytest
+
+from backends import backends, engine_class
+from tetris_engine import TetrisConfig, TetrisEngine
+
+
+@pytest.mark.parametrize("module, name", backends)
+@pytest.mark.parametrize("config", [(3, 20, 3), (10, 3, 3), (10, 20, 0)])
+def test_invalid_config(module, name, config):
+    with pytest.raises(ValueError):
+        engine_class(module, name)(seed=0, config=config)
+
+
+@pytest.mark.parametrize("module, name", backends)
+@pytest.mark.parametrize(
+    "config", [TetrisConfig(4, 4, 1), TetrisConfig(5, 30, 2), TetrisConfig(40, 6, 5)]
+)
+def test_games_on_other_boards(module, name, config):
+    engine = engine_class(module, name)(seed=101, config=config)
+    assert (engine.cols, engine.rows, engine.cluster_thold) == config
+    rng = random.Random(102)
+    for _ in range(40):
+        if engine.gameover:
+            break
+        engine.place_stone(rng.randrange(4), rng.randrange(config.cols))
+        assert len(engine.board) == config.rows + 1
+        assert len(engine.board[0]) == config.cols
+        assert not engine.judge_can_settle(engine.board)
+    assert engine.gameover or engine.score > 0
+
+
+def test_threshold_changes_the_game():
+    "同じseedと操作でも、消えるのに必要な数が違えば異なるゲームになる"
+    games = []
+    for thold in (2, 3):
+        engine = TetrisEngine(seed=103, config=TetrisConfig(10, 22, thold))
+        rng = random.Random(104)
+        for _ in range(30):
+            if not engine.gameover:
+                engine.place_stone(rng.randrange(4), rng.randrange(10))
+        games.append((engine.score, engine.board))
+    assert games[0] != games[1]
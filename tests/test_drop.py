@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+
+# Hard drop from the column skyline and the ghost landing row
+
+import random
+
+import reference_rules as ref
+from tetris_engine import TetrisConfig, TetrisEngine, board_skyline
+
+
+def reference_landing(board, stone, x, y):
+    "元のdropを繰り返した時にストーンが止まるy座標"
+    while not ref.check_collision(board, stone, (x, y + 1)):
+        y += 1
+    return y
+
+
+def test_insta_drop_matches_stepwise_drop():
+    "insta_dropは、1段ずつのdrop(True)と同じボードと得点になる"
+    config = TetrisConfig(9, 16, 2)
+    fast = TetrisEngine(seed=51, config=config)
+    slow = TetrisEngine(seed=51, config=config)
+    rng = random.Random(52)
+    for _ in range(80):
+        if fast.gameover:
+            break
+        rotation, x = rng.randrange(4), rng.randrange(fast.cols)
+        for engine in fast, slow:
+            for _ in range(rotation):
+                engine.rotate_stone()
+            engine.move(x - engine.stone_x)
+        stone = fast.current_rotation()[0]
+        landing = reference_landing(fast.board, stone, fast.stone_x, fast.stone_y)
+        assert fast.landing_y() == landing
+        fast.insta_drop()
+        while not slow.drop(True):
+            pass
+        assert fast.board == slow.board
+        assert fast.score == slow.score
+        for engine in fast, slow:
+            engine.resolve_board()
+        assert fast.board == slow.board
+        assert fast.gameover == slow.gameover
+
+
+def test_skyline_follows_the_board():
+    engine = TetrisEngine(seed=53)
+    rng = random.Random(54)
+    for _ in range(60):
+        if engine.gameover:
+            break
+        engine.place_stone(rng.randrange(4), rng.randrange(engine.cols))
+        assert engine.get_skyline() == board_skyline(engine.board)
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+# Entangled groups: Bell pair correlations and the bookkeeping of the store
+
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from tetris_entangled import (  # noqa: E402
+    EntangledStateStore,
+    EntangledTetrisEngine,
+    ghz_state,
+)
+from tetris_quantum import entangled_value, gate_matrices  # noqa: E402
+
+
+@pytest.mark.parametrize("flip", [False, True])
+def test_measuring_a_bell_pair_collapses_the_partner(flip):
+    for seed in range(20):
+        store = EntangledStateStore()
+        a, b = store.new_group(ghz_state(2))
+        if flip:
+            store.apply(a, gate_matrices["X"])
+        outcome = store.measure(a, random.Random(seed))
+        amps = store.release(b)
+        expected = outcome ^ flip
+        assert np.allclose(np.abs(amps), np.eye(2)[expected])
+        assert len(store) == 0 and not store.group_of
+
+
+def test_gate_acts_on_the_shared_state():
+    store = EntangledStateStore()
+    a, b = store.new_group(ghz_state(2))
+    store.apply(b, gate_matrices["H"])
+    # H⊗Hは (|00> + |11>)/√2 を変えないので、片方だけでは部分系が変わる
+    assert np.allclose(store.reduced_state(a), np.eye(2) / 2)
+    store.apply(a, gate_matrices["H"])
+    qubits, state = store.groups[store.group_of[a]]
+    assert np.allclose(state, ghz_state(2))
+
+
+def check_groups(engine):
+    "盤面のEのセルとストアのqubitが1対1に対応し、状態が正規化されている"
+    cells = engine.qubits[engine.qubits != 0]
+    assert ((engine.board == entangled_value) == (engine.qubits != 0)).all()
+    assert sorted(cells) == sorted(engine.store.group_of)
+    for qubits, state in engine.store.groups.values():
+        assert len(qubits) >= 2
+        assert np.isclose(np.sum(np.abs(state) ** 2), 1)
+
+
+def test_game_keeps_groups_consistent():
+    engine = EntangledTetrisEngine(seed=71, entangle_rate=1.0)
+    rng = random.Random(72)
+    measured = 0
+    for _ in range(80):
+        if engine.gameover:
+            break
+        before = engine.store.next_qubit - len(engine.store.group_of)
+        engine.place_stone(rng.randrange(4), rng.randrange(engine.cols))
+        measured += engine.store.next_qubit - len(engine.store.group_of) > before
+        check_groups(engine)
+    assert engine.store.next_qubit > 1
+    assert measured > 0
+
+
+def test_undo_restores_the_store():
+    engine = EntangledTetrisEngine(seed=73, entangle_rate=1.0)
+    rng = random.Random(74)
+    for _ in range(12):
+        engine.place_stone(rng.randrange(4), rng.randrange(engine.cols))
+    board = engine.board.copy()
+    qubits = engine.qubits.copy()
+    groups = {g: (list(q), s.copy()) for g, (q, s) in engine.store.groups.items()}
+    engine.place_stone(0, 0)
+    engine.place_stone(1, engine.cols - 1)
+    assert engine.undo() and engine.undo()
+    assert (engine.board == board).all()
+    assert (engine.qubits == qubits).all()
+    assert engine.store.groups.keys() == groups.keys()
+    for group, (q, s) in groups.items():
+        assert engine.store.groups[group][0] == q
+        assert np.allclose(engine.store.groups[group][1], s)
+    check_groups(engine)
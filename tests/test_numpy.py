@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+
+# NumpyTetrisEngine against the list engine and the original rules
+
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import reference_rules as ref  # noqa: E402
+from tetris_engine import TetrisEngine  # noqa: E402
+from tetris_numpy import NumpyTetrisEngine, board_dtype  # noqa: E402
+
+
+def as_lists(board):
+    return [[int(v) for v in row] for row in board]
+
+
+def test_cascade_matches_reference():
+    engine = NumpyTetrisEngine(seed=0)
+    for board in ref.random_boards(200, seed=11):
+        expected = ref.resolve([row[:] for row in board])
+        result = engine.resolve_cascade(np.array(board, dtype=board_dtype))
+        assert (as_lists(result.board), result.chain, result.cleared) == expected
+
+
+@pytest.mark.parametrize("threthold", [1, 2, 4])
+def test_find_cluster_matches_reference(threthold):
+    engine = NumpyTetrisEngine(seed=0)
+    for board in ref.random_boards(100, seed=12, fill=0.8):
+        expected = ref.find_cluster(board, threthold)
+        clusters = engine.find_cluster(np.array(board, dtype=board_dtype), threthold)
+        assert {(int(x), int(y)) for x, y in clusters} == expected
+
+
+def test_same_game_as_list_engine():
+    "同じseedと操作なら、リストのボードのエンジンと同じゲームになる"
+    engines = TetrisEngine(seed=13), NumpyTetrisEngine(seed=13)
+    rng = random.Random(14)
+    for _ in range(60):
+        if engines[0].gameover:
+            break
+        move = rng.randrange(4), rng.randrange(engines[0].cols)
+        for engine in engines:
+            engine.place_stone(*move)
+        assert as_lists(engines[1].board) == engines[0].board
+        assert engines[1].score == engines[0].score
+        assert engines[1].gameover == engines[0].gameover
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# FrameProfiler with a fake clock, and the spans of the Tk front end
+
+import pytest
+
+from tetris_profile import FrameProfiler, null_profiler
+
+
+class FakeClock(object):
+    "呼ばれるたびにstep (ns) ずつ進む時計"
+
+    def __init__(self, step=1000000):
+        self.now = 0
+        self.step = step
+
+    def __call__(self):
+        self.now += self.step
+        return self.now
+
+
+def test_nested_phases_and_frame_stats():
+    profiler = FrameProfiler(clock=FakeClock())
+    for _ in range(10):
+        profiler.begin_frame()
+        with profiler.span("input"):
+            with profiler.span("cascade"):
+                pass
+        with profiler.span("idle"):
+            pass
+    profiler.finish()
+    # 1フレームは時計を7回呼ぶ (begin_frame, 3個のスパンの開始と終了) = 7ms
+    assert profiler.frame_stats() == (7.0, 7.0, 6.0, 6.0)
+    stats = {name: (depth, mean) for name, depth, mean, p99 in profiler.phase_stats()}
+    assert stats == {"input": (0, 3.0), "cascade": (1, 1.0), "idle": (0, 1.0)}
+    names = [event["name"] for event in profiler.trace_events()]
+    assert names.count("frame") == 10
+    assert names.count("cascade") == 10
+
+
+def test_instrument_wraps_existing_methods_only():
+    class Engine(object):
+        def settle_board(self, board):
+            return board
+
+    engine = Engine()
+    profiler = FrameProfiler(clock=FakeClock())
+    profiler.instrument(engine, ["settle_board", "find_cluster"])
+    profiler.begin_frame()
+    assert engine.settle_board([1]) == [1]
+    profiler.begin_frame()
+    assert [name for name, depth, mean, p99 in profiler.phase_stats()] == [
+        "settle_board"
+    ]
+    assert not hasattr(engine, "find_cluster")
+    null_profiler.instrument(engine, ["settle_board"])
+    with null_profiler.span("draw"):
+        pass
+
+
+def test_tk_frames_are_profiled():
+    tk = pytest.importorskip("tkinter")
+    import tetris
+
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        pytest.skip("no display")
+    profiler = FrameProfiler()
+    try:
+        game = tetris.TetrisGame(root, 6, 8)
+        handler = tetris.EventHandller(root, game, profiler)
+        handler.start_event()
+        # タイマーを待たずに画面更新を進める
+        for _ in range(200):
+            if not handler.running:
+                break
+            handler.update_screen(None)
+        handler.end_event()
+    finally:
+        root.destroy()
+    profiler.finish()
+    names = {name for name, start, duration in profiler.events}
+    assert {"drop", "cascade", "draw", "idle", "analyze", "frame"} <= names
+    # フィールドの状態は連鎖の段階の中で調べる
+    cascades = [
+        (start, start + duration)
+        for name, start, duration in profiler.events
+        if name == "cascade"
+    ]
+    for name, start, duration in profiler.events:
+        if name == "analyze":
+            assert any(begin <= start < end for begin, end in cascades)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+# Real-time replay in the pygame front end (SDL dummy video driver)
+
+import io
+import os
+
+import pytest
+
+pygame = pytest.importorskip("pygame")
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+from tetris_engine import TetrisEngine  # noqa: E402
+from tetris_profile import FrameProfiler  # noqa: E402
+from tetris_pygame import TetrisApp  # noqa: E402
+from tetris_replay import (  # noqa: E402
+    ReplayRecorder,
+    engine_actions,
+    finish_cascade,
+    make_engine,
+    parse_replays,
+    play_replay,
+)
+
+
+def record_drops(seed, drops, interval):
+    "interval ms ごとに左右に動かしてinsta_dropしたゲームのReplayと、最後のエンジン"
+    engine = TetrisEngine(seed=seed)
+    stream = io.BytesIO()
+    recorder = ReplayRecorder(engine, stream)
+    actions = engine_actions(engine)
+    now = 0
+    for i in range(drops):
+        for name in ["left"] * (i % 4) + ["right"] * (i % 3) + ["drop"]:
+            if engine.gameover:
+                break
+            recorder.record(name, now)
+            finish_cascade(engine)
+            actions[name]()
+        now += interval
+    finish_cascade(engine)
+    recorder.close()
+    (replay,) = parse_replays(stream.getvalue())
+    return replay, engine
+
+
+def test_realtime_replay_times_cascades_outside_input():
+    replay, engine = record_drops(seed=7, drops=20, interval=60)
+    profiler = FrameProfiler()
+    app = TetrisApp(
+        lambda on_level_change, seed, config: make_engine(
+            replay.header, on_level_change
+        ),
+        profiler=profiler,
+    )
+    try:
+        played = app.play_replay(replay, fixed_step=True)
+    finally:
+        # SDLのスレッドを残すと、後のテストでforkした子プロセスが止まる
+        pygame.quit()
+    assert played.board == engine.board == play_replay(replay).board
+    assert played.score == engine.score
+    # 連鎖の段階は入力と落下のスパンの中で計測されない
+    actions = [
+        (start, start + duration)
+        for name, start, duration in profiler.events
+        if name in ("input", "drop")
+    ]
+    phases = [
+        start
+        for name, start, duration in profiler.events
+        if name in ("settle_board", "operate_all_gates", "find_cluster")
+    ]
+    assert phases
+    assert not [t for t in phases for begin, end in actions if begin <= t < end]
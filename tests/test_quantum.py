@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+
+# StatevectorTetrisEngine: the original values follow the original rules,
+# and the amplitudes stay normalized through a game with every gate
+
+import random
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import reference_rules as ref  # noqa: E402
+from tetris_numpy import board_dtype  # noqa: E402
+from tetris_quantum import (  # noqa: E402
+    StatevectorTetrisEngine,
+    is_state,
+    nearest_values,
+    value_amplitudes,
+)
+
+
+def load_board(engine, board):
+    "値のボードと、各量子状態の振幅をエンジンに設定"
+    engine.board = np.array(board, dtype=board_dtype)
+    engine.amps = value_amplitudes[engine.board]
+    engine.amps[-1] = 0
+
+
+def test_original_values_follow_original_rules():
+    engine = StatevectorTetrisEngine(seed=0)
+    for board in ref.random_boards(150, seed=61):
+        expected = ref.resolve([row[:] for row in board], engine.cluster_thold)
+        load_board(engine, board)
+        result = engine.resolve_cascade(engine.board)
+        assert (result.board.tolist(), result.chain, result.cleared) == expected
+
+
+def test_amplitudes_stay_normalized():
+    engine = StatevectorTetrisEngine(seed=62)
+    rng = random.Random(63)
+    chains = 0
+    for _ in range(80):
+        if engine.gameover:
+            break
+        engine.place_stone(rng.randrange(4), rng.randrange(engine.cols))
+        chains += engine.chain
+        body = engine.board[:-1]
+        amps = engine.amps[:-1]
+        qubits = is_state[body]
+        assert np.allclose(np.linalg.norm(amps[qubits], axis=-1), 1)
+        assert not amps[~qubits].any()
+        assert (body[qubits] == nearest_values(amps[qubits])).all()
+    assert chains > 0
+
+
+def test_only_its_own_board():
+    engine = StatevectorTetrisEngine(seed=0)
+    with pytest.raises(ValueError):
+        engine.cascade_step(engine.board.copy())
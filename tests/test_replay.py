@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+# Replay logs: encoding round trip and re-execution of recorded games
+
+import io
+import random
+
+import pytest
+
+from tetris_engine import TetrisConfig, TetrisEngine
+from tetris_replay import (
+    ReplayError,
+    ReplayRecorder,
+    action_names,
+    engine_actions,
+    finish_cascade,
+    header_config,
+    parse_replays,
+    play_replay,
+    read_varint,
+    write_varint,
+)
+from tetris_selfplay import run_selfplay
+
+
+def test_varint_round_trip():
+    values = [0, 1, 127, 128, 300, 2**32 + 5, 2**70]
+    out = bytearray()
+    for value in values:
+        write_varint(out, value)
+    pos = 0
+    for value in values:
+        decoded, pos = read_varint(out, pos)
+        assert decoded == value
+    assert pos == len(out)
+    with pytest.raises(ReplayError):
+        read_varint(out[:-1], len(out) - 10)
+
+
+def record_game(seed, config, rng, moves):
+    "キー操作をランダムに記録しながらプレイし、(ログのバイト列, 記録した操作, エンジン)"
+    engine = TetrisEngine(seed=seed, config=config)
+    stream = io.BytesIO()
+    recorder = ReplayRecorder(engine, stream)
+    actions = engine_actions(engine)
+    names = ["left", "right", "down", "rotate", "drop", "tick", "undo"]
+    recorded = []
+    now = 0
+    for _ in range(moves):
+        if engine.gameover:
+            break
+        name = rng.choice(names)
+        now += rng.randrange(0, 400)
+        recorder.record(name, now)
+        recorded.append((now, name, None))
+        finish_cascade(engine)
+        actions[name]()
+    finish_cascade(engine)
+    recorder.close()
+    return stream.getvalue(), recorded, engine
+
+
+def test_encode_decode_round_trip():
+    config = TetrisConfig(8, 15, 2)
+    data, recorded, engine = record_game(91, config, random.Random(92), 300)
+    (replay,) = parse_replays(data)
+    assert header_config(replay.header) == config
+    assert replay.header.seed == 91
+    assert replay.header.engine == "TetrisEngine"
+    actions = [event for event in replay.events if event[1] != "piece"]
+    assert actions == recorded
+    assert {name for t, name, arg in actions} <= set(action_names)
+    # 1操作あたり数バイト
+    assert len(data) < 4 * len(replay.events) + 64
+
+
+def test_play_replay_reproduces_the_game():
+    for seed in range(5):
+        data, recorded, engine = record_game(
+            seed, TetrisConfig(10, 22, 3), random.Random(seed), 400
+        )
+        (replay,) = parse_replays(data)
+        played = play_replay(replay)
+        assert played.board == engine.board
+        assert (played.score, played.level, played.lines) == (
+            engine.score,
+            engine.level,
+            engine.lines,
+        )
+        assert played.max_chain == engine.max_chain
+        assert played.gameover == engine.gameover
+
+
+def test_selfplay_records_replayable_games():
+    results = run_selfplay(
+        range(3), max_stones=60, processes=1, record=True, config=(9, 18, 2)
+    )
+    log = b"".join(result.replay for result in results)
+    replays = list(parse_replays(log))
+    assert len(replays) == len(results)
+    for result, replay in zip(results, replays):
+        engine = play_replay(replay)
+        assert (engine.score, engine.max_chain) == (result.score, result.max_chain)
+        assert (engine.level, engine.lines) == (result.level, result.lines)
+
+
+def test_other_pieces_fail_instead_of_drifting():
+    data, recorded, engine = record_game(
+        93, TetrisConfig(10, 22, 3), random.Random(94), 100
+    )
+    (replay,) = parse_replays(data)
+    header = replay.header._replace(seed=95)
+    with pytest.raises(ReplayError):
+        play_replay(replay._replace(header=header))
+    with pytest.raises(ReplayError):
+        list(parse_replays(data[:-1]))
+    with pytest.raises(ReplayError):
+        list(parse_replays(b"XXXX" + data))
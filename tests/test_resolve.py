@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+# iter_cascade / resolve_cascade against the original rules and the game loop
+
+import random
+
+import reference_rules as ref
+from tetris_engine import TetrisEngine
+
+
+def reference_phases(board):
+    phases = []
+    while True:
+        phase, n = ref.cascade_step(board)
+        if phase is None:
+            return phases
+        phases.append((phase, n))
+
+
+def test_iter_cascade_steps_match_reference():
+    engine = TetrisEngine(seed=0)
+    for board in ref.random_boards(100, seed=21):
+        expected = reference_phases([row[:] for row in board])
+        steps = list(engine.iter_cascade(board))
+        cleared = [step.cleared for step in steps]
+        assert [step.phase for step in steps] == [phase for phase, n in expected]
+        assert cleared == [
+            sum(n for phase, n in expected[: i + 1]) for i in range(len(expected))
+        ]
+        assert all(step.board is board for step in steps)
+
+
+def test_resolve_cascade_matches_game_loop():
+    "ボードのコピーを解いた結果は、ゲームの連鎖の結果と得点に一致し、ゲームは変更しない"
+    engine = TetrisEngine(seed=22)
+    rng = random.Random(23)
+    for _ in range(80):
+        if engine.gameover:
+            break
+        engine.move(rng.randrange(engine.cols) - engine.stone_x)
+        engine.insta_drop()
+        score, level, lines = engine.score, engine.level, engine.lines
+        result = engine.resolve_cascade([row[:] for row in engine.board])
+        assert (engine.score, engine.level, engine.lines) == (score, level, lines)
+        engine.resolve_board()
+        assert result.board == engine.board
+        assert result.points == engine.score - score
+        assert result.chain == engine.chain
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+
+# Seeded self-play: the same seeds give the same games on any number of workers
+
+from tetris_engine import TetrisConfig
+from tetris_selfplay import RandomAgent, run_selfplay, summarize
+
+
+def outcomes(results):
+    return [(r.seed, r.score, r.max_chain, r.level, r.lines, r.stones) for r in results]
+
+
+def test_results_do_not_depend_on_workers():
+    seeds = list(range(6))
+    serial = run_selfplay(seeds, RandomAgent, max_stones=40, processes=1)
+    pooled = run_selfplay(seeds, RandomAgent, max_stones=40, processes=2)
+    assert outcomes(serial) == outcomes(pooled)
+    assert [r.seed for r in pooled] == seeds
+    assert summarize(pooled)["games"] == len(seeds)
+
+
+def test_seed_and_config_determine_the_game():
+    config = TetrisConfig(8, 14, 2)
+    first = run_selfplay([3, 4], max_stones=50, processes=1, config=config)
+    again = run_selfplay([3, 4], max_stones=50, processes=1, config=config)
+    other = run_selfplay([3, 4], max_stones=50, processes=1)
+    assert outcomes(first) == outcomes(again)
+    assert outcomes(first) != outcomes(other)
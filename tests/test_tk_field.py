@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+
+# TetrisField of the Tk version (skipped when tkinter is not available)
+
+import random
+
+import pytest
+
+pytest.importorskip("tkinter")
+
+import tetris  # noqa: E402
+
+
+def put(field, x, y, label):
+    field.get_square(x, y).set_color(tetris.label_color_dict[label])
+    field.get_square(x, y).set_label(label)
+
+
+def test_square_views_refer_to_the_same_cell():
+    field = tetris.TetrisField(5, 6)
+    a = field.get_square(2, 3)
+    b = field.get_square(2, 3)
+    assert a is not b
+    assert a == b and hash(a) == hash(b)
+    assert a != field.get_square(3, 2)
+    assert a != tetris.TetrisField(5, 6).get_square(2, 3)
+    assert len({a, b}) == 1
+    put(field, 2, 3, "1")
+    assert b.get_label() == "1"
+    assert b.get_cord() == (2, 3)
+    assert field.labels[3 * 5 + 2] == "1"
+    assert len(field.get_squares()) == 5 * 6
+
+
+def test_set_cord_moves_the_view():
+    "set_cordは正方形が参照する要素を変え、フィールドの内容は変えない"
+    field = tetris.TetrisField(5, 6)
+    put(field, 2, 3, "1")
+    square = field.get_square(2, 3)
+    square.set_cord(4, 1)
+    assert square.get_cord() == (4, 1)
+    assert square == field.get_square(4, 1)
+    assert square.get_label() == tetris.base_label
+    assert field.get_square(2, 3).get_label() == "1"
+    square.set_label("0")
+    assert field.labels[1 * 5 + 4] == "0"
+
+
+def test_delete_pair():
+    field = tetris.TetrisField(5, 6)
+    put(field, 1, 4, "1")
+    put(field, 2, 4, "1")
+    put(field, 3, 4, "0")
+    deletable = field.get_deletable_block()
+    assert set(deletable) == {field.get_square(1, 4), field.get_square(2, 4)}
+    field.delete_same_step()
+    assert field.get_square(1, 4).get_color() == tetris.base_color
+    assert field.get_square(3, 4).get_label() == "0"
+
+
+def test_single_block_cluster():
+    field = tetris.TetrisField(5, 6, cluster_thold=1)
+    put(field, 1, 4, "1")
+    put(field, 3, 4, "+")
+    deletable = set(field.get_deletable_block())
+    assert deletable == {field.get_square(1, 4), field.get_square(3, 4)}
+
+
+def test_large_cluster_threshold():
+    field = tetris.TetrisField(5, 6, cluster_thold=3)
+    put(field, 0, 5, "1")
+    put(field, 1, 5, "1")
+    put(field, 3, 5, "0")
+    put(field, 4, 5, "0")
+    put(field, 4, 4, "0")
+    assert set(field.get_deletable_block()) == {
+        field.get_square(3, 5),
+        field.get_square(4, 5),
+        field.get_square(4, 4),
+    }
+
+
+@pytest.mark.parametrize(
+    "width, height, cluster_thold", [(4, 20, 2), (10, 3, 2), (10, 20, 0)]
+)
+def test_invalid_field_config(width, height, cluster_thold):
+    with pytest.raises(ValueError):
+        tetris.TetrisField(width, height, cluster_thold)
+
+
+def test_smallest_field_fits_every_block():
+    field = tetris.TetrisField(tetris.MIN_FIELD_WIDTH, tetris.MIN_FIELD_HEIGHT)
+    for _ in range(200):
+        block = tetris.TetrisBlock(field.get_width())
+        for square in block.get_squares():
+            x, y = square.get_cord()
+            assert 0 <= x < field.get_width() and 0 <= y < field.get_height()
+
+
+labels = list(tetris.label_color_dict) + tetris.opperator_labels
+
+
+def random_cell(rng):
+    "空の正方形か、ランダムな量子状態かゲートの (色, ラベル)"
+    if rng.random() < 0.4:
+        return tetris.base_color, tetris.base_label
+    label = rng.choice(labels)
+    return tetris.label_color_dict.get(label, "white"), label
+
+
+def random_writes(field, rng, steps):
+    "全ての書き換え方法をランダムにsteps回使い、1回ごとにフィールドを出力"
+    frozen = [field.freeze()]
+    width, height = field.get_width(), field.get_height()
+
+    def write_cell():
+        field.set_cell(rng.randrange(width * height), *random_cell(rng))
+
+    def write_square():
+        square = field.get_square(rng.randrange(width), rng.randrange(height))
+        color, label = random_cell(rng)
+        square.set_color(color)
+        square.set_label(label)
+
+    def fix_block():
+        block = tetris.TetrisBlock(width)
+        for _ in range(rng.randrange(height)):
+            if field.judge_can_move(block, tetris.MOVE_DOWN):
+                block.move(tetris.MOVE_DOWN)
+        field.fix_block(block)
+
+    def restore():
+        field.restore(rng.choice(frozen))
+
+    writes = [
+        write_cell,
+        write_square,
+        fix_block,
+        field.down_after_fix,
+        field.operate_all_gates,
+        field.delete_same_step,
+        field.delete_same_chain,
+        restore,
+        lambda: frozen.append(field.freeze()),
+    ]
+    for _ in range(steps):
+        rng.choice(writes)()
+        yield field
+
+
+def test_occupied_bits_follow_every_write():
+    "どの方法で書き換えても、ブロックの有無のビットは色から作り直したものと同じ"
+    random.seed(61)
+    field = tetris.TetrisField(6, 8)
+    for field in random_writes(field, random.Random(62), 400):
+        for y in range(field.get_height()):
+            row = field.colors[y * 6 : (y + 1) * 6]
+            bits = sum(
+                1 << x for x, color in enumerate(row) if color != tetris.base_color
+            )
+            assert field.occupied[y] == bits
+
+
+def report_indexes(report):
+    "フィールドの状態の正方形を、比較できるように要素の番号にしたもの"
+    operator_targets = {
+        operator.index: [square.index for square in squares]
+        for operator, squares in report.operator_targets.items()
+    }
+    deletable = {square.index for square in report.deletable}
+    return report.fall_columns, operator_targets, deletable
+
+
+@pytest.mark.parametrize("cluster_thold", [1, 2, 3])
+def test_cached_analysis_follows_every_write(cluster_thold):
+    "キャッシュしたフィールドの状態は、同じ内容の新しいフィールドで調べたものと同じ"
+    random.seed(cluster_thold)
+    field = tetris.TetrisField(6, 8, cluster_thold)
+    # 書き換える前の状態をキャッシュさせる
+    field.analyze()
+    for field in random_writes(field, random.Random(cluster_thold), 400):
+        fresh = tetris.TetrisField(6, 8, cluster_thold)
+        for i, (color, label) in enumerate(zip(field.colors, field.labels)):
+            fresh.set_cell(i, color, label)
+        assert report_indexes(field.analyze()) == report_indexes(fresh.analyze())
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+# Copy-on-write snapshots and the undo stack
+
+import random
+
+import pytest
+
+from tetris_engine import TetrisEngine
+
+
+def state(engine):
+    return (
+        [list(row) for row in engine.board],
+        engine.stone,
+        engine.stone_x,
+        engine.next_stone,
+        engine.score,
+        engine.level,
+        engine.lines,
+        engine.gameover,
+    )
+
+
+def play(engine, rng, turns):
+    for _ in range(turns):
+        if engine.gameover:
+            break
+        engine.place_stone(rng.randrange(4), rng.randrange(engine.cols))
+
+
+def test_restore_replays_the_same_game():
+    "スナップショットに戻して同じ操作をすると、同じゲーム (同じストーンの列) になる"
+    engine = TetrisEngine(seed=81)
+    play(engine, random.Random(0), 10)
+    snapshot = engine.snapshot()
+    expected = state(engine)
+    play(engine, random.Random(82), 25)
+    after = state(engine)
+    engine.restore(snapshot)
+    assert state(engine) == expected
+    play(engine, random.Random(82), 25)
+    assert state(engine) == after
+
+
+def test_unchanged_rows_are_shared():
+    engine = TetrisEngine(seed=83)
+    first = engine.snapshot()
+    engine.place_stone(0, 0)
+    second = engine.snapshot()
+    shared = sum(a is b for a, b in zip(first.board, second.board))
+    assert shared >= engine.rows - 4
+    assert second.board[-1] is first.board[-1]
+
+
+@pytest.mark.parametrize("turns", [1, 5, TetrisEngine.undo_limit + 3])
+def test_undo_goes_back_one_stone_at_a_time(turns):
+    engine = TetrisEngine(seed=84)
+    rng = random.Random(85)
+    states = [state(engine)]
+    for _ in range(turns):
+        engine.place_stone(rng.randrange(4), rng.randrange(engine.cols))
+        states.append(state(engine))
+        if engine.gameover:
+            break
+    undone = 0
+    while engine.undo():
+        undone += 1
+        assert state(engine) == states[-1 - undone]
+    assert undone == min(len(states) - 1, TetrisEngine.undo_limit)
+    # 戻した状態からのビットボードは作り直したものと同じ
+    bitboard = list(engine.get_bitboard())
+    engine.board = engine.board
+    assert bitboard == engine.get_bitboard()
@@ -1,16 +1,41 @@
 # -*- coding:utf-8 -*-
+import argparse
+import copy
 import random
 import time
+import sys
 import tkinter as tk
+from collections import deque
+
+from tetris_profile import FrameProfiler, null_profiler
 
 # 定数
-BLOCK_SIZE = 25  # ブロックの縦横サイズpx
-FIELD_WIDTH = 10  # フィールドの幅
-FIELD_HEIGHT = 20  # フィールドの高さ
+BLOCK_SIZE = 25  # ブロックの縦横サイズpx (大きなフィールドでは縮小する)
+MIN_LABEL_SIZE = 12  # ラベルを表示する最小のブロックのサイズpx
+MAX_CANVAS_SIZE = (1200, 800)  # ブロックを縮小して収めるキャンバスの最大の幅と高さpx
+FIELD_WIDTH = 10  # フィールドの幅 (既定値)
+FIELD_HEIGHT = 20  # フィールドの高さ (既定値)
+CLUSTER_THOLD = 2  # 消えるのに必要な隣接した同じ量子状態の数 (既定値)
+UNDO_LIMIT = 32  # 取り消せる手数
+MIN_FIELD_WIDTH = 5  # フィールドの最小の幅 (横棒のブロックが出現できる幅)
+MIN_FIELD_HEIGHT = 4  # フィールドの最小の高さ (縦棒のブロックが出現できる高さ)
 
 MOVE_LEFT = 0  # 左にブロックを移動することを示す定数
 MOVE_RIGHT = 1  # 右にブロックを移動することを示す定数
 MOVE_DOWN = 2  # 下にブロックを移動することを示す定数
+
+# プロファイラで計測するフィールドのメソッド
+field_phases = [
+    "judge_can_move",
+    "judge_game_over",
+    "fix_block",
+    "analyze",
+    "down_after_fix",
+    "operate_all_gates",
+    "delete_same_step",
+    "freeze",
+    "restore",
+]
 base_color = "gray"
 base_label = "N"
 
@@ -45,8 +70,11 @@ label_color_dict = {
 # 色が同じなら消すのではなく、ラベルが同じなら消すという書き方に(ラベルに色を追従させる)
 # 連鎖の過程を表示できるように
 
+
 # ブロックを構成する正方形のクラス
 class TetrisSquare:
+    __slots__ = ("x", "y", "color", "label")
+
     def __init__(self, x=0, y=0, color=base_color, label=base_label):
         "１つの正方形を作成"
         self.x = x
@@ -96,13 +124,63 @@ class TetrisSquare:
             return x, y
 
 
+# フィールドの配列の1要素を参照する正方形のクラス
+# (必要な時に作成し、同じ要素を参照する正方形は等しいものとして扱う)
+class FieldSquare(TetrisSquare):
+    __slots__ = ("field", "index")
+
+    def __init__(self, field, index):
+        "TetrisFieldのindex番目の要素を参照する正方形を作成"
+        self.field = field
+        self.index = index
+
+    def __eq__(self, other):
+        return (
+            isinstance(other, FieldSquare)
+            and self.field is other.field
+            and self.index == other.index
+        )
+
+    def __hash__(self):
+        return hash((id(self.field), self.index))
+
+    def set_cord(self, x, y):
+        "参照する要素を座標(x, y)の要素に変更 (フィールドの内容は変更しない)"
+        self.index = y * self.field.width + x
+
+    @property
+    def x(self):
+        return self.index % self.field.width
+
+    @property
+    def y(self):
+        return self.index // self.field.width
+
+    @property
+    def color(self):
+        return self.field.colors[self.index]
+
+    @color.setter
+    def color(self, color):
+        self.field.set_cell(self.index, color, self.label)
+
+    @property
+    def label(self):
+        return self.field.labels[self.index]
+
+    @label.setter
+    def label(self, label):
+        self.field.set_cell(self.index, self.color, label)
+
+
 # テトリス画面を描画するキャンバスクラス
 class TetrisCanvas(tk.Canvas):
-    def __init__(self, master, field):
+    def __init__(self, master, field, block_size=BLOCK_SIZE):
         "テトリスを描画するキャンバスを作成"
 
-        canvas_width = field.get_width() * BLOCK_SIZE
-        canvas_height = field.get_height() * BLOCK_SIZE
+        self.block_size = block_size
+        canvas_width = field.get_width() * block_size
+        canvas_height = field.get_height() * block_size
 
         # tk.Canvasクラスのinit
         super().__init__(master, width=canvas_width, height=canvas_height, bg="white")
@@ -110,86 +188,100 @@ class TetrisCanvas(tk.Canvas):
         # キャンバスを画面上に設置
         self.place(x=25, y=25)
 
-        # 10x20個の正方形を描画することでテトリス画面を作成
+        # 幅x高さ個の正方形を描画することでテトリス画面を作成
+        # 長方形とラベルの描画アイテムはここで一度だけ作成し、以降は設定のみ変更する
+        # (ブロックが小さくて文字が読めない場合はラベルのアイテムを作らない)
+        self.field_width = field.get_width()
+        self.show_labels = block_size >= MIN_LABEL_SIZE
+        self.rect_items = []
+        self.text_items = []
         for y in range(field.get_height()):
             for x in range(field.get_width()):
                 square = field.get_square(x, y)
-                x1 = x * BLOCK_SIZE
-                x2 = (x + 1) * BLOCK_SIZE
-                y1 = y * BLOCK_SIZE
-                y2 = (y + 1) * BLOCK_SIZE
-                self.create_rectangle(
-                    x1, y1, x2, y2, outline="white", width=1, fill=square.get_color()
+                color = square.get_color()
+                x1 = x * block_size
+                x2 = (x + 1) * block_size
+                y1 = y * block_size
+                y2 = (y + 1) * block_size
+                x_c = (x1 + x2) / 2
+                y_c = (y1 + y2) / 2
+                self.rect_items.append(
+                    self.create_rectangle(
+                        x1,
+                        y1,
+                        x2,
+                        y2,
+                        outline="white",
+                        width=1 if block_size > 2 else 0,
+                        fill=color,
+                    )
+                )
+                if not self.show_labels:
+                    continue
+                self.text_items.append(
+                    self.create_text(
+                        (x_c, y_c),
+                        text=square.get_label(),
+                        fill="white",
+                        state=tk.HIDDEN if color == base_color else tk.NORMAL,
+                    )
                 )
 
-        # 一つ前に描画したフィールドを設定
-        self.before_field = field
+        # デバッグ表示用の描画アイテム (update_debugで初めて作成)
+        self.debug_items = None
 
-    def update(self, field, block):
-        "テトリス画面をアップデート"
+        # 一つ前に描画した色とラベルを設定
+        self.shown_colors, self.shown_labels = field.snapshot()
 
-        # 描画用のフィールド（フィールド＋ブロック）を作成
-        new_field = TetrisField()
-        for y in range(field.get_height()):
-            for x in range(field.get_width()):
-                square = field.get_square(x, y)
-                color = square.get_color()
-                label = square.get_label()
+    def draw_square(self, i, color, label):
+        "i番目(y * 幅 + x)の長方形とラベルの描画アイテムを更新"
+        self.shown_colors[i] = color
+        self.shown_labels[i] = label
+        self.itemconfig(self.rect_items[i], fill=color)
+        if not self.show_labels:
+            return
+        if color != base_color:
+            self.itemconfig(self.text_items[i], text=label, state=tk.NORMAL)
+        else:
+            self.itemconfig(self.text_items[i], state=tk.HIDDEN)
 
-                new_square = new_field.get_square(x, y)
-                new_square.set_color(color)
-                new_square.set_label(label)
+    def update(self, field, block):
+        "テトリス画面をアップデート"
 
-        # フィールドにブロックの正方形情報を合成
+        # ブロックの正方形の位置ごとの色とラベル
+        block_cells = {}
         if block is not None:
-            block_squares = block.get_squares()
-            for block_square in block_squares:
-                # ブロックの正方形の座標と色を取得
+            for block_square in block.get_squares():
                 x, y = block_square.get_cord()
-                color = block_square.get_color()
-                label = block_square.get_label()
-
-                # 取得した座標のフィールド上の正方形の色を更新
-                new_field_square = new_field.get_square(x, y)
-                new_field_square.set_color(color)
-                new_field_square.set_label(label)
-
-        # 描画用のフィールドを用いてキャンバスに描画
-        for y in range(field.get_height()):
-            for x in range(field.get_width()):
-
-                # (x,y)座標のフィールドの色を取得
-                new_square = new_field.get_square(x, y)
-                new_color = new_square.get_color()
-                new_label = new_square.get_label()
-                # (x,y)座標が前回描画時から変化ない場合は描画しない
-                before_square = self.before_field.get_square(x, y)
-                before_color = before_square.get_color()
-                if new_color == before_color:
-                    continue
-
-                x1 = x * BLOCK_SIZE
-                x2 = (x + 1) * BLOCK_SIZE
-                y1 = y * BLOCK_SIZE
-                y2 = (y + 1) * BLOCK_SIZE
-                x_c = (x1 + x2) / 2
-                y_c = (y1 + y2) / 2
-                # フィールドの各位置の色で長方形描画
-                self.create_rectangle(
-                    x1, y1, x2, y2, outline="white", width=1, fill=new_color
+                block_cells[y * field.get_width() + x] = (
+                    block_square.get_color(),
+                    block_square.get_label(),
                 )
-                if new_color != base_color:
-                    self.create_text((x_c, y_c), text=new_label, fill="white")
 
-        # 前回描画したフィールドの情報を更新
-        self.before_field = new_field
+        # フィールドにブロックを重ねた色とラベルを、前回描画時と比較して描画
+        # (フィールドの配列を直接参照し、描画用のフィールドは作成しない)
+        colors = field.colors
+        labels = field.labels
+        shown_colors = self.shown_colors
+        shown_labels = self.shown_labels
+        for i in range(len(colors)):
+            if i in block_cells:
+                new_color, new_label = block_cells[i]
+            else:
+                new_color = colors[i]
+                new_label = labels[i]
+            # 前回描画時から変化ない場合は描画しない
+            if new_color == shown_colors[i] and new_label == shown_labels[i]:
+                continue
+
+            # フィールドの各位置の色で長方形描画
+            self.draw_square(i, new_color, new_label)
 
     def update_debug(self, field):
         "連鎖部分をアップデート"
 
         # debug_label(field)
-        new_field = TetrisField()
-        # 描画用のフィールドを用いてキャンバスに描画
+        # フィールドを用いてキャンバスに描画
         for y in range(field.get_height()):
             for x in range(field.get_width()):
                 # (x,y)座標のフィールドの色を取得
@@ -197,53 +289,86 @@ class TetrisCanvas(tk.Canvas):
                 color = square.get_color()
                 label = square.get_label()
 
-                new_square = new_field.get_square(x, y)
-                new_square.set_color(color)
-                new_square.set_label(label)
-
                 if y > 10:
                     print(x, y, label, color)
 
-                x1 = x * BLOCK_SIZE
-                x2 = (x + 1) * BLOCK_SIZE
-                y1 = y * BLOCK_SIZE
-                y2 = (y + 1) * BLOCK_SIZE
-                x_c = (x1 + x2) / 2
-                y_c = (y1 + y2) / 2
                 # フィールドの各位置の色で長方形描画
-                self.create_rectangle(
-                    x1, y1, x2, y2, outline="white", width=1, fill=color
-                )
-                if color != base_color:
-                    self.create_text((x_c, y_c), text=label, fill="white")
+                self.draw_square(y * field.get_width() + x, color, label)
 
         rand_color = random.choice(["black", "white"])
         rand_label = random.choice(["A", "B"])
 
-        self.create_rectangle(
-            0,
-            19 * BLOCK_SIZE,
-            BLOCK_SIZE,
-            20 * BLOCK_SIZE,
-            outline="white",
-            width=1,
-            fill=rand_color,
+        if self.debug_items is None:
+            # ラベルは右下の正方形の中心に表示
+            block_size = self.block_size
+            x_c = (field.get_width() - 0.5) * block_size
+            y_c = (field.get_height() - 0.5) * block_size
+            self.debug_items = (
+                self.create_rectangle(
+                    0,
+                    (field.get_height() - 1) * block_size,
+                    block_size,
+                    field.get_height() * block_size,
+                    outline="white",
+                    width=1,
+                ),
+                self.create_text((x_c, y_c), fill="white"),
+            )
+        debug_rect, debug_text = self.debug_items
+        self.itemconfig(debug_rect, fill=rand_color)
+        self.itemconfig(debug_text, text=rand_label)
+
+
+# フィールドの状態を1回の走査で調べた結果のクラス
+class TetrisFieldReport:
+    def __init__(self, fall_columns, operator_targets, deletable):
+        "連鎖反応の各処理の判定に必要な情報をまとめる"
+
+        # 下に落とせるブロックがある列のビットを立てた整数
+        self.fall_columns = fall_columns
+        # ゲートの正方形 -> 作用する量子状態の正方形のリスト
+        self.operator_targets = operator_targets
+        # 消せる正方形のリスト (重複あり)
+        self.deletable = deletable
+
+
+def check_field_config(width, height, cluster_thold):
+    "フィールドの大きさとルールが有効か確認 (無効ならValueError)"
+    if width < MIN_FIELD_WIDTH or height < MIN_FIELD_HEIGHT:
+        raise ValueError(
+            "field must be at least %dx%d, got %dx%d"
+            % (MIN_FIELD_WIDTH, MIN_FIELD_HEIGHT, width, height)
         )
-        self.create_text((x_c, y_c), text=rand_label, fill="white")
+    if cluster_thold < 1:
+        raise ValueError("cluster_thold must be at least 1")
 
 
 # 積まれたブロックの情報を管理するフィールドクラス
 class TetrisField:
-    def __init__(self):
-        self.width = FIELD_WIDTH
-        self.height = FIELD_HEIGHT
+    def __init__(
+        self, width=FIELD_WIDTH, height=FIELD_HEIGHT, cluster_thold=CLUSTER_THOLD
+    ):
+        check_field_config(width, height, cluster_thold)
+        self.width = width
+        self.height = height
+        # 消えるのに必要な隣接した同じ量子状態の数
+        # (1なら全ての量子状態が、2なら隣接したペアが消える)
+        self.cluster_thold = cluster_thold
 
         # フィールドを初期化
-        self.squares = []
-        for y in range(self.height):
-            for x in range(self.width):
-                # フィールドを正方形インスタンスのリストとして管理
-                self.squares.append(TetrisSquare(x, y, base_color, base_label))
+        # 各座標の色とラベルを y * 幅 + x 番目の要素とする配列で管理
+        size = self.width * self.height
+        self.colors = [base_color] * size
+        self.labels = [base_label] * size
+        # 行ごとにブロックがある列のビットを立てた整数 (ブロックの衝突判定用)
+        self.occupied = [0] * self.height
+        # 変更のたびに増える番号と、その番号の時点で作成したフィールドの状態
+        self.version = 0
+        self.report = None
+        self.report_version = None
+        # 前回freezeした各行の状態と、それ以降に変更した行のset
+        self.frozen = None
+        self.changed_rows = set()
 
     def get_width(self):
         "フィールドの正方形の数（横方向）を取得"
@@ -258,71 +383,98 @@ class TetrisField:
     def get_squares(self):
         "フィールドを構成する正方形のリストを取得"
 
-        return self.squares
+        return [FieldSquare(self, i) for i in range(self.width * self.height)]
 
     def get_square(self, x, y):
         "指定した座標の正方形を取得"
 
-        return self.squares[y * self.width + x]
+        return FieldSquare(self, y * self.width + x)
 
-    def judge_game_over(self, block):
-        "ゲームオーバーかどうかを判断"
+    def set_cell(self, i, color, label):
+        "i番目(y * 幅 + x)の色とラベルを設定し、ブロックの有無のビットを更新"
 
-        # フィールド上で既に埋まっている座標の集合作成
-        no_empty_cord = set(
-            square.get_cord()
-            for square in self.get_squares()
-            if square.get_color() != base_color
-        )
+        self.colors[i] = color
+        self.labels[i] = label
+        self.version += 1
+        y, x = divmod(i, self.width)
+        self.changed_rows.add(y)
+        if color == base_color:
+            self.occupied[y] &= ~(1 << x)
+        else:
+            self.occupied[y] |= 1 << x
+
+    def snapshot(self):
+        "色とラベルの配列のコピーを取得"
 
-        # ブロックがある座標の集合作成
-        block_cord = set(square.get_cord() for square in block.get_squares())
+        return self.colors[:], self.labels[:]
 
-        # ブロックの座標の集合と
-        # フィールドの既に埋まっている座標の集合の積集合を作成
-        collision_set = no_empty_cord & block_cord
+    def freeze(self):
+        "各行の(色, ラベル)をタプルにした不変の状態を取得 (変更していない行は前回と共有)"
 
-        # 積集合が空であればゲームオーバーではない
-        if len(collision_set) == 0:
-            ret = False
+        width = self.width
+        if self.frozen is None:
+            rows = [None] * self.height
+            changed = range(self.height)
         else:
-            ret = True
+            rows = list(self.frozen)
+            changed = self.changed_rows
+        for y in changed:
+            start = y * width
+            rows[y] = (
+                tuple(self.colors[start : start + width]),
+                tuple(self.labels[start : start + width]),
+            )
+        self.frozen = tuple(rows)
+        self.changed_rows = set()
+        return self.frozen
 
-        return ret
+    def restore(self, frozen):
+        "freezeで取得した状態に戻す (前回のfreezeから変化した行だけを書き換える)"
 
-    def judge_can_move(self, block, direction):
-        "指定した方向にブロックを移動できるかを判断"
+        if self.frozen is None:
+            rows = range(self.height)
+        else:
+            rows = self.changed_rows | {
+                y for y in range(self.height) if frozen[y] is not self.frozen[y]
+            }
+        for y in rows:
+            colors, labels = frozen[y]
+            for x in range(self.width):
+                i = y * self.width + x
+                if self.colors[i] != colors[x] or self.labels[i] != labels[x]:
+                    self.set_cell(i, colors[x], labels[x])
+        self.frozen = frozen
+        self.changed_rows = set()
 
-        # フィールド上で既に埋まっている座標の集合作成
-        no_empty_cord = set(
-            square.get_cord()
-            for square in self.get_squares()
-            if square.get_color() != base_color
-        )
+    def judge_game_over(self, block):
+        "ゲームオーバーかどうかを判断"
 
-        # 移動後のブロックがある座標の集合作成
-        move_block_cord = set(
-            square.get_moved_cord(direction) for square in block.get_squares()
-        )
+        # ブロックのいずれかの座標がフィールド上で既に埋まっていればゲームオーバー
+        occupied = self.occupied
+        for square in block.get_squares():
+            x, y = square.get_cord()
+            if occupied[y] & (1 << x):
+                return True
 
-        # フィールドからはみ出すかどうかを判断
-        for x, y in move_block_cord:
+        return False
 
-            # はみ出す場合は移動できない
+    def judge_can_move(self, block, direction):
+        "指定した方向にブロックを移動できるかを判断"
+
+        occupied = self.occupied
+        for square in block.get_squares():
+            # 移動後の正方形の座標
+            x, y = square.get_moved_cord(direction)
+
+            # フィールドからはみ出す場合は移動できない
             if x < 0 or x >= self.width or y < 0 or y >= self.height:
                 return False
 
-        # 移動後のブロックの座標の集合と
-        # フィールドの既に埋まっている座標の集合の積集合を作成
-        collision_set = no_empty_cord & move_block_cord
-
-        # 積集合が空なら移動可能
-        if len(collision_set) == 0:
-            ret = True
-        else:
-            ret = False
+            # フィールドの既に埋まっている座標と重なる場合は移動できない
+            if occupied[y] & (1 << x):
+                return False
 
-        return ret
+        return True
 
     def fix_block(self, block):
         "ブロックを固定してフィールドに追加"
@@ -330,13 +482,9 @@ class TetrisField:
         for square in block.get_squares():
             # ブロックに含まれる正方形の座標と色を取得
             x, y = square.get_cord()
-            color = square.get_color()
-            label = square.get_label()
 
             # その座標と色をフィールドに反映
-            field_square = self.get_square(x, y)
-            field_square.set_color(color)
-            field_square.set_label(label)
+            self.set_cell(y * self.width + x, square.get_color(), square.get_label())
 
     # def delete_line(self):
     #     '行の削除を行う'
@@ -363,63 +511,125 @@ class TetrisField:
     #                 square = self.get_square(x, 0)
     #                 square.set_color(base_color)
 
+    def analyze(self):
+        "フィールドの状態を取得 (変更がなければ前回の結果を再利用)"
+
+        if self.report is not None and self.report_version == self.version:
+            return self.report
+
+        # ブロックがあり、その下が空いている列を行ごとにチェック
+        occupied = self.occupied
+        fall_columns = 0
+        for y in range(1, self.height - 1):
+            fall_columns |= occupied[y] & ~occupied[y + 1]
+
+        # ゲートとそのターゲット、消せるブロックを1回の走査で取得
+        operator_targets = {}
+        deletable = []
+        labels = self.labels
+        colors = self.colors
+        width = self.width
+        height = self.height
+        single = self.cluster_thold == 1
+        for y in range(height):
+            for x in range(width):
+                i = y * width + x
+                label = labels[i]
+                if label in opperator_labels:
+                    # 行列演算は順序があるため左右上下を確認する必要あり
+                    opperands = []
+                    neighbors = []
+                    # 左端の場合以外、左側に量子状態ブロックがあるかチェック
+                    if x != 0:
+                        neighbors.append(i - 1)
+                    # 右端の場合以外、右側に量子状態ブロックがあるかチェック
+                    if x != width - 1:
+                        neighbors.append(i + 1)
+                    # 上端の場合以外、上側に量子状態ブロックがあるかチェック
+                    if y != 0:
+                        neighbors.append(i - width)
+                    # 下端の場合以外、下側に量子状態ブロックがあるかチェック
+                    if y != height - 1:
+                        neighbors.append(i + width)
+                    for j in neighbors:
+                        if labels[j] in opperand_labels:
+                            opperands.append(FieldSquare(self, j))
+                    operator_targets[FieldSquare(self, i)] = opperands
+                elif colors[i] != base_color and label in opperand_labels:
+                    if single:
+                        # 1個で消えるため隣接したペアは調べない
+                        deletable.append(FieldSquare(self, i))
+                        continue
+                    # 右端の場合以外
+                    if x != width - 1 and labels[i + 1] == label:
+                        deletable.extend(
+                            [FieldSquare(self, i), FieldSquare(self, i + 1)]
+                        )
+                    # 下端の場合以外
+                    if y != height - 1 and labels[i + width] == label:
+                        deletable.extend(
+                            [FieldSquare(self, i), FieldSquare(self, i + width)]
+                        )
+
+        if self.cluster_thold > 2:
+            deletable = self.large_clusters(deletable)
+
+        self.report = TetrisFieldReport(fall_columns, operator_targets, deletable)
+        self.report_version = self.version
+        return self.report
+
+    def large_clusters(self, pairs):
+        "隣接したペアのリスト(2個ずつ)をつないだ連結成分のうち、cluster_thold個以上の正方形"
+
+        neighbors = {}
+        for a, b in zip(pairs[::2], pairs[1::2]):
+            neighbors.setdefault(a, []).append(b)
+            neighbors.setdefault(b, []).append(a)
+        squares = []
+        visited = set()
+        for start in neighbors:
+            if start in visited:
+                continue
+            visited.add(start)
+            component = [start]
+            # 探索中にcomponentへ追加した正方形も順に処理される
+            for square in component:
+                for other in neighbors[square]:
+                    if other not in visited:
+                        visited.add(other)
+                        component.append(other)
+            if len(component) >= self.cluster_thold:
+                squares.extend(component)
+        return squares
+
     def judge_can_fall(self):
         "フィールド上の全ブロックのういずれかが下に移動できるか判定"
-        can_fall = False
-        for y in range(self.height - 2, 0, -1):
-            for x in range(self.width):
-                square = self.get_square(x, y)
-                # ブロックがあった場合は下にブロックがあるかチェック
-                if square.get_color() != base_color:
-                    square_below = self.get_square(x, y + 1)
-                    if square_below.get_color() == base_color:
-                        can_fall = True
-                        break
-
-        return can_fall
+        return self.analyze().fall_columns != 0
 
     def down_after_fix(self):
         "フィールド上のブロックで下に落とせるものは落とす"
+        colors = self.colors
+        labels = self.labels
+        width = self.width
+        size = len(colors)
         for y in range(self.height - 2, 0, -1):
-            for x in range(self.width):
-                square = self.get_square(x, y)
-                if square.get_color() == base_color:
+            for x in range(width):
+                i = y * width + x
+                if colors[i] == base_color:
                     continue
                 # ブロックの下にスペースがあれば落としていく
-                for down_y in range(y + 1, FIELD_HEIGHT):
-                    square_below = self.get_square(x, down_y)
-                    if square_below.get_color() == base_color:
-                        square_below.set_color(square.get_color())
-                        square_below.set_label(square.get_label())
-                        square.set_color(base_color)
-                        square.set_label(base_label)
-                        square = self.get_square(x, down_y)
-                    else:
-                        break
+                below = i
+                while below + width < size and colors[below + width] == base_color:
+                    below += width
+                if below != i:
+                    self.set_cell(below, colors[i], labels[i])
+                    self.set_cell(i, base_color, base_label)
 
     def get_deletable_block(self):
         "消せるブロックのオプジェクトのリストを取得"
         # 重複ありのリストになっているが今のところ実害なし
         # 今のところは2個で消えるが今後3個以上で消えるパターンも検討
-        squares_to_delete = []
-        for y in range(self.height):
-            for x in range(self.width):
-                square = self.get_square(x, y)
-                if square.get_color() == base_color:
-                    continue
-                elif square.get_label() not in opperand_labels:
-                    continue
-                # 右端の場合以外
-                if x != FIELD_WIDTH - 1:
-                    square_r = self.get_square(x + 1, y)
-                    if square.get_label() == square_r.get_label():
-                        squares_to_delete.extend([square, square_r])
-                # 下端の場合以外
-                if y != FIELD_HEIGHT - 1:
-                    square_up = self.get_square(x, y + 1)
-                    if square.get_label() == square_up.get_label():
-                        squares_to_delete.extend([square, square_up])
-        return squares_to_delete
+        return self.analyze().deletable
 
     def exist_deletale(self):
         "消せるブロックがあるか確認"
@@ -429,8 +639,7 @@ class TetrisField:
         "消せるブロックがあれば消す(連鎖はしない)"
         squares_to_delete = self.get_deletable_block()
         for square in set(squares_to_delete):
-            square.set_color(base_color)
-            square.set_label(base_label)
+            self.set_cell(square.index, base_color, base_label)
 
     def delete_same_chain(self):
         "消せるブロックがあれば消す(連鎖する)"
@@ -453,6 +662,7 @@ class TetrisField:
 
     def operate_gate(self, operator_square, target_squares):
         "与えられたゲート"
+        # i <-> -i はH, X, Zのいずれでも入れ替わる (位相を除く)
         if operator_square.get_label() == "H":
             # 0 <-> +,  1 <-> -
             qstate_transition_dict = {"0": "+", "1": "-", "+": "0", "-": "1"}
@@ -461,49 +671,18 @@ class TetrisField:
             qstate_transition_dict = {"0": "1", "1": "0", "+": "+", "-": "-"}
         elif operator_square.get_label() == "Z":
             qstate_transition_dict = {"0": "0", "1": "1", "+": "-", "-": "+"}
+        qstate_transition_dict.update({"i": "-i", "-i": "i"})
 
         for square in target_squares:
             new_qstate = qstate_transition_dict[square.get_label()]
             new_color = label_color_dict[new_qstate]
-            square.set_label(new_qstate)
-            square.set_color(new_color)
+            self.set_cell(square.index, new_color, new_qstate)
 
-        operator_square.set_color(base_color)
-        operator_square.set_label(base_label)
+        self.set_cell(operator_square.index, base_color, base_label)
 
     def get_operator_target(self):
         "ゲートの位置と種類を取得"
-        operator_target_dict = {}
-        for y in range(self.height):
-            for x in range(self.width):
-                opperands = []
-                square = self.get_square(x, y)
-                if square.get_label() not in opperator_labels:
-                    continue
-                # 行列演算は順序があるため左右上下を確認する必要あり
-                # 左端の場合以外、左側に量子状態ブロックがあるかチェック
-                if x != 0:
-                    square_l = self.get_square(x - 1, y)
-                    if square_l.get_label() in opperand_labels:
-                        opperands.append(square_l)
-                # 右端の場合以外、右側に量子状態ブロックがあるかチェック
-                if x != FIELD_WIDTH - 1:
-                    square_r = self.get_square(x + 1, y)
-                    if square_r.get_label() in opperand_labels:
-                        opperands.append(square_r)
-                # 上端の場合以外、上側に量子状態ブロックがあるかチェック
-                if y != 0:
-                    square_down = self.get_square(x, y - 1)
-                    if square_down.get_label() in opperand_labels:
-                        opperands.append(square_down)
-                # 下端の場合以外、下側に量子状態ブロックがあるかチェック
-                if y != FIELD_HEIGHT - 1:
-                    square_up = self.get_square(x, y + 1)
-                    if square_up.get_label() in opperand_labels:
-                        opperands.append(square_up)
-                operator_target_dict[square] = opperands
-
-        return operator_target_dict
+        return self.analyze().operator_targets
 
     def operate_all_gates(self):
         "ゲート処理を実行"
@@ -528,8 +707,8 @@ class TetrisField:
 
 # テトリスのブロックのクラス
 class TetrisBlock:
-    def __init__(self):
-        "テトリスのブロックを作成"
+    def __init__(self, field_width=FIELD_WIDTH):
+        "幅field_widthのフィールドの中央上端に出現するテトリスのブロックを作成"
 
         # ブロックを構成する正方形のリスト
         self.squares = []
@@ -562,66 +741,66 @@ class TetrisBlock:
         if block_type == 1:
             # 縦棒を生成
             cords = [
-                [FIELD_WIDTH / 2, 0],
-                [FIELD_WIDTH / 2, 1],
-                [FIELD_WIDTH / 2, 2],
-                [FIELD_WIDTH / 2, 3],
+                [field_width / 2, 0],
+                [field_width / 2, 1],
+                [field_width / 2, 2],
+                [field_width / 2, 3],
             ]
         elif block_type == 2:
             # 正方形を生成
             cords = [
-                [FIELD_WIDTH / 2, 0],
-                [FIELD_WIDTH / 2, 1],
-                [FIELD_WIDTH / 2 - 1, 0],
-                [FIELD_WIDTH / 2 - 1, 1],
+                [field_width / 2, 0],
+                [field_width / 2, 1],
+                [field_width / 2 - 1, 0],
+                [field_width / 2 - 1, 1],
             ]
         elif block_type == 3:
             #  縦棒+右 を生成
             cords = [
-                [FIELD_WIDTH / 2 - 1, 0],
-                [FIELD_WIDTH / 2, 0],
-                [FIELD_WIDTH / 2, 1],
-                [FIELD_WIDTH / 2, 2],
+                [field_width / 2 - 1, 0],
+                [field_width / 2, 0],
+                [field_width / 2, 1],
+                [field_width / 2, 2],
             ]
         elif block_type == 4:
             # 縦棒+左を生成
             cords = [
-                [FIELD_WIDTH / 2, 0],
-                [FIELD_WIDTH / 2 - 1, 0],
-                [FIELD_WIDTH / 2 - 1, 1],
-                [FIELD_WIDTH / 2 - 1, 2],
+                [field_width / 2, 0],
+                [field_width / 2 - 1, 0],
+                [field_width / 2 - 1, 1],
+                [field_width / 2 - 1, 2],
             ]
         elif block_type == 5:
             # 横棒を生成
             cords = [
-                [FIELD_WIDTH / 2 - 1, 0],
-                [FIELD_WIDTH / 2, 0],
-                [FIELD_WIDTH / 2 + 1, 0],
-                [FIELD_WIDTH / 2 + 2, 0],
+                [field_width / 2 - 1, 0],
+                [field_width / 2, 0],
+                [field_width / 2 + 1, 0],
+                [field_width / 2 + 2, 0],
             ]
         elif block_type == 6:
             # 正方形を生成
             cords = [
-                [FIELD_WIDTH / 2, 0],
-                [FIELD_WIDTH / 2, 1],
-                [FIELD_WIDTH / 2 - 1, 0],
-                [FIELD_WIDTH / 2 - 1, 1],
+                [field_width / 2, 0],
+                [field_width / 2, 1],
+                [field_width / 2 - 1, 0],
+                [field_width / 2 - 1, 1],
             ]
         elif block_type == 7:
             #  横棒+右 を生成
             cords = [
-                [FIELD_WIDTH / 2 - 1, 0],
-                [FIELD_WIDTH / 2, 0],
-                [FIELD_WIDTH / 2 + 1, 0],
-                [FIELD_WIDTH / 2 + 1, 1],
+                [field_width / 2 - 1, 0],
+                [field_width / 2, 0],
+                [field_width / 2 + 1, 0],
+                [field_width / 2 + 1, 1],
             ]
         elif block_type == 8:
             # 縦棒+左を生成
             cords = [
-                [FIELD_WIDTH / 2 - 1, 0],
-                [FIELD_WIDTH / 2, 0],
-                [FIELD_WIDTH / 2 + 1, 0],
-                [FIELD_WIDTH / 2 - 1, 1],
+                [field_width / 2 - 1, 0],
+                [field_width / 2, 0],
+                [field_width / 2 + 1, 0],
+                [field_width / 2 - 1, 1],
             ]
 
         # 決定した色と座標の正方形を作成してリストに追加
@@ -647,23 +826,37 @@ class TetrisBlock:
 
 # テトリスゲームを制御するクラス
 class TetrisGame:
-    def __init__(self, master):
-        "テトリスのインスタンス作成"
+    def __init__(
+        self,
+        master,
+        width=FIELD_WIDTH,
+        height=FIELD_HEIGHT,
+        cluster_thold=CLUSTER_THOLD,
+        block_size=BLOCK_SIZE,
+    ):
+        "幅width, 高さheightのフィールドでテトリスのインスタンス作成"
+
+        check_field_config(width, height, cluster_thold)
+        # フィールドの大きさとルール (startで作り直すフィールドにも使う)
+        self.field_config = (width, height, cluster_thold)
 
         # ブロック管理リストを初期化
-        self.field = TetrisField()
+        self.field = TetrisField(*self.field_config)
 
         # 落下ブロックをセット
         self.block = None
 
         # テトリス画面をセット
-        self.canvas = TetrisCanvas(master, self.field)
+        self.canvas = TetrisCanvas(master, self.field, block_size)
 
         # テトリス画面アップデート
         self.canvas.update(self.field, self.block)
 
         self.cnt_tmp = 0
 
+        # 各手の開始時 (ブロックの出現時) のフィールドとブロック
+        self.history = deque(maxlen=UNDO_LIMIT + 1)
+
     def start(self, func):
         "テトリスを開始"
 
@@ -671,7 +864,8 @@ class TetrisGame:
         self.end_func = func
 
         # ブロック管理リストを初期化
-        self.field = TetrisField()
+        self.field = TetrisField(*self.field_config)
+        self.history.clear()
 
         # 落下ブロックを新規追加
         self.new_block()
@@ -680,15 +874,31 @@ class TetrisGame:
         "ブロックを新規追加"
 
         # 落下中のブロックインスタンスを作成
-        self.block = TetrisBlock()
+        self.block = TetrisBlock(self.field.get_width())
 
         if self.field.judge_game_over(self.block):
             self.end_func()
             print("GAMEOVER")
+        else:
+            # 取り消し用に、この手の開始時の状態を保存
+            self.history.append((self.field.freeze(), copy.deepcopy(self.block)))
 
         # テトリス画面をアップデート
         self.canvas.update(self.field, self.block)
 
+    def undo(self):
+        "1手前 (前のブロックの出現時) の状態に戻す"
+
+        # 連鎖反応の処理中は戻さない
+        if self.block is None or len(self.history) < 2:
+            return False
+        self.history.pop()
+        frozen, block = self.history[-1]
+        self.field.restore(frozen)
+        self.block = copy.deepcopy(block)
+        self.canvas.update(self.field, self.block)
+        return True
+
     def move_block(self, direction):
         "ブロックを移動"
 
@@ -724,7 +934,9 @@ class TetrisGame:
 
 # イベントを受け付けてそのイベントに応じてテトリスを制御するクラス
 class EventHandller:
-    def __init__(self, master, game):
+    def __init__(self, master, game, profiler=None):
+        """profiler: 各段階の時間を計測するtetris_profile.FrameProfiler
+        (キー入力とタイマーのイベント1回を1フレームとして数える)"""
         self.master = master
 
         # 制御するゲーム
@@ -733,9 +945,16 @@ class EventHandller:
         # イベントを定期的に発行するタイマー
         self.timer = None
 
+        # 計測 (指定がなければ何もしない)
+        self.profiler = null_profiler if profiler is None else profiler
+        self.idle_start = None
+        if self.profiler.enabled:
+            game.canvas.update = self.profiler.wrap("draw", game.canvas.update)
+
         # ゲームスタートボタンを設置
         button = tk.Button(master, text="START", command=self.start_event)
-        button.place(x=25 + BLOCK_SIZE * FIELD_WIDTH + 25, y=30)
+        canvas_width = game.canvas.block_size * game.field.get_width()
+        button.place(x=25 + canvas_width + 25, y=30)
 
     def start_event(self):
         "ゲームスタートボタンを押された時の処理"
@@ -744,6 +963,9 @@ class EventHandller:
         self.game.start(self.end_event)
         self.running = True
 
+        # 作り直したフィールドのメソッドを計測
+        self.profiler.instrument(self.game.field, field_phases)
+
         # タイマーセット
         self.timer_start()
 
@@ -751,6 +973,7 @@ class EventHandller:
         self.master.bind("<Left>", self.left_key_event)
         self.master.bind("<Right>", self.right_key_event)
         self.master.bind("<Down>", self.down_key_event)
+        self.master.bind("u", self.undo_key_event)
 
     def end_event(self):
         "ゲーム終了時の処理"
@@ -761,6 +984,7 @@ class EventHandller:
         self.master.unbind("<Left>")
         self.master.unbind("<Right>")
         self.master.unbind("<Down>")
+        self.master.unbind("u")
 
     def timer_end(self):
         "タイマーを終了"
@@ -780,23 +1004,47 @@ class EventHandller:
             # タイマーを開始
             self.timer = self.master.after(wait_time, self.timer_event)
 
+    def begin_frame(self):
+        "イベントの処理を1フレームとして計測を開始 (前のイベントからの時間はidle)"
+        profiler = self.profiler
+        if not profiler.enabled:
+            return
+        now = profiler.clock()
+        if self.idle_start is not None:
+            profiler.record("idle", self.idle_start, now - self.idle_start)
+        profiler.begin_frame()
+
+    def end_frame(self):
+        "イベントの処理の終了 (次のイベントまではidle)"
+        if self.profiler.enabled:
+            self.idle_start = self.profiler.clock()
+
     def left_key_event(self, event):
         "左キー入力受付時の処理"
 
         # ブロックを左に動かす
-        self.game.move_block(MOVE_LEFT)
+        self.begin_frame()
+        with self.profiler.span("input"):
+            self.game.move_block(MOVE_LEFT)
+        self.end_frame()
 
     def right_key_event(self, event):
         "右キー入力受付時の処理"
 
         # ブロックを右に動かす
-        self.game.move_block(MOVE_RIGHT)
+        self.begin_frame()
+        with self.profiler.span("input"):
+            self.game.move_block(MOVE_RIGHT)
+        self.end_frame()
 
     def down_key_event(self, event):
         "下キー入力受付時の処理"
 
         # ブロックを下に動かす
-        self.game.move_block(MOVE_DOWN)
+        self.begin_frame()
+        with self.profiler.span("drop"):
+            self.game.move_block(MOVE_DOWN)
+        self.end_frame()
         # 落下タイマーを再スタート
         self.timer_start()
         # if (
@@ -810,31 +1058,51 @@ class EventHandller:
         #     self.game.canvas.update(self.game.field, None)
         #     self.game.cnt_tmp += 1
 
+    def undo_key_event(self, event):
+        "uキー入力受付時の処理"
+
+        # 1手前に戻し、落下タイマーを再スタート
+        self.begin_frame()
+        with self.profiler.span("input"):
+            undone = self.game.undo()
+        self.end_frame()
+        if undone:
+            self.timer_start()
+
     def update_screen(self, event):
         "画面更新のパターンを判定"
 
+        self.begin_frame()
+        self.timer_start(self.advance())
+        self.end_frame()
+
+    def advance(self):
+        "落下か連鎖反応を1段階進め、次の画面更新までの時間msを出力"
+        span = self.profiler.span
+
         # ブロック落下中の処理
         if self.game.block is not None:
-            self.game.move_block(MOVE_DOWN)
-            self.timer_start()
-
-        # ブロック落下後の処理
-        elif self.game.field.judge_can_fall():
-            self.game.field.down_after_fix()
-            self.game.canvas.update(self.game.field, None)
-            self.timer_start(500)
-        # ゲートブロックの存在を確認
-        elif self.game.field.gate_exist():
-            self.game.field.operate_all_gates()
-            self.game.canvas.update(self.game.field, None)
-            self.timer_start(500)
-        elif self.game.field.exist_deletale():
-            self.game.field.delete_same_step()
-            self.game.canvas.update(self.game.field, None)
-            self.timer_start(500)
-        else:
-            self.game.new_block()
-            self.timer_start(200)
+            with span("drop"):
+                self.game.move_block(MOVE_DOWN)
+            return 1000
+
+        with span("cascade"):
+            # フィールドの状態を1回だけ調べ、以下の判定と処理で共有する
+            report = self.game.field.analyze()
+
+            # ブロック落下後の処理
+            if report.fall_columns:
+                self.game.field.down_after_fix()
+            # ゲートブロックの存在を確認
+            elif report.operator_targets:
+                self.game.field.operate_all_gates()
+            elif report.deletable:
+                self.game.field.delete_same_step()
+            else:
+                self.game.new_block()
+                return 200
+        self.game.canvas.update(self.game.field, None)
+        return 500
         # if (self.game.block is not None) and self.game.field.judge_can_move(
         #     self.game.block, MOVE_DOWN
         # ):
@@ -850,28 +1118,63 @@ class EventHandller:
         self.update_screen(None)
 
 
+def fit_block_size(width, height):
+    "幅width, 高さheightのフィールドがMAX_CANVAS_SIZEに収まるブロックのサイズpx"
+    max_width, max_height = MAX_CANVAS_SIZE
+    return max(1, min(BLOCK_SIZE, max_width // width, max_height // height))
+
+
 class Application(tk.Tk):
-    def __init__(self):
+    def __init__(
+        self,
+        width=FIELD_WIDTH,
+        height=FIELD_HEIGHT,
+        cluster_thold=CLUSTER_THOLD,
+        profiler=None,
+    ):
         super().__init__()
 
-        # アプリウィンドウの設定
-        self.geometry("400x600")
+        # アプリウィンドウの設定 (キャンバスの右にボタン、下に余白)
+        block_size = fit_block_size(width, height)
+        self.geometry("%dx%d" % (width * block_size + 150, height * block_size + 100))
         self.title("テトリス")
 
         # テトリス生成
-        game = TetrisGame(self)
+        game = TetrisGame(self, width, height, cluster_thold, block_size)
 
         # イベントハンドラー生成
-        EventHandller(self, game)
+        EventHandller(self, game, profiler)
 
 
 def main():
     "main関数"
 
+    parser = argparse.ArgumentParser(description="quantum tetris (Tk)")
+    parser.add_argument("--width", type=int, default=FIELD_WIDTH)
+    parser.add_argument("--height", type=int, default=FIELD_HEIGHT)
+    parser.add_argument("--cluster-thold", type=int, default=CLUSTER_THOLD)
+    parser.add_argument(
+        "--profile", action="store_true", help="print frame timings on exit"
+    )
+    parser.add_argument("--trace", help="write a Chrome trace of the frames on exit")
+    args = parser.parse_args()
+    try:
+        check_field_config(args.width, args.height, args.cluster_thold)
+    except ValueError as e:
+        parser.error(str(e))
+
+    profiler = None
+    if args.profile or args.trace is not None:
+        profiler = FrameProfiler(args.trace)
+
     # GUIアプリ生成
-    app = Application()
+    app = Application(args.width, args.height, args.cluster_thold, profiler)
     app.mainloop()
 
+    if profiler is not None:
+        profiler.finish()
+        print("\n".join(profiler.report()), file=sys.stderr)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Placement search bot for quantum tetris
+#
+# PlacementBot enumerates every rotation and x offset of the current stone
+# and of next_stone, resolves the chain reaction for each placement and
+# keeps the best one according to a pluggable heuristic.
+# Many placements lead to the same board, so resolved cascades are memoized
+# in a bounded LRU transposition table keyed by a Zobrist hash. The hash of
+# a placement is derived incrementally from the hash of the board it was
+# dropped on.
+#
+# The bot is an agent for tetris_selfplay (agent_factory(seed)). It works on
+# the list boards of tetris_engine.TetrisEngine and on the ndarray boards of
+# tetris_numpy.NumpyTetrisEngine. The cells of the placed stone are passed
+# to the cascade as dirty only when the engine supports incremental
+# detection (engine.incremental).
+
+import random
+import time
+from collections import OrderedDict
+
+from tetris_engine import (
+    board_masks,
+    board_skyline,
+    check_collision,
+    collide_masks,
+    drop_distance,
+    labels_dict,
+    score_cleared,
+    stone_rotations,
+)
+
+
+def zobrist_table(seed, cols, rows):
+    "幅cols, 高さrowsのボードのセルの座標とブロックの値ごとの64bit乱数表 (空セルは0)"
+    rng = random.Random(seed)
+    return [
+        [
+            [0] + [rng.getrandbits(64) for v in range(1, len(labels_dict))]
+            for x in range(cols)
+        ]
+        for y in range(rows)
+    ]
+
+
+def placements(board, stone, stone_x):
+    """place_stone(回転回数, x座標)で実現できる全ての配置を列挙
+    (回転回数, x座標, 回転後のストーン, 置いたy座標) を出力"""
+    bitboard = board_masks(board)
+    skyline = board_skyline(board)
+    seen = []
+    for rotation, (shape, masks, bottoms) in enumerate(stone_rotations(stone)):
+        # 落下開始位置で回転できなければ、それ以上回転しても同じ配置
+        if rotation > 0 and collide_masks(bitboard, masks, (stone_x, 0)):
+            break
+        if shape in seen:
+            continue
+        seen.append(shape)
+        for x in range(len(board[0]) - len(shape[0]) + 1):
+            if collide_masks(bitboard, masks, (x, 0)):
+                continue
+            y = drop_distance(skyline, bottoms, (x, 0))
+            if y is None:
+                y = 0
+                while not collide_masks(bitboard, masks, (x, y + 1)):
+                    y += 1
+            yield rotation, x, shape, y
+
+
+def default_heuristic(board, chain, points):
+    "得点と連鎖数を重視し、積み上がった高さを減点、隣接した同一ブロックを加点"
+    rows = len(board) - 1
+    cols = len(board[0])
+    height = 0
+    pairs = 0
+    for y in range(rows):
+        row = board[y]
+        if height == 0 and any(row):
+            height = rows - y
+        for x in range(cols):
+            val = row[x]
+            if val == 0:
+                continue
+            if x != cols - 1 and row[x + 1] == val:
+                pairs += 1
+            if y != rows - 1 and board[y + 1][x] == val:
+                pairs += 1
+    return points + 5 * chain - 2 * height + 0.5 * pairs
+
+
+class PlacementBot(object):
+    def __init__(self, seed=0, heuristic=default_heuristic, table_size=100000):
+        "seedはZobristの乱数表に使用 (同じseedなら同じ探索結果)"
+        self.heuristic = heuristic
+        self.table_size = table_size
+        self.seed = seed
+        # 乱数表は最初に探索するエンジンの設定 (TetrisConfig) の大きさで作成する
+        self.config = None
+        self.zobrist = None
+        # 連鎖前のハッシュ -> (連鎖後のボード, 連鎖数, 削除数, 連鎖後のハッシュ)
+        # 得点はレベルに依存するため、削除数から取り出し時に計算する
+        self.table = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.nodes = 0
+        self.search_time = 0.0
+
+    def prepare(self, engine):
+        "エンジンの盤面の大きさの乱数表を用意 (設定が変われば置換表も作り直す)"
+        if engine.config != self.config:
+            self.config = engine.config
+            self.zobrist = zobrist_table(self.seed, engine.cols, engine.rows)
+            self.table.clear()
+
+    def board_hash(self, board):
+        "ボード全体のハッシュを計算"
+        h = 0
+        for y in range(len(self.zobrist)):
+            for x, val in enumerate(board[y]):
+                if val:
+                    h ^= self.zobrist[y][x][val]
+        return h
+
+    def join(self, board, h, shape, x, y):
+        """ストーンを置いたボードのコピーと、差分から求めたハッシュ、
+        ストーンを置いたセルの座標setを出力"""
+        if isinstance(board, list):
+            board = [row[:] for row in board]
+        else:
+            board = board.copy()
+        cells = set()
+        for cy, row in enumerate(shape):
+            for cx, val in enumerate(row):
+                if val:
+                    board[y + cy][x + cx] = val
+                    h ^= self.zobrist[y + cy][x + cx][val]
+                    cells.add((x + cx, y + cy))
+        return board, h, cells
+
+    def resolve(self, engine, board, h, cells=None):
+        """連鎖を最後まで進めた結果を置換表から取得 (なければ計算して登録)
+        cellsには連鎖が止まったボードにストーンを置いたセルを渡す
+        (差分判定に対応したエンジンでのみ使用)
+        (連鎖後のボード, 連鎖数, 得点, 連鎖後のハッシュ) を出力"""
+        entry = self.table.get(h)
+        if entry is not None:
+            self.hits += 1
+            self.table.move_to_end(h)
+        else:
+            self.misses += 1
+            dirty = cells if engine.incremental else None
+            result = engine.resolve_cascade(board, dirty=dirty)
+            entry = (
+                result.board,
+                result.chain,
+                result.cleared,
+                self.board_hash(result.board),
+            )
+            self.table[h] = entry
+            if len(self.table) > self.table_size:
+                self.table.popitem(last=False)
+        board, chain, cleared, h = entry
+        points = score_cleared(cleared, engine.level, engine.lines)[0]
+        return board, chain, points, h
+
+    def evaluate_next(self, engine, board, h, chain, points):
+        "next_stoneの全配置のうち最良の評価値"
+        best = None
+        next_x = int(engine.cols / 2 - len(engine.next_stone[0]) / 2)
+        for rotation, x, shape, y in placements(board, engine.next_stone, next_x):
+            self.nodes += 1
+            board2, h2, cells = self.join(board, h, shape, x, y)
+            board2, chain2, points2, h2 = self.resolve(engine, board2, h2, cells)
+            value = self.heuristic(board2, max(chain, chain2), points + points2)
+            if best is None or value > best:
+                best = value
+        return float("-inf") if best is None else best
+
+    def choose(self, engine):
+        "現在のストーンの最良の配置を (回転回数, x座標) で出力"
+        start = time.perf_counter()
+        self.prepare(engine)
+        base = self.board_hash(engine.board)
+        next_x = int(engine.cols / 2 - len(engine.next_stone[0]) / 2)
+        best = None
+        best_move = (0, engine.stone_x)
+        for rotation, x, shape, y in placements(
+            engine.board, engine.stone, engine.stone_x
+        ):
+            self.nodes += 1
+            board, h, cells = self.join(engine.board, base, shape, x, y)
+            # 次のストーンは連鎖前のボードで出現判定される
+            if check_collision(board, engine.next_stone, (next_x, 0)):
+                value = float("-inf")
+            else:
+                board, chain, points, h = self.resolve(engine, board, h, cells)
+                value = self.evaluate_next(engine, board, h, chain, points)
+            if best is None or value > best:
+                best = value
+                best_move = (rotation, x)
+        self.search_time += time.perf_counter() - start
+        return best_move
+
+    def __call__(self, engine):
+        return self.choose(engine)
+
+    def stats(self):
+        "置換表のヒット率と探索速度"
+        lookups = self.hits + self.misses
+        return {
+            "nodes": self.nodes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "nodes_per_sec": self.nodes / self.search_time if self.search_time else 0.0,
+            "table_entries": len(self.table),
+        }
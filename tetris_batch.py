@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Batched quantum tetris simulator
+#
+# BatchTetrisEngine advances N independent games in lockstep. All boards
+# live in one (N, rows + 1, cols) array and every phase (drop, settle,
+# gates, clusters) is applied to all boards at once with the vectorized
+# functions of tetris_numpy. Boards whose cascade or game has finished are
+# masked out.
+#
+# One placement is the same as calling, on a TetrisEngine,
+#   place_stone(r, x)  (rotate_stone() r times, move, insta_drop, resolve_board)
+# and gives the same board, score, level and chain cell for cell.
+#
+# Requires numpy (pip install numpy).
+
+import numpy as np
+
+from tetris_engine import TetrisConfig, default_config, shape_rotations, tetris_shapes
+from tetris_numpy import (
+    board_dtype,
+    can_settle,
+    cluster_mask,
+    gate_masks,
+    new_board_array,
+    operate_all_gates,
+    settle_board,
+)
+
+# ストーンを構成するセルの数 (全ての形で4個)
+n_cells = 4
+n_rotations = 4
+
+
+def shape_tables():
+    """全ての形と回転について、各セルの相対座標と幅の表を作成
+    セルは回転前の形の行優先の順番で並べる (tetris_engine.shape_rotationsと同じ)
+    (dy, dx: (形, 回転, セル), width: (形, 回転))"""
+    dy = np.zeros((len(tetris_shapes), n_rotations, n_cells), dtype=np.int64)
+    dx = np.zeros_like(dy)
+    width = np.zeros((len(tetris_shapes), n_rotations), dtype=np.int64)
+    for s, table in enumerate(shape_rotations):
+        for r, rotation in enumerate(table):
+            dy[s, r], dx[s, r] = np.array(rotation.cells).T
+            width[s, r] = rotation.width
+    return dy, dx, width
+
+
+shape_dy, shape_dx, shape_width = shape_tables()
+
+
+def stone_matrix(shape_id, values):
+    "形と各セルの値からTetrisEngineのストーン(入れ子リスト)を作成"
+    it = iter(int(v) for v in values)
+    return [
+        [next(it) if cell else 0 for cell in row] for row in tetris_shapes[shape_id]
+    ]
+
+
+def score_cleared(n, level, lines):
+    "tetris_engine.score_cleared のボードごとのベクトル版"
+    points = np.zeros_like(n)
+    n = n.copy()
+    level = level.copy()
+    lines = lines.copy()
+    while (n > 0).any():
+        # 次のレベルアップまでに削除する個数ずつまとめて加算
+        k = np.minimum(n, level * 6 - lines)
+        points += k * level
+        lines += k
+        n -= k
+        level += lines >= level * 6
+    return points, level, lines
+
+
+class BatchTetrisEngine(object):
+    def __init__(
+        self,
+        n,
+        seed=None,
+        threthold=None,
+        shape_weights=None,
+        value_weights=None,
+        config=default_config,
+    ):
+        """n個のゲームを同時に初期化
+        threthold: クラスターとして消える最小の個数 (省略時はconfigのcluster_thold)
+        shape_weights: tetris_shapesの各形の出現比率
+        value_weights: ブロックの値1-7 (量子状態とゲート) の出現比率
+        config: 全てのゲームに共通の盤面の大きさとルール (tetris_engine.TetrisConfig)"""
+        self.n = n
+        self.rng = np.random.default_rng(seed)
+        self.config = config = TetrisConfig(*config)
+        self.cols, self.rows = config.cols, config.rows
+        self.threthold = config.cluster_thold if threthold is None else threthold
+        self.shape_p = self.normalize(shape_weights, len(tetris_shapes))
+        self.value_p = self.normalize(value_weights, len(tetris_shapes))
+
+        self.boards = np.repeat(new_board_array(self.cols, self.rows)[None], n, axis=0)
+        self.score = np.zeros(n, dtype=np.int64)
+        self.level = np.ones(n, dtype=np.int64)
+        self.lines = np.zeros(n, dtype=np.int64)
+        self.chain = np.zeros(n, dtype=np.int64)
+        self.max_chain = np.zeros(n, dtype=np.int64)
+        self.gameover = np.zeros(n, dtype=bool)
+        self.board_updating = np.zeros(n, dtype=bool)
+        self.placed = np.zeros(n, dtype=np.int64)
+
+        self.stone_shape = np.zeros(n, dtype=np.int64)
+        self.stone_values = np.zeros((n, n_cells), dtype=board_dtype)
+        self.stone_x = np.zeros(n, dtype=np.int64)
+        self.next_shape, self.next_values = self.random_stones(n)
+        self.new_stones(np.arange(n))
+
+    @staticmethod
+    def normalize(weights, size):
+        if weights is None:
+            return None
+        weights = np.asarray(weights, dtype=float)
+        if weights.shape != (size,):
+            raise ValueError("expected %d weights, got %r" % (size, weights.shape))
+        return weights / weights.sum()
+
+    def random_stones(self, m):
+        "m個のストーンの形と各セルの値を生成"
+        shapes = self.rng.choice(len(tetris_shapes), size=m, p=self.shape_p)
+        values = self.rng.choice(
+            len(tetris_shapes), size=(m, n_cells), p=self.value_p
+        ).astype(board_dtype)
+        return shapes, values + 1
+
+    def collides(self, idx, shape, rot, x, y):
+        "ボードidxの位置(x, y)に置いたストーンが衝突するか (壁の外も衝突)"
+        ys = y[:, None] + shape_dy[shape, rot]
+        xs = x[:, None] + shape_dx[shape, rot]
+        outside = xs >= self.cols
+        cells = self.boards[idx[:, None], ys, np.minimum(xs, self.cols - 1)]
+        return (outside | (cells != 0)).any(axis=1)
+
+    def new_stones(self, idx):
+        "ボードidxで次のストーンを落下開始位置に出し、置けなければゲームオーバー"
+        self.stone_shape[idx] = self.next_shape[idx]
+        self.stone_values[idx] = self.next_values[idx]
+        self.next_shape[idx], self.next_values[idx] = self.random_stones(len(idx))
+        shape = self.stone_shape[idx]
+        self.stone_x[idx] = (self.cols / 2 - shape_width[shape, 0] / 2).astype(np.int64)
+        zeros = np.zeros(len(idx), dtype=np.int64)
+        self.gameover[idx] |= self.collides(idx, shape, zeros, self.stone_x[idx], zeros)
+
+    def place(self, rotations, xs):
+        """全ての続行中のゲームでストーンを回転・移動してから一気に落とす
+        rotations: 時計回りの回転回数, xs: 移動先のx座標 (どちらも長さnの配列)
+        置いたボードのインデックスを出力"""
+        idx = np.flatnonzero(~self.gameover & ~self.board_updating)
+        if len(idx) == 0:
+            return idx
+        shape = self.stone_shape[idx]
+        x = self.stone_x[idx]
+        y = np.zeros(len(idx), dtype=np.int64)
+
+        # rotate_stone()と同様に、衝突する回転は行わない
+        rot = np.zeros(len(idx), dtype=np.int64)
+        want = np.asarray(rotations, dtype=np.int64)[idx]
+        for r in range(1, n_rotations):
+            trying = (want >= r) & (rot == r - 1)
+            trying[trying] = ~self.collides(
+                idx[trying], shape[trying], rot[trying] + 1, x[trying], y[trying]
+            )
+            rot[trying] = r
+
+        # move()と同様に、壁の内側に収めて衝突しなければ移動
+        new_x = np.clip(np.asarray(xs, dtype=np.int64)[idx], 0, None)
+        new_x = np.minimum(new_x, self.cols - shape_width[shape, rot])
+        movable = ~self.collides(idx, shape, rot, new_x, y)
+        x[movable] = new_x[movable]
+
+        # 各列で指定した行以下にある最初のブロックの行 (床があるので必ず見つかる)
+        occupied = self.boards[idx] != 0
+        rows = self.rows
+        row_index = np.where(occupied, np.arange(rows + 1)[None, :, None], rows + 1)
+        below = np.minimum.accumulate(row_index[:, ::-1], axis=1)[:, ::-1]
+        dy = shape_dy[shape, rot]
+        dx = shape_dx[shape, rot]
+        hit_y = below[np.arange(len(idx))[:, None], dy + 1, x[:, None] + dx] - dy
+        # insta_drop()と同様に、衝突した1段上に置き、落とした段数を得点に加算
+        land_y = hit_y.min(axis=1)
+        self.score[idx] += land_y
+        self.boards[idx[:, None], land_y[:, None] - 1 + dy, x[:, None] + dx] = (
+            self.stone_values[idx]
+        )
+
+        self.new_stones(idx)
+        self.placed[idx] += 1
+        self.chain[idx] = 0
+        self.board_updating[idx] = True
+        return idx
+
+    def cascade_step(self):
+        """連鎖中の全ボードを1段階ずつ進める
+        各ボードは落下、ゲート、クラスター削除のうち最初に該当する処理を行う
+        連鎖中のボードが残っているかを出力"""
+        idx = np.flatnonzero(self.board_updating)
+        if len(idx) == 0:
+            return False
+
+        # ブロック落下の処理
+        settle = can_settle(self.boards[idx])
+        settle_idx = idx[settle]
+        self.boards[settle_idx] = settle_board(self.boards[settle_idx])
+
+        # ゲートブロックの処理
+        idx = idx[~settle]
+        boards = self.boards[idx]
+        active, hits = gate_masks(boards)
+        gate = active.any(axis=(-2, -1))
+        self.boards[idx[gate]] = operate_all_gates(
+            boards[gate], (active[gate], hits[gate])
+        )
+
+        # クラスターの削除
+        idx = idx[~gate]
+        boards = self.boards[idx]
+        mask = cluster_mask(boards, self.threthold)
+        cleared = mask.sum(axis=(-2, -1))
+        boards[:, :-1, :][mask] = 0
+        self.boards[idx] = boards
+        points, self.level[idx], self.lines[idx] = score_cleared(
+            cleared, self.level[idx], self.lines[idx]
+        )
+        self.score[idx] += points
+        chained = idx[cleared > 0]
+        self.chain[chained] += 1
+        self.max_chain[chained] = np.maximum(
+            self.max_chain[chained], self.chain[chained]
+        )
+
+        # 何も起きなかったボードは連鎖終了
+        self.board_updating[idx[cleared == 0]] = False
+        return bool(self.board_updating.any())
+
+    def resolve(self):
+        "全てのボードの連鎖が終わるまで進め、段階数を出力"
+        steps = 0
+        while self.cascade_step():
+            steps += 1
+        return steps
+
+    def step(self, rotations, xs):
+        "ストーンを置いて連鎖を最後まで進める"
+        idx = self.place(rotations, xs)
+        self.resolve()
+        return idx
+
+    def random_actions(self):
+        "ランダムな回転回数と移動先"
+        rotations = self.rng.integers(0, n_rotations, size=self.n)
+        xs = self.rng.integers(0, self.cols, size=self.n)
+        return rotations, xs
+
+    def play_random(self, max_stones=None):
+        "全てのゲームが終わるまで (またはmax_stones個まで) ランダムに置く"
+        while not self.gameover.all():
+            if (
+                max_stones is not None
+                and self.placed[~self.gameover].min() >= max_stones
+            ):
+                break
+            self.step(*self.random_actions())
+        return self.score
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Benchmarks for the rules hot paths
+#
+# Times find_cluster, settle_board, operate_all_gates, check_collision
+# and a full cascade step of tetris_engine.TetrisEngine, plus the
+# TetrisField methods of the Tk version (tetris.py, skipped when tkinter
+# is missing). Each operation runs on seeded boards at several sizes:
+#
+#   random   random values, about 60% filled, with floating blocks
+#   cluster  the whole board is one cluster of "0"
+#   checker  "0" and "1" in a checkerboard (no clusters, every cell checked)
+#   gates    gate rows over state rows (every gate has a target)
+#
+# For every (operation, board, size) it reports ops/sec, p50/p90/p99 of
+# the time per call and the bytes allocated per call (tracemalloc peak).
+# Results can be saved as a JSON baseline and compared against later:
+#
+#   python tetris_bench.py --sizes 10x22,40x88 --save baseline.json
+#   python tetris_bench.py --sizes 10x22,40x88 --compare baseline.json
+#
+# --compare exits with status 1 when an entry is slower than the baseline
+# by more than --threshold (ops/sec, default 20%).
+
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+import tracemalloc
+
+from tetris_engine import (
+    TetrisConfig,
+    TetrisEngine,
+    check_collision,
+    cluster_thold,
+    labels_dict,
+    tetris_shapes,
+)
+from tetris_stats import percentile
+
+board_kinds = ["random", "cluster", "checker", "gates"]
+default_sizes = [(10, 22), (20, 44), (40, 88)]
+
+# 1回の計測の目安時間(s)と、時間を測る1まとまりの目安時間(s)
+min_time = 0.2
+sample_time = 0.0005
+
+
+def tk_module():
+    "Tk版のモジュール (tkinterがなければNone)"
+    try:
+        import tetris
+    except ImportError:
+        return None
+    return tetris
+
+
+def make_board(kind, cols, rows, seed=0):
+    "床を含む(rows + 1)行cols列のボード (値はtetris_engine.labels_dict)"
+    rng = random.Random("%s-%d-%d-%d" % (kind, cols, rows, seed))
+    board = [[0] * cols for y in range(rows)]
+    for y in range(1, rows):
+        for x in range(cols):
+            if kind == "random":
+                if rng.random() < 0.6:
+                    board[y][x] = rng.randrange(1, len(tetris_shapes) + 1)
+            elif kind == "cluster":
+                board[y][x] = 1
+            elif kind == "checker":
+                board[y][x] = 1 + (x + y) % 2
+            elif kind == "gates":
+                # 下から量子状態、ゲートの順に交互に積む
+                if (rows - y) % 2:
+                    board[y][x] = rng.randrange(1, 5)
+                else:
+                    board[y][x] = rng.randrange(5, 8)
+    return board + [[1] * cols]
+
+
+def measure(setup, op):
+    """setup()で作成した引数でop(*args)を繰り返し呼んで計測
+    (引数の作成は計測に含めない。opが引数を変更しても毎回作り直す)"""
+    # 1まとまりの呼び出し回数を、sample_time程度になるように決める
+    batch = 1
+    while True:
+        args = [setup() for _ in range(batch)]
+        start = time.perf_counter()
+        for a in args:
+            op(*a)
+        if time.perf_counter() - start >= sample_time or batch >= 1 << 16:
+            break
+        batch *= 2
+    samples = []
+    total = 0.0
+    calls = 0
+    while total < min_time or len(samples) < 5:
+        args = [setup() for _ in range(batch)]
+        start = time.perf_counter()
+        for a in args:
+            op(*a)
+        elapsed = time.perf_counter() - start
+        samples.append(elapsed / batch)
+        total += elapsed
+        calls += batch
+    samples.sort()
+    # 1回の呼び出しで確保するメモリ (tracemalloc実行中の最大値)
+    args = setup()
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    op(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "ops_per_sec": calls / total,
+        "p50_us": percentile(samples, 0.5) * 1e6,
+        "p90_us": percentile(samples, 0.9) * 1e6,
+        "p99_us": percentile(samples, 0.99) * 1e6,
+        "alloc_bytes": peak - base,
+    }
+
+
+def engine_benchmarks(kind, cols, rows):
+    "TetrisEngineの(名前, setup, op)のリスト"
+    engine = TetrisEngine(seed=0, config=TetrisConfig(cols, rows, cluster_thold))
+    board = make_board(kind, cols, rows)
+
+    def copy():
+        return ([row[:] for row in board],)
+
+    stone = [[v + 1 for v in row] for row in tetris_shapes[6]]
+    # 全ての列と、盤面の中ほどまでの全ての行に置いて判定
+    offsets = [(x, y) for y in range(0, rows // 2) for x in range(cols - 2)]
+
+    def collisions(board):
+        for offset in offsets:
+            check_collision(board, stone, offset)
+
+    return [
+        ("find_cluster", lambda: (board,), engine.find_cluster),
+        ("settle_board", copy, engine.settle_board),
+        ("operate_all_gates", copy, engine.operate_all_gates),
+        ("check_collision[%d]" % len(offsets), lambda: (board,), collisions),
+        ("cascade_step", copy, engine.full_cascade_step),
+    ]
+
+
+def tk_benchmarks(kind, cols, rows):
+    "Tk版のTetrisFieldの(名前, setup, op)のリスト (tkinterがなければ空)"
+    tk = tk_module()
+    if tk is None:
+        return []
+    board = make_board(kind, cols, rows)[:-1]
+    gate_colors = {"H": "#70B7EB", "X": "#58C698", "Z": "#58C698"}
+    cells = []
+    for y, row in enumerate(board):
+        for x, val in enumerate(row):
+            if val:
+                label = labels_dict[val]
+                color = tk.label_color_dict.get(label) or gate_colors[label]
+                cells.append((y * cols + x, color, label))
+
+    def make_field():
+        field = tk.TetrisField(cols, rows)
+        for cell in cells:
+            field.set_cell(*cell)
+        return (field,)
+
+    fields = make_field()
+    random.seed(0)
+    block = tk.TetrisBlock(cols)
+
+    def analyze(field):
+        # 変更がない場合は前回の結果を返すため、毎回変更扱いにする
+        field.version += 1
+        return field.analyze()
+
+    def moves(field):
+        for direction in (tk.MOVE_LEFT, tk.MOVE_RIGHT, tk.MOVE_DOWN):
+            field.judge_can_move(block, direction)
+
+    return [
+        ("tk.analyze", lambda: fields, analyze),
+        ("tk.down_after_fix", make_field, lambda f: f.down_after_fix()),
+        ("tk.operate_all_gates", make_field, lambda f: f.operate_all_gates()),
+        ("tk.delete_same_step", make_field, lambda f: f.delete_same_step()),
+        ("tk.judge_can_move", lambda: fields, moves),
+    ]
+
+
+def run(sizes, kinds, only=None, out=sys.stdout):
+    "全ての組み合わせを計測し、'名前/盤面/大きさ' -> 結果の辞書を出力"
+    results = {}
+    for cols, rows in sizes:
+        for kind in kinds:
+            benches = engine_benchmarks(kind, cols, rows)
+            benches += tk_benchmarks(kind, cols, rows)
+            for name, setup, op in benches:
+                if only is not None and not any(o in name for o in only):
+                    continue
+                key = "%s/%s/%dx%d" % (name, kind, cols, rows)
+                results[key] = result = measure(setup, op)
+                out.write(
+                    "%-44s %12.0f ops/s  p50 %9.1fus  p99 %9.1fus  %8d B\n"
+                    % (
+                        key,
+                        result["ops_per_sec"],
+                        result["p50_us"],
+                        result["p99_us"],
+                        result["alloc_bytes"],
+                    )
+                )
+    return results
+
+
+def compare(results, baseline, threshold):
+    "ベースラインよりops/secがthresholdの割合以上遅い項目のリスト"
+    slower = []
+    for key, result in results.items():
+        base = baseline.get(key)
+        if base is None:
+            continue
+        ratio = result["ops_per_sec"] / base["ops_per_sec"]
+        if ratio < 1 - threshold:
+            slower.append((key, ratio))
+    return slower
+
+
+def parse_sizes(text):
+    "'10x22,40x88' -> [(10, 22), (40, 88)]"
+    sizes = []
+    for size in text.split(","):
+        cols, rows = size.lower().split("x")
+        sizes.append((int(cols), int(rows)))
+    return sizes
+
+
+def main():
+    global min_time
+    parser = argparse.ArgumentParser(description="quantum tetris rule benchmarks")
+    parser.add_argument(
+        "--sizes",
+        type=parse_sizes,
+        default=default_sizes,
+        help="comma separated COLSxROWS (default 10x22,20x44,40x88)",
+    )
+    parser.add_argument("--boards", default=",".join(board_kinds))
+    parser.add_argument(
+        "--only", default=None, help="comma separated substrings of benchmark names"
+    )
+    parser.add_argument("--min-time", type=float, default=min_time)
+    parser.add_argument("--save", default=None, help="write results as JSON")
+    parser.add_argument("--compare", default=None, help="JSON baseline to compare")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    min_time = args.min_time
+    only = args.only.split(",") if args.only else None
+    results = run(args.sizes, args.boards.split(","), only)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=1,
+                sort_keys=True,
+            )
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        slower = compare(results, baseline, args.threshold)
+        for key, ratio in slower:
+            print("SLOWER %-44s %.0f%% of baseline" % (key, ratio * 100))
+        if slower:
+            sys.exit(1)
+        print("no slowdowns over %.0f%%" % (args.threshold * 100))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Frame capture for the pygame front end
+#
+# FrameCapture takes a copy of the screen (raw RGB bytes) whenever
+# TetrisApp has presented something new. It puts the copy on a bounded
+# queue, and a writer thread encodes it, so a slow disk or encoder never
+# stalls the game loop. When the queue is full, the frame is dropped and
+# the app captures again on its next frame. The writer skips frames that
+# are identical to the previous one. An idle game therefore produces no
+# frames.
+#
+# Frames go to one of two sinks:
+#
+#   RawSink  rgb24 frames back to back, to a file, a named pipe or stdout
+#   PngSink  frame_000000.png, frame_000001.png, ... in a directory
+#
+# The time of every emitted frame (ms since the start) is written as a
+# timestamp file in "timestamp format v2" (one line per frame after the
+# header), so the variable frame rate can be muxed back, for example:
+#
+#   python tetris_replay.py night.qtr --game 0 --headless --capture-raw - \
+#       --capture-timestamps frames.txt \
+#       | ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -r 30 -i - night.mkv
+#   mkvmerge -o clip.mkv --timestamps 0:frames.txt night.mkv
+#
+# (W and H are the window size, printed when the capture starts.)
+#
+# --headless renders on the SDL dummy video driver and advances replays
+# in fixed steps of one frame of game time instead of sleeping, so a
+# recorded game is rendered as fast as the machine allows.
+
+import os
+import queue
+import struct
+import sys
+import threading
+import zlib
+
+import pygame
+
+# キューに保持するフレームの合計バイト数の上限
+capture_queue_bytes = 256 << 20
+# PNGの圧縮レベル (zlib)
+png_compression = 6
+
+
+class CaptureError(RuntimeError):
+    "フレームの書き出しに失敗した"
+
+
+class RawSink(object):
+    "フレームをRGBのバイト列のまま連続してstreamに書き込む"
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write_frame(self, index, data, size):
+        self.stream.write(data)
+
+    def close(self):
+        self.stream.flush()
+        if self.stream is not sys.stdout.buffer:
+            self.stream.close()
+
+
+def png_chunk(kind, body):
+    crc = zlib.crc32(body, zlib.crc32(kind))
+    return struct.pack(">I", len(body)) + kind + body + struct.pack(">I", crc)
+
+
+def png_bytes(data, size, level=png_compression):
+    """幅, 高さsizeのRGBのバイト列dataをPNGファイルの内容に符号化
+    (pygame.image.saveは符号化の間GILを保持してゲームのループを止めるため、
+    圧縮中にGILを解放するzlibで符号化する)"""
+    width, height = size
+    stride = width * 3
+    # 各行の先頭にフィルターの種類 (0: なし) を付ける
+    raw = b"".join(b"\0" + data[y * stride : (y + 1) * stride] for y in range(height))
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return b"".join(
+        [
+            b"\x89PNG\r\n\x1a\n",
+            png_chunk(b"IHDR", header),
+            png_chunk(b"IDAT", zlib.compress(raw, level)),
+            png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+class PngSink(object):
+    "フレームを連番のPNGファイルとしてdirectoryに書き込む"
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+    def write_frame(self, index, data, size):
+        path = os.path.join(self.directory, "frame_%06d.png" % index)
+        with open(path, "wb") as f:
+            f.write(png_bytes(data, size))
+
+    def close(self):
+        pass
+
+
+class FrameCapture(object):
+    "変化したフレームを時刻とともにキューに入れ、書き出しのスレッドでsinkに書き込む"
+
+    def __init__(self, sink, size, timestamps=None, max_queue_bytes=None):
+        """size: フレームの (幅, 高さ)
+        timestamps: 各フレームの時刻を書き出すファイル名 (Noneなら書き出さない)
+        max_queue_bytes: キューに保持するフレームの合計バイト数の上限"""
+        if max_queue_bytes is None:
+            max_queue_bytes = capture_queue_bytes
+        self.sink = sink
+        self.size = tuple(size)
+        frame_bytes = self.size[0] * self.size[1] * 3
+        self.queue = queue.Queue(maxsize=max(2, max_queue_bytes // frame_bytes))
+        self.timestamps = None
+        if timestamps is not None:
+            self.timestamps = open(timestamps, "w")
+            self.timestamps.write("# timestamp format v2\n")
+        # 書き出したフレーム数, キューが一杯で捨てたフレーム数, 前と同じで省いたフレーム数
+        self.emitted = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self.error = None
+        self.thread = threading.Thread(
+            target=self.drain, name="frame-capture", daemon=True
+        )
+        self.thread.start()
+
+    def add(self, surface, timestamp, block=False):
+        """surfaceの現在の内容を時刻timestamp(ms)のフレームとしてキューに入れる
+        キューが一杯なら捨ててFalseを出力 (blockがTrueなら空くまで待つ)"""
+        if self.error is not None:
+            raise CaptureError("frame capture failed: %s" % self.error)
+        data = pygame.image.tobytes(surface, "RGB")
+        try:
+            self.queue.put((timestamp, data), block)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def drain(self):
+        "書き出しのスレッド (closeでNoneを受け取るまでキューのフレームを書き出す)"
+        last = None
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            if self.error is not None:
+                continue
+            timestamp, data = item
+            if data == last:
+                self.duplicates += 1
+                continue
+            last = data
+            try:
+                self.sink.write_frame(self.emitted, data, self.size)
+                if self.timestamps is not None:
+                    self.timestamps.write("%d\n" % timestamp)
+            except Exception as e:
+                # 書き出せなくなったら以降のフレームは捨て、次のaddで報告する
+                self.error = e
+                continue
+            self.emitted += 1
+
+    def close(self):
+        "キューに残ったフレームを書き出して終了"
+        self.queue.put(None)
+        self.thread.join()
+        if self.timestamps is not None:
+            self.timestamps.close()
+        try:
+            self.sink.close()
+        except OSError as e:
+            if self.error is None:
+                self.error = e
+        if self.error is not None:
+            raise CaptureError("frame capture failed: %s" % self.error)
+
+
+def open_capture(size, png=None, raw=None, timestamps=None):
+    """pngのディレクトリか、raw ("-"は標準出力) のファイルに書き出すFrameCapture
+    timestampsを省略した場合は PNGならディレクトリのtimestamps.txt、
+    rawならファイル名.timestamps.txt (標準出力なら書き出さない)"""
+    if png is not None:
+        sink = PngSink(png)
+        if timestamps is None:
+            timestamps = os.path.join(png, "timestamps.txt")
+    elif raw == "-":
+        sink = RawSink(sys.stdout.buffer)
+    else:
+        sink = RawSink(open(raw, "wb"))
+        if timestamps is None:
+            timestamps = raw + ".timestamps.txt"
+    sys.stderr.write("capturing %dx%d rgb24 frames\n" % tuple(size))
+    return FrameCapture(sink, size, timestamps)
@@ -0,0 +1,1015 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Headless rules engine for quantum tetris
+#
+# TetrisEngine owns the board, the stone queue, score/level and the
+# chain reaction (settle -> gates -> clusters). It does not import pygame,
+# so simulations can run without a display at full CPU speed.
+# tetris_pygame.TetrisApp is a thin renderer over this class.
+#
+# The board size and the cluster threshold are per-game settings
+# (TetrisEngine(config=TetrisConfig(cols, rows, cluster_thold))). The
+# module constants below are only the defaults. Every hot path costs time
+# proportional to the cells it touches, so boards like 1000x1000 stay usable.
+
+import random
+from collections import deque, namedtuple
+
+# The configuration (ゲームごとの設定の既定値)
+cols = 10
+rows = 22
+cluster_thold = 3
+undo_limit = 32  # 取り消せる手数
+rules_version = 1  # ルールを変更したら増やす (リプレイの互換性の判定用)
+
+# Define the shapes of the single parts
+tetris_shapes = [
+    [[1, 1, 1], [0, 1, 0]],
+    [[0, 1, 1], [1, 1, 0]],
+    [[1, 1, 0], [0, 1, 1]],
+    [[1, 0, 0], [1, 1, 1]],
+    [[0, 0, 1], [1, 1, 1]],
+    [[1, 1, 1, 1]],
+    [[1, 1], [1, 1]],
+]
+
+labels_dict = {
+    0: None,
+    1: "0",
+    2: "1",
+    3: "+",
+    4: "-",
+    5: "H",
+    6: "Z",
+    7: "X",
+}
+
+opperand_labels = ["0", "1", "+", "-"]
+opperator_labels = ["H", "Z", "X"]
+labels_dict_inv = {v: k for k, v in labels_dict.items()}
+
+# ゲートごとの量子状態の遷移表
+qstate_transition_dicts = {
+    # 0 <-> +,  1 <-> -
+    "H": {"0": "+", "1": "-", "+": "0", "-": "1"},
+    # 0 <-> 1
+    "X": {"0": "1", "1": "0", "+": "+", "-": "-"},
+    # + <-> -
+    "Z": {"0": "0", "1": "1", "+": "-", "-": "+"},
+}
+
+
+# ゲームごとの盤面の大きさとルールの設定
+# cols: 幅, rows: 床を除いた高さ, cluster_thold: クラスターとして消える最小の個数
+TetrisConfig = namedtuple("TetrisConfig", ["cols", "rows", "cluster_thold"])
+default_config = TetrisConfig(cols, rows, cluster_thold)
+
+
+def rotate_clockwise(shape):
+    return [
+        [shape[y][x] for y in range(len(shape))]
+        for x in range(len(shape[0]) - 1, -1, -1)
+    ]
+
+
+# ビットボードの左右の壁の幅 (ストーンの最大幅)
+# ボードの各行はx列目をwall_width + xビット目とし、それ以外のビットを壁とする
+wall_width = 4
+
+
+def make_wall_mask(cols):
+    "幅colsのボードのビットボードで壁にあたるビットを全て立てた整数"
+    return ~(((1 << cols) - 1) << wall_width)
+
+
+wall_mask = make_wall_mask(cols)
+
+
+def row_bits(row):
+    "行のブロックがある列のビットを立てた整数 (x列目はxビット目)"
+    bits = 0
+    for x, val in enumerate(row):
+        if val:
+            bits |= 1 << x
+    return bits
+
+
+def shape_masks(shape):
+    "ストーンの各行のビットマスク"
+    return tuple(row_bits(row) for row in shape)
+
+
+def board_masks(board):
+    "ボードの各行を左右の壁を含むビットボードに変換"
+    mask = make_wall_mask(len(board[0]))
+    return [(row_bits(row) << wall_width) | mask for row in board]
+
+
+def collide_masks(masks, stone_masks, offset):
+    """ビットボードmasksの位置offsetに置いたストーンが、ブロックか壁と重なるか
+    (ボードの上下や壁の外にはみ出す場合も衝突とする)"""
+    off_x, off_y = offset
+    if off_x < -wall_width or off_y < 0 or off_y + len(stone_masks) > len(masks):
+        return True
+    shift = off_x + wall_width
+    for mask in stone_masks:
+        if masks[off_y] & (mask << shift):
+            return True
+        off_y += 1
+    return False
+
+
+def mask_bottoms(masks, width):
+    "ストーンの各列で最も下にあるセルの行 (セルのない列はNone)"
+    bottoms = [None] * width
+    for cy, mask in enumerate(masks):
+        for cx in range(width):
+            if mask & (1 << cx):
+                bottoms[cx] = cy
+    return tuple(bottoms)
+
+
+def column_profile(board, x):
+    """x列目の最上段のブロックの行と、ブロックの数を取得
+    (最上段は落下対象外のため、どちらも1行目から床までで数える)"""
+    top = None
+    filled = 0
+    for y in range(1, len(board)):
+        if board[y][x]:
+            if top is None:
+                top = y
+            if y < len(board) - 1:
+                filled += 1
+    return top, filled
+
+
+def board_skyline(board):
+    "各列の最上段のブロックの行のリスト (空の列は床の行)"
+    return [column_profile(board, x)[0] for x in range(len(board[0]))]
+
+
+def drop_distance(skyline, bottoms, offset):
+    """位置offsetのストーンをブロックに当たるまで何段落とせるかを、
+    各列の最上段のブロックの行skylineからストーンの幅に比例する時間で計算
+    ストーンのいずれかの列が最上段のブロックより下にある場合はNone"""
+    off_x, off_y = offset
+    distance = None
+    for cx, bottom in enumerate(bottoms):
+        if bottom is None:
+            continue
+        top = skyline[off_x + cx]
+        y = off_y + bottom
+        if y >= top:
+            return None
+        if distance is None or top - 1 - y < distance:
+            distance = top - 1 - y
+    return distance
+
+
+def check_collision(board, shape, offset):
+    off_x, off_y = offset
+    if off_y < 0 or off_y + len(shape) > len(board):
+        return True
+    masks = board_masks(board[off_y : off_y + len(shape)])
+    return collide_masks(masks, shape_masks(shape), (off_x, 0))
+
+
+# tetris_shapesの回転1つ分の情報
+# masks: 各行のビットマスク, width/height: 幅と高さ,
+# cells: 各セルの座標(y, x) (回転前の形の行優先の順番),
+# bottoms: 各列で最も下にあるセルの行
+ShapeRotation = namedtuple(
+    "ShapeRotation", ["masks", "width", "height", "cells", "bottoms"]
+)
+
+
+def rotation_table(shape):
+    "形の4方向の回転のShapeRotationのリストを作成"
+    # セルに番号を振った形をrotate_clockwiseで回転させて位置を追跡
+    numbered = []
+    n = 0
+    for row in shape:
+        numbered.append([])
+        for cell in row:
+            n += 1 if cell else 0
+            numbered[-1].append(n if cell else 0)
+    table = []
+    for _ in range(4):
+        cells = [None] * n
+        for cy, row in enumerate(numbered):
+            for cx, cell in enumerate(row):
+                if cell:
+                    cells[cell - 1] = (cy, cx)
+        masks = shape_masks(numbered)
+        width = len(numbered[0])
+        table.append(
+            ShapeRotation(
+                masks, width, len(numbered), tuple(cells), mask_bottoms(masks, width)
+            )
+        )
+        numbered = rotate_clockwise(numbered)
+    return table
+
+
+# shape_rotations[形][回転]: 起動時に作成する全ての形と回転の表
+shape_rotations = [rotation_table(shape) for shape in tetris_shapes]
+# 回転前のビットマスク -> 形の番号
+spawn_shapes = {table[0].masks: s for s, table in enumerate(shape_rotations)}
+
+
+def stone_rotations(stone):
+    """ストーンの4方向の回転を (値の行列, 各行のビットマスク, 各列の最も下のセル)
+    のリストで作成 (tetris_shapesの回転前の形なら回転表から作成する)"""
+    s = spawn_shapes.get(shape_masks(stone))
+    if s is None:
+        rotations = []
+        for _ in range(4):
+            masks = shape_masks(stone)
+            rotations.append((stone, masks, mask_bottoms(masks, len(stone[0]))))
+            stone = rotate_clockwise(stone)
+        return rotations
+    values = [val for row in stone for val in row if val]
+    table = shape_rotations[s]
+    rotations = [(stone, table[0].masks, table[0].bottoms)]
+    for rotation in table[1:]:
+        matrix = [[0] * rotation.width for _ in range(rotation.height)]
+        for (cy, cx), val in zip(rotation.cells, values):
+            matrix[cy][cx] = val
+        rotations.append((matrix, rotation.masks, rotation.bottoms))
+    return rotations
+
+
+def join_matrixes(mat1, mat2, mat2_off):
+    off_x, off_y = mat2_off
+    for cy, row in enumerate(mat2):
+        for cx, val in enumerate(row):
+            mat1[cy + off_y - 1][cx + off_x] += val
+    return mat1
+
+
+def new_board(cols=cols, rows=rows):
+    board = [[0 for x in range(cols)] for y in range(rows)]
+    board += [[1 for x in range(cols)]]
+    return board
+
+
+def new_stone_shape(rand=random.randrange):
+    """ランダムな形のストーンを生成し、各セルに量子状態またはゲートを割り当てる
+    randには乱数生成器のrandrangeを渡す"""
+    shape = tetris_shapes[rand(len(tetris_shapes))]
+    return [
+        [rand(1, len(tetris_shapes) + 1) if i != 0 else 0 for i in col] for col in shape
+    ]
+
+
+# iter_cascadeが出力する連鎖の1段階と、resolve_cascadeの結果
+# (clearedはそれまでに削除したブロックの総数)
+CascadeStep = namedtuple(
+    "CascadeStep", ["phase", "board", "chain", "points", "cleared"]
+)
+CascadeResult = namedtuple("CascadeResult", ["board", "chain", "points", "cleared"])
+
+# TetrisEngine.snapshotが出力するゲームの状態
+# boardは各行をタプルにした不変のボード (変化していない行は前のスナップショットと共有)
+# extraはサブクラスが追加で保存する状態 (snapshot_extraを参照)
+EngineSnapshot = namedtuple(
+    "EngineSnapshot",
+    [
+        "board",
+        "stone",
+        "rotations",
+        "rotation",
+        "stone_x",
+        "stone_y",
+        "next_stone",
+        "level",
+        "score",
+        "lines",
+        "max_chain",
+        "gameover",
+        "random_state",
+        "extra",
+    ],
+)
+
+
+def freeze_row(row):
+    "ボードの1行を不変のタプルに変換 (ndarrayの行はtolistで要素ごとの変換を避ける)"
+    tolist = getattr(row, "tolist", None)
+    return tuple(row if tolist is None else tolist())
+
+
+def snapshot_board(board, base=None, changed_rows=None):
+    """ボードの各行をタプルにした不変のスナップショットを作成
+    前のスナップショットbaseのうち変化していない行はそのまま共有する
+    changed_rowsにはbaseから変化した行のsetを渡す (Noneは全ての行を比較)"""
+    if base is None:
+        return tuple(freeze_row(row) for row in board)
+    if changed_rows is None:
+        rows = []
+        for row, old in zip(board, base):
+            row = freeze_row(row)
+            rows.append(old if row == old else row)
+        return tuple(rows)
+    rows = list(base)
+    for y in changed_rows:
+        rows[y] = freeze_row(board[y])
+    return tuple(rows)
+
+
+def restore_board(board, snapshot, base=None, changed_rows=None):
+    """boardをスナップショットsnapshotの状態に戻し、値が変わったセルの座標(x, y)のsetを出力
+    boardがスナップショットbaseからchanged_rowsの行だけ変化した状態の場合は、
+    それらの行とsnapshotとbaseで共有していない行だけを書き換える"""
+    if base is None or changed_rows is None:
+        rows = range(len(board))
+    else:
+        rows = changed_rows | {
+            y for y, (row, old) in enumerate(zip(snapshot, base)) if row is not old
+        }
+    cells = set()
+    for y in rows:
+        row = board[y]
+        new = snapshot[y]
+        old = freeze_row(row)
+        if old == new:
+            continue
+        cells.update((x, y) for x, val in enumerate(new) if old[x] != val)
+        row[:] = new
+    return cells
+
+
+def score_cleared(n, level, lines):
+    """n個のブロック削除による得点を計算 (add_cl_clustersを1個ずつ呼ぶのと同じ)
+    (得点, 削除後のレベル, 削除後の削除数) を出力"""
+    points = 0
+    for _ in range(n):
+        lines += 1
+        points += level
+        if lines >= level * 6:
+            level += 1
+    return points, level, lines
+
+
+def drop_delay(level):
+    "レベルに応じた自動落下の間隔(ms)"
+    delay = 1000 - 50 * (level - 1)
+    return 100 if delay < 100 else delay
+
+
+def around(cells, rows=rows):
+    """差分判定の対象とするセルの座標set (rowsは床を除いたボードの高さ)
+    変化したセルと、それを真下のターゲットとするゲートの位置 (床は除く)"""
+    return {(x, y) for x, y in cells if y < rows} | {
+        (x, y - 1) for x, y in cells if 0 < y <= rows
+    }
+
+
+class TetrisEngine(object):
+    # ブロックの値 -> 表示するラベル
+    labels = labels_dict
+    # 連鎖反応の判定を、前回連鎖が止まった状態から変化したセルの周辺に限定するか
+    incremental = True
+    # 差分判定の結果をボード全体の走査と比較して検証するか (デバッグ用)
+    verify_incremental = False
+    # undoで取り消せる手数
+    undo_limit = undo_limit
+
+    def __init__(self, on_level_change=None, seed=None, config=default_config):
+        # 盤面の大きさとルール (TetrisConfigか同じ順番のタプル)
+        self.config = config = TetrisConfig(*config)
+        if config.cols < wall_width or config.rows < wall_width:
+            raise ValueError(
+                "board must be at least %dx%d, got %dx%d"
+                % (wall_width, wall_width, config.cols, config.rows)
+            )
+        if config.cluster_thold < 1:
+            raise ValueError("cluster_thold must be at least 1")
+        self.cols, self.rows, self.cluster_thold = config
+        self.wall_mask = make_wall_mask(self.cols)
+        # label_clustersの訪問済みフラグ (最初の探索で作成)
+        self.visited = None
+        # レベルが変わった時に呼ばれる (描画側で落下タイマーを更新するため)
+        self.on_level_change = on_level_change
+        # ゲームごとの乱数生成器 (seedを指定すればストーンの列が再現できる)
+        self.seed = seed
+        self.random = random.Random(seed)
+
+        self.gameover = False
+        self.paused = False
+        self.board_updating = False
+        self.chain = 0
+        self.max_chain = 0
+
+        self.next_stone = self.make_stone()
+        self.init_game()
+        self.save_turn()
+
+    @property
+    def board(self):
+        return self._board
+
+    @board.setter
+    def board(self, board):
+        self._board = board
+        # ボードを置き換えたらビットボードとskylineを作り直す
+        self.bitboard = None
+        self.skyline = None
+        self.skyline_stale = False
+        # 次のスナップショットでは全ての行を前回と比較する
+        self.changed_rows = None
+
+    def get_bitboard(self):
+        "衝突判定用のビットボード (ボードが変わった時だけ作成)"
+        if self.bitboard is None:
+            self.bitboard = board_masks(self.board)
+        return self.bitboard
+
+    def refresh_bitboard(self, cells=None):
+        """ボードを変更した座標(x, y)のset cellsの行だけビットボードを更新
+        cellsがNoneの場合は次の衝突判定で全体を作り直す"""
+        if self.bitboard is None or cells is None:
+            self.bitboard = None
+            return
+        for y in {y for x, y in cells}:
+            self.bitboard[y] = (row_bits(self.board[y]) << wall_width) | self.wall_mask
+
+    def get_skyline(self):
+        """各列の最上段のブロックの行と、各列のブロックの数 (ボードが変わった時だけ作成)
+        連鎖反応の途中(skyline_stale)では連鎖前の値のまま"""
+        if self.skyline is None:
+            profiles = [column_profile(self.board, x) for x in range(self.cols)]
+            self.skyline = [top for top, filled in profiles]
+            self.filled = [filled for top, filled in profiles]
+        return self.skyline
+
+    def refresh_skyline(self, cells=None):
+        """ボードを変更した座標(x, y)のset cellsの列だけskylineを更新
+        cellsがNoneの場合は次に使う時に全体を作り直す"""
+        self.skyline_stale = False
+        if self.skyline is None or cells is None:
+            self.skyline = None
+            return
+        for x in {x for x, y in cells}:
+            self.skyline[x], self.filled[x] = column_profile(self.board, x)
+
+    def current_rotation(self):
+        "現在のストーンの (値の行列, 各行のビットマスク, 各列の最も下のセル)"
+        if self.stone is not self.rotations[self.rotation][0]:
+            # ストーンが外部から置き換えられた場合は回転を作り直す
+            self.rotations = stone_rotations(self.stone)
+            self.rotation = 0
+        return self.rotations[self.rotation]
+
+    def stone_collides(self, rotation, offset):
+        "現在のストーンをrotation回回転して位置offsetに置くと衝突するか"
+        self.current_rotation()
+        bitboard = self.bitboard
+        if bitboard is None:
+            bitboard = self.get_bitboard()
+        return collide_masks(bitboard, self.rotations[rotation % 4][1], offset)
+
+    def landing_y(self):
+        "落下中のストーンが着地するy座標 (ゴーストの表示位置)"
+        bottoms = self.current_rotation()[2]
+        distance = drop_distance(
+            self.get_skyline(), bottoms, (self.stone_x, self.stone_y)
+        )
+        if distance is not None:
+            return self.stone_y + distance
+        # 最上段のブロックより下にある場合は1段ずつ判定
+        y = self.stone_y
+        while not self.stone_collides(self.rotation, (self.stone_x, y + 1)):
+            y += 1
+        return y
+
+    def make_stone(self):
+        "次に出現するストーンを生成"
+        return new_stone_shape(self.random.randrange)
+
+    def new_stone(self):
+        self.stone = self.next_stone[:]
+        self.next_stone = self.make_stone()
+        self.stone_x = int(self.cols / 2 - len(self.stone[0]) / 2)
+        self.stone_y = 0
+        # 4方向の回転はストーンの出現時に作成し、回転操作では切り替えるだけにする
+        self.rotations = stone_rotations(self.stone)
+        self.rotation = 0
+
+        if self.stone_collides(0, (self.stone_x, self.stone_y)):
+            self.gameover = True
+
+    def init_game(self):
+        self.board = new_board(self.cols, self.rows)
+        self.board_updating = False
+        # 前回連鎖が止まった状態から変化したセルの座標set (Noneは全体を走査)
+        self.dirty = None
+        # 前回のスナップショットのボードと、それ以降に変化した行のset
+        # (Noneは不明なので全ての行を比較する)
+        self.board_snapshot = None
+        # 各手の開始時 (ストーンの出現時) のスナップショット
+        self.history = deque(maxlen=self.undo_limit + 1)
+        self.new_stone()
+        self.level = 1
+        self.score = 0
+        self.lines = 0
+        if self.on_level_change is not None:
+            self.on_level_change(self.level)
+
+    def can_operate(self):
+        "ストーンを操作できる状態か (連鎖処理中は操作不可)"
+        return not self.gameover and not self.paused and not self.board_updating
+
+    def judge_can_settle(self, board, columns=None):
+        """ボード上の全ブロックのうちいずれかが下に移動できるか判定
+        columnsを指定した場合はその列だけを判定"""
+        rows = self.rows
+        columns = range(self.cols) if columns is None else columns
+        if board is self.board and self.skyline is not None and not self.skyline_stale:
+            # 最上段のブロックから床までの間に空きがある列は落下できる
+            skyline = self.skyline
+            filled = self.filled
+            return any(filled[x] < rows - skyline[x] for x in columns)
+        for y in range(rows - 2, 0, -1):
+            row = board[y]
+            below = board[y + 1]
+            for x in columns:
+                if (row[x] != 0) and (below[x] == 0):
+                    return True
+        return False
+
+    def settle_board(self, board, columns=None):
+        """クラスター削除後に浮いたブロックを落下
+        columnsを指定した場合はその列だけを処理"""
+        rows = self.rows
+        for x in range(self.cols) if columns is None else columns:
+            # 1行目から床の上までのブロックを、順番を保ったまま下から詰めていく
+            # (1個ずつ空きを落とすのと同じ結果を、列の高さに比例する時間で求める)
+            bottom = rows - 1
+            for y in range(rows - 1, 0, -1):
+                val = board[y][x]
+                if val == 0:
+                    continue
+                if y != bottom:
+                    board[bottom][x] = val
+                    board[y][x] = 0
+                bottom -= 1
+        return board
+
+    def get_operator_target(self, board, cells=None):
+        """ゲートの(位置,種類)とターゲットの(位置,種類)ペアを取得
+        cellsを指定した場合はその座標(x, y)のゲートだけを調べる"""
+        rows = self.rows
+        if cells is None:
+            cells = [(x, y) for y in range(rows) for x in range(self.cols)]
+        else:
+            # ボード全体を走査した場合と同じ順番で処理する
+            cells = sorted(cells, key=lambda cell: (cell[1], cell[0]))
+        # ゲートの真下のみ作用する仕様へ変更
+        operator_target_dict = {}
+        for x, y in cells:
+            gate_type = labels_dict[board[y][x]]
+            if gate_type not in opperator_labels:
+                continue
+            # ゲートの下側のみ作用する場合はリストサイズ1 (現行の挙動),
+            # 左右にも作用する場合は最大リストサイズ3 (将来の拡張用)
+            operands = []
+            # 下端の場合以外、下側に量子状態ブロックがあるかチェック
+            if y != rows - 1:
+                qstate = labels_dict[board[y + 1][x]]
+                if qstate in opperand_labels:
+                    operands.append((x, y + 1, qstate))
+            # 下端に接したゲートと量子状態に接したゲートは削除対象
+            if (y == rows - 1) or (len(operands) > 0):
+                operator_target_dict[(x, y, gate_type)] = operands
+
+        return operator_target_dict
+
+    def gate_exist(self, board):
+        "フィールド上にゲートブロックが存在するか"
+        return len(self.get_operator_target(board)) > 0
+
+    def operate_gate(self, board, operator, targets):
+        "targetブロックにoperatorを作用"
+        # operator: ()
+        operator_x, operator_y, gate_type = operator
+        qstate_transition_dict = qstate_transition_dicts[gate_type]
+
+        for target in targets:
+            target_x, target_y, qstate_pre = target
+            # targetの量子状態を更新
+            qstate_post = qstate_transition_dict[qstate_pre]
+            board[target_y][target_x] = labels_dict_inv[qstate_post]
+
+        # ゲートブロックの削除
+        board[operator_y][operator_x] = 0
+
+        return board
+
+    def operate_all_gates(self, board):
+        "ゲート処理を実行"
+        for operator, opperands in self.get_operator_target(board).items():
+            self.operate_gate(board, operator, opperands)
+        return board
+
+    def find_idential_adjacent(self, board, x, y):
+        """対象の座標(x,y)の隣接に同一ブロックがないかをチェック
+        クラスター候補となる座標のsetを出力"""
+        cols, rows = self.cols, self.rows
+        set_cluster_xy = {(x, y)}
+        while True:
+            pre_set_cluster_xy = set_cluster_xy.copy()
+            for xx, yy in pre_set_cluster_xy:
+                # 左端の場合以外で左側のブロック比較
+                if (xx != 0) and (board[yy][xx] == board[yy][xx - 1]):
+                    set_cluster_xy.add((xx - 1, yy))
+                # 右端の場合以外で右側のブロック比較
+                if (xx != cols - 1) and (board[yy][xx] == board[yy][xx + 1]):
+                    set_cluster_xy.add((xx + 1, yy))
+                # 上端の場合以外で上側のブロック比較
+                if (yy != 0) and (board[yy][xx] == board[yy - 1][xx]):
+                    set_cluster_xy.add((xx, yy - 1))
+                # 下端の場合以外で下側のブロック比較
+                if (yy != rows - 1) and (board[yy][xx] == board[yy + 1][xx]):
+                    set_cluster_xy.add((xx, yy + 1))
+            if len(pre_set_cluster_xy) == len(set_cluster_xy):
+                break
+
+        return set_cluster_xy
+
+    def label_clusters(self, board, threthold=1, cells=None):
+        """同一ブロックが隣接した連結成分を1回の走査で全て取得
+        訪問済みフラグを持つ幅優先探索のため、盤面サイズに対して線形時間
+        cellsを指定した場合はその座標(x, y)を含む成分だけを探索
+        threthold個以上の成分を(ラベル, サイズ, 座標のリスト)のリストで出力"""
+        cols, rows = self.cols, self.rows
+        if cells is None:
+            starts = [(x, y) for y in range(rows) for x in range(cols)]
+        else:
+            starts = cells
+        # 訪問済みフラグはエンジンで使い回し、探索後に立てたフラグだけを戻す
+        # (差分判定の探索は盤面の大きさによらず探索したセルの数に比例する時間で済む)
+        visited = self.visited
+        if visited is None:
+            visited = self.visited = [[False] * cols for _ in range(rows)]
+        components = []
+        clusters = []
+        label = 0
+        for x, y in starts:
+            if visited[y][x] or board[y][x] == 0:
+                continue
+            val = board[y][x]
+            visited[y][x] = True
+            cells = [(x, y)]
+            components.append(cells)
+            # 探索中にcellsへ追加した座標も順に処理される
+            for xx, yy in cells:
+                for nx, ny in (
+                    (xx - 1, yy),
+                    (xx + 1, yy),
+                    (xx, yy - 1),
+                    (xx, yy + 1),
+                ):
+                    if (
+                        0 <= nx < cols
+                        and 0 <= ny < rows
+                        and not visited[ny][nx]
+                        and board[ny][nx] == val
+                    ):
+                        visited[ny][nx] = True
+                        cells.append((nx, ny))
+            label += 1
+            if len(cells) >= threthold:
+                clusters.append((label, len(cells), cells))
+        for cells in components:
+            for x, y in cells:
+                visited[y][x] = False
+        return clusters
+
+    def find_cluster(self, board, threthold=None, cells=None):
+        """cluster_tholdをクラスター判定の基準とし、同一ブロックが隣接した全座標setを出力
+        (thretholdを省略した場合はゲームの設定のcluster_thold)
+        cellsを指定した場合はその座標を含むクラスターだけを探索"""
+        if threthold is None:
+            threthold = self.cluster_thold
+        clusters_cordinates = set()
+        for label, size, cells in self.label_clusters(board, threthold, cells):
+            clusters_cordinates.update(cells)
+        return clusters_cordinates
+
+    def remove_clusters(self, board, clusters):
+        "クラスターのブロックを消す (得点は加算しない)"
+        for x, y in clusters:
+            board[y][x] = 0
+        return board
+
+    def delete_clusters(self, board, clusters):
+        """クラスターを削除"""
+        board = self.remove_clusters(board, clusters)
+        for _ in range(len(clusters)):
+            self.add_cl_clusters(1)
+        return board
+
+    def cascade_step(self, board, dirty=None):
+        """boardの連鎖反応を1段階だけ進める (boardはその場で更新し、得点は加算しない)
+        (処理の種類, 削除したブロック数) を返し、連鎖が終わっていれば (None, 0)
+        dirtyには前回連鎖が止まった状態から変化したセルの座標setを渡す
+        (判定をその周辺に限定し、この段階で変化したセルを追加する)
+        差分判定に対応しないエンジン (incrementalがFalse) ではdirtyを無視して全体を走査する"""
+        if dirty is None or not self.incremental:
+            return self.full_cascade_step(board)
+        if not self.verify_incremental:
+            return self.incremental_cascade_step(board, dirty)
+        expected_board = [row[:] for row in board]
+        expected = self.full_cascade_step(expected_board)
+        result = self.incremental_cascade_step(board, dirty)
+        if result != expected or board != expected_board:
+            raise AssertionError(
+                "incremental cascade step %r differs from full scan %r"
+                % (result, expected)
+            )
+        return result
+
+    def full_cascade_step(self, board):
+        "ボード全体を走査して連鎖反応を1段階進める"
+        # ブロック落下の処理
+        if self.judge_can_settle(board):
+            self.settle_board(board)
+            return "settle", 0
+        # ゲートブロックの存在を確認
+        if self.gate_exist(board):
+            self.operate_all_gates(board)
+            return "gate", 0
+        # 同じブロックが隣接しているクラスターの存在を確認
+        clusters = self.find_cluster(board)
+        if len(clusters) > 0:
+            self.remove_clusters(board, clusters)
+            return "cluster", len(clusters)
+        return None, 0
+
+    def incremental_cascade_step(self, board, dirty):
+        """変化したセルの周辺だけを調べて連鎖反応を1段階進める
+        変化していない部分は連鎖が止まった状態のままなので、
+        落下は変化した列、ゲートとクラスターは変化したセルの周辺でしか起きない"""
+        rows = self.rows
+        # ブロック落下の処理
+        columns = sorted({x for x, y in dirty})
+        if self.judge_can_settle(board, columns):
+            before = [[board[y][x] for y in range(rows)] for x in columns]
+            self.settle_board(board, columns)
+            for x, column in zip(columns, before):
+                dirty.update((x, y) for y in range(rows) if board[y][x] != column[y])
+            return "settle", 0
+        # ゲートブロックの存在を確認
+        operator_targets = self.get_operator_target(board, around(dirty, rows))
+        if len(operator_targets) > 0:
+            for operator, opperands in operator_targets.items():
+                self.operate_gate(board, operator, opperands)
+                dirty.add(operator[:2])
+                dirty.update(target[:2] for target in opperands)
+            return "gate", 0
+        # 同じブロックが隣接しているクラスターの存在を確認
+        clusters = self.find_cluster(
+            board, cells=[(x, y) for x, y in dirty if y < rows]
+        )
+        if len(clusters) > 0:
+            self.remove_clusters(board, clusters)
+            dirty.update(clusters)
+            return "cluster", len(clusters)
+        return None, 0
+
+    def iter_cascade(self, board, level=None, lines=None, dirty=None):
+        """boardの連鎖反応を1段階ずつ進めるジェネレーター
+        各段階の後にCascadeStep(処理の種類, ボード, 連鎖数, 得点, 削除数)を出力
+        level, linesを省略した場合は現在のゲームの値で得点を計算
+        dirtyを指定した場合は差分判定で進める (cascade_stepを参照)
+        (boardはその場で更新されるが、ゲームの得点やレベルは変更しない)"""
+        level = self.level if level is None else level
+        lines = self.lines if lines is None else lines
+        chain = 0
+        points = 0
+        total = 0
+        while True:
+            phase, cleared = self.cascade_step(board, dirty)
+            if phase is None:
+                return
+            if phase == "cluster":
+                chain += 1
+                total += cleared
+                gained, level, lines = score_cleared(cleared, level, lines)
+                points += gained
+            yield CascadeStep(phase, board, chain, points, total)
+
+    def resolve_cascade(self, board, level=None, lines=None, dirty=None):
+        """boardの連鎖反応を最後まで進める
+        CascadeResult(最終ボード, 連鎖数, 得点, 削除数)を出力"""
+        result = CascadeResult(board, 0, 0, 0)
+        for step in self.iter_cascade(board, level, lines, dirty):
+            result = CascadeResult(board, step.chain, step.points, step.cleared)
+        return result
+
+    def update_board(self):
+        """連鎖反応を1段階だけ進める
+        実行した処理 ("settle", "gate", "cluster") を返し、連鎖が終わればNoneを返す"""
+        if not self.board_updating:
+            return None
+        phase, cleared = self.cascade_step(self.board, self.dirty)
+        if phase is None:
+            # ボードの更新が終わった (連鎖中は操作できないので、ここで衝突判定用に更新)
+            self.board_updating = False
+            self.refresh_bitboard(self.dirty)
+            self.refresh_skyline(self.dirty)
+            if self.dirty is None:
+                self.changed_rows = None
+            elif self.changed_rows is not None:
+                self.changed_rows.update(y for x, y in self.dirty)
+            self.dirty = None
+            self.save_turn()
+            return phase
+        # 連鎖中はskylineを更新しない (judge_can_settleはボードを走査する)
+        self.skyline_stale = True
+        if phase == "cluster":
+            for _ in range(cleared):
+                self.add_cl_clusters(1)
+            self.chain += 1
+            self.max_chain = max(self.max_chain, self.chain)
+        return phase
+
+    def resolve_board(self):
+        "連鎖反応が終わるまでボードを更新"
+        while self.update_board() is not None:
+            pass
+
+    def add_cl_clusters(self, n):
+        self.lines += n
+        self.score += n * self.level
+        if self.lines >= self.level * 6:
+            self.level += 1
+            if self.on_level_change is not None:
+                self.on_level_change(self.level)
+
+    def move(self, delta_x):
+        if self.can_operate():
+            new_x = self.stone_x + delta_x
+            if new_x < 0:
+                new_x = 0
+            if new_x > self.cols - len(self.stone[0]):
+                new_x = self.cols - len(self.stone[0])
+            if not self.stone_collides(self.rotation, (new_x, self.stone_y)):
+                self.stone_x = new_x
+
+    def drop(self, manual):
+        if self.can_operate():
+            self.score += 1 if manual else 0
+            self.stone_y += 1
+            if self.stone_collides(self.rotation, (self.stone_x, self.stone_y)):
+                join_matrixes(self.board, self.stone, (self.stone_x, self.stone_y))
+                # 置いたストーンの行だけビットボードを更新
+                shift = self.stone_x + wall_width
+                for cy, mask in enumerate(self.rotations[self.rotation][1]):
+                    self.bitboard[self.stone_y - 1 + cy] |= mask << shift
+                # 置いたストーンの列だけskylineを更新
+                if self.skyline is not None:
+                    for cy, row in enumerate(self.stone):
+                        y = self.stone_y - 1 + cy
+                        for cx, val in enumerate(row):
+                            if val and y >= 1:
+                                x = self.stone_x + cx
+                                self.skyline[x] = min(self.skyline[x], y)
+                                self.filled[x] += 1
+                if self.changed_rows is not None:
+                    self.changed_rows.update(
+                        range(self.stone_y - 1, self.stone_y - 1 + len(self.stone))
+                    )
+                if self.incremental:
+                    # 連鎖が止まった状態のボードからの変化は置いたストーンのみ
+                    self.dirty = {
+                        (self.stone_x + cx, self.stone_y - 1 + cy)
+                        for cy, row in enumerate(self.stone)
+                        for cx, val in enumerate(row)
+                        if val
+                    }
+                self.new_stone()
+                self.board_updating = True
+                self.chain = 0
+                cleared_rows = 0
+
+                self.add_cl_clusters(cleared_rows)
+                return True
+        return False
+
+    def insta_drop(self):
+        if self.can_operate():
+            # 着地位置の直前まで一気に移動 (1段ずつdrop(True)した場合と同じ得点)
+            distance = self.landing_y() - self.stone_y
+            self.stone_y += distance
+            self.score += distance
+            while not self.drop(True):
+                pass
+
+    def rotate_stone(self):
+        if self.can_operate():
+            rotation = self.rotation + 1
+            if not self.stone_collides(rotation, (self.stone_x, self.stone_y)):
+                self.rotation = rotation % 4
+                self.stone = self.rotations[self.rotation][0]
+
+    def place_stone(self, rotation, x):
+        "ストーンをrotation回回転してx座標へ移動し、一気に落として連鎖を最後まで進める"
+        for _ in range(rotation):
+            self.rotate_stone()
+        self.move(x - self.stone_x)
+        self.insta_drop()
+        self.resolve_board()
+
+    def toggle_pause(self):
+        self.paused = not self.paused
+
+    def snapshot(self):
+        """現在の状態のスナップショットを作成
+        前回のスナップショットから変化していないボードの行は共有するため、
+        作成のコストは変化した行の数に比例する"""
+        board = snapshot_board(self.board, self.board_snapshot, self.changed_rows)
+        self.board_snapshot = board
+        self.changed_rows = set()
+        return EngineSnapshot(
+            board,
+            self.stone,
+            self.rotations,
+            self.rotation,
+            self.stone_x,
+            self.stone_y,
+            self.next_stone,
+            self.level,
+            self.score,
+            self.lines,
+            self.max_chain,
+            self.gameover,
+            self.random.getstate(),
+            self.snapshot_extra(),
+        )
+
+    def restore(self, snapshot):
+        """スナップショットの状態に戻す (連鎖反応の途中の状態は破棄)
+        ボードは前回のスナップショットから変化した行だけを書き換える"""
+        cells = restore_board(
+            self.board, snapshot.board, self.board_snapshot, self.changed_rows
+        )
+        self.board_snapshot = snapshot.board
+        self.changed_rows = set()
+        self.refresh_bitboard(cells)
+        self.refresh_skyline(cells)
+        self.board_updating = False
+        self.dirty = None
+        self.chain = 0
+        self.stone = snapshot.stone
+        self.rotations = snapshot.rotations
+        self.rotation = snapshot.rotation
+        self.stone_x = snapshot.stone_x
+        self.stone_y = snapshot.stone_y
+        self.next_stone = snapshot.next_stone
+        self.score = snapshot.score
+        self.lines = snapshot.lines
+        self.max_chain = snapshot.max_chain
+        self.gameover = snapshot.gameover
+        self.random.setstate(snapshot.random_state)
+        self.restore_extra(snapshot.extra)
+        if snapshot.level != self.level:
+            self.level = snapshot.level
+            if self.on_level_change is not None:
+                self.on_level_change(self.level)
+
+    def snapshot_extra(self):
+        "サブクラスがスナップショットに追加で保存する状態 (ボード以外のセルごとの情報など)"
+        return None
+
+    def restore_extra(self, extra):
+        "snapshot_extraで保存した状態に戻す"
+
+    def save_turn(self):
+        "手の開始時 (ストーンの出現時) の状態をundo用の履歴に追加"
+        self.history.append(self.snapshot())
+
+    def can_undo(self):
+        "undoできる状態か (連鎖処理中はゲームオーバーの場合のみ)"
+        if self.paused or (self.board_updating and not self.gameover):
+            return False
+        # 連鎖の途中で終わった手は履歴に入っていない
+        return len(self.history) > (0 if self.board_updating else 1)
+
+    def undo(self):
+        """1手前 (前のストーンの出現時) の状態に戻す (ゲームオーバーからも戻せる)
+        戻した場合はTrueを返す"""
+        if not self.can_undo():
+            return False
+        if not self.board_updating:
+            self.history.pop()
+        self.restore(self.history[-1])
+        return True
+
+    def start_game(self):
+        if self.gameover:
+            self.init_game()
+            self.gameover = False
+            self.save_turn()
@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Entangled stones for the statevector mode
+#
+# With probability entangle_rate a new stone turns some of its qubit cells
+# into one entangled group (a Bell pair for two cells, a GHZ state for
+# more). These cells show the value "E". A gate that hits one of them acts
+# on the shared state of the whole group, so its partners are affected too.
+#
+# Only entangled groups are stored as multi-qubit statevectors, in a
+# sparse EntangledStateStore (group id -> qubit ids + 2**k amplitudes).
+# Every other qubit cell stays a single-qubit entry of
+# StatevectorTetrisEngine.amps. A qubit id grid next to the board tells
+# which cell holds which entangled qubit and moves with the cells when they
+# settle.
+#
+# Groups never grow: gates act on one qubit, so a group keeps the size it
+# spawned with (at most group_size, 2**group_size amplitudes) until it is
+# measured. "E" cells form clusters with each other like gates do. When
+# delete_clusters clears an "E" cell, its qubit is measured in the
+# computational basis. A partner left alone in its group collapses back
+# into a plain single-qubit cell, and the group is removed from the store.
+# So the store never holds more than one group per stone on the board.
+#
+# Requires numpy (pip install numpy).
+
+import numpy as np
+
+from tetris_engine import default_config
+from tetris_numpy import gate_masks
+from tetris_quantum import (
+    StatevectorTetrisEngine,
+    apply_unitaries,
+    entangled_value,
+    fidelity_tolerance,
+    is_gate,
+    is_qubit,
+    is_state,
+    nearest_values,
+)
+
+# エンタングルしたストーンの出現率と、1つのグループのqubit数
+entangle_rate = 0.2
+group_size = 2
+
+
+def ghz_state(n):
+    "n qubitのGHZ状態 (|0...0> + |1...1>)/√2 (n=2ならBell状態)"
+    state = np.zeros((2,) * n, dtype=complex)
+    state[(0,) * n] = state[(1,) * n] = np.sqrt(0.5)
+    return state
+
+
+class EntangledStateStore(object):
+    "エンタングルしたqubitのグループだけを多qubitの状態ベクトルで保持する疎なストア"
+
+    def __init__(self):
+        # グループid -> [qubit idのリスト, 形が(2,)*kの状態ベクトル]
+        # 状態ベクトルのk番目の軸がリストのk番目のqubitに対応
+        self.groups = {}
+        # qubit id -> グループid (qubit idは1から、0はエンタングルしていないセル)
+        self.group_of = {}
+        self.next_qubit = 1
+        self.next_group = 0
+
+    def __len__(self):
+        return len(self.groups)
+
+    def n_amplitudes(self):
+        "保持している振幅の総数"
+        return sum(state.size for qubits, state in self.groups.values())
+
+    def new_group(self, state):
+        "状態ベクトルstateのグループを登録し、各軸のqubit idのリストを出力"
+        qubits = list(range(self.next_qubit, self.next_qubit + state.ndim))
+        self.next_qubit += state.ndim
+        group = self.next_group
+        self.next_group += 1
+        self.groups[group] = [qubits, state]
+        for qubit in qubits:
+            self.group_of[qubit] = group
+        return list(qubits)
+
+    def apply(self, qubit, unitary):
+        "qubitに2x2のユニタリを作用させる (グループの他のqubitとの相関も変わる)"
+        qubits, state = self.groups[self.group_of[qubit]]
+        axis = qubits.index(qubit)
+        state = np.tensordot(unitary, state, axes=([1], [axis]))
+        self.groups[self.group_of[qubit]][1] = np.moveaxis(state, 0, axis)
+
+    def copy(self):
+        "ストアのコピー (状態ベクトルは置き換えるだけで変更しないので共有する)"
+        store = EntangledStateStore()
+        store.groups = {
+            group: [list(qubits), state]
+            for group, (qubits, state) in self.groups.items()
+        }
+        store.group_of = dict(self.group_of)
+        store.next_qubit = self.next_qubit
+        store.next_group = self.next_group
+        return store
+
+    def reduced_state(self, qubit):
+        "qubitの縮約密度行列"
+        qubits, state = self.groups[self.group_of[qubit]]
+        state = np.moveaxis(state, qubits.index(qubit), 0).reshape(2, -1)
+        return state @ np.conj(state).T
+
+    def measure(self, qubit, rng):
+        """qubitを計算基底で測定して状態を射影し、測定値(0か1)を出力
+        rngはrandom.Random (エンジンと同じ乱数系列を使う)"""
+        group = self.group_of.pop(qubit)
+        qubits, state = self.groups[group]
+        axis = qubits.index(qubit)
+        p1 = np.sum(np.abs(state.take(1, axis=axis)) ** 2)
+        outcome = int(rng.random() < p1)
+        state = state.take(outcome, axis=axis)
+        state = state / np.sqrt(p1 if outcome else 1 - p1)
+        del qubits[axis]
+        if qubits:
+            self.groups[group][1] = state
+        else:
+            del self.groups[group]
+        return outcome
+
+    def release(self, qubit):
+        """グループに1つだけ残ったqubitをストアから外し、1qubitの振幅を出力
+        (他のqubitが残っていてエンタングルしている場合はNone)"""
+        group = self.group_of[qubit]
+        qubits, state = self.groups[group]
+        if len(qubits) != 1:
+            return None
+        del self.groups[group]
+        del self.group_of[qubit]
+        return state
+
+
+class EntangledTetrisEngine(StatevectorTetrisEngine):
+    "一部のストーンがエンタングルしたqubitを含むstatevectorモードのエンジン"
+
+    def __init__(
+        self,
+        on_level_change=None,
+        seed=None,
+        tolerance=fidelity_tolerance,
+        gates=None,
+        entangle_rate=entangle_rate,
+        group_size=group_size,
+        config=default_config,
+    ):
+        """entangle_rate: ストーンがエンタングルしたqubitを含む確率
+        group_size: 1つのストーンでエンタングルさせるqubitの最大数 (2以上)"""
+        if group_size < 2:
+            raise ValueError("group_size must be at least 2")
+        self.entangle_rate = entangle_rate
+        self.group_size = group_size
+        super().__init__(on_level_change, seed, tolerance, gates, config)
+
+    def make_stone(self):
+        "一定の確率でストーンの量子状態のセルの一部をエンタングルしたqubitにする"
+        stone = super().make_stone()
+        if self.random.random() >= self.entangle_rate:
+            return stone
+        cells = [
+            (cy, cx)
+            for cy, row in enumerate(stone)
+            for cx, val in enumerate(row)
+            if is_state[val]
+        ]
+        if len(cells) < 2:
+            return stone
+        n = min(len(cells), self.group_size)
+        for cy, cx in self.random.sample(cells, n):
+            stone[cy][cx] = entangled_value
+        return stone
+
+    def init_game(self):
+        super().init_game()
+        self.store = EntangledStateStore()
+        # 各セルのエンタングルしたqubitのid (0はエンタングルしていない)
+        self.qubits = np.zeros(self.board.shape, dtype=np.int64)
+
+    def snapshot_extra(self):
+        return super().snapshot_extra(), self.qubits.copy(), self.store.copy()
+
+    def restore_extra(self, extra):
+        amps, qubits, store = extra
+        super().restore_extra(amps)
+        self.qubits[...] = qubits
+        self.store = store.copy()
+
+    def drop(self, manual):
+        stone, x, y = self.stone, self.stone_x, self.stone_y
+        landed = super().drop(manual)
+        if landed:
+            # 置いたストーンのEのセルを1つのGHZ状態のグループとして登録
+            cells = [
+                (y + cy, x + cx)
+                for cy, row in enumerate(stone)
+                for cx, val in enumerate(row)
+                if val == entangled_value
+            ]
+            if cells:
+                qubits = self.store.new_group(ghz_state(len(cells)))
+                for cell, qubit in zip(cells, qubits):
+                    self.qubits[cell] = qubit
+        return landed
+
+    def settle_cells(self, order):
+        super().settle_cells(order)
+        self.qubits[1:-1] = np.take_along_axis(self.qubits[1:-1], order, axis=0)
+
+    def operate_gates(self):
+        """作用するゲートを処理 (Eのセルへのゲートはストアのグループに作用)
+        処理したゲートがあるかを出力"""
+        board = self.board
+        active, hits = gate_masks(board, is_qubit, is_gate)
+        if not active.any():
+            return False
+        # ターゲットはゲートの1段下
+        ys, xs = np.nonzero(hits)
+        entangled = board[ys + 1, xs] == entangled_value
+        for y, x in zip(ys[entangled], xs[entangled]):
+            self.store.apply(self.qubits[y + 1, x], self.unitaries[board[y, x]])
+        apply_unitaries(
+            board, self.amps, ys[~entangled], xs[~entangled], self.unitaries
+        )
+        board[:-1][active] = 0
+        self.amps[:-1][active] = 0
+        return True
+
+    def clear_cells(self, mask):
+        """削除するEのセルのqubitを測定して射影し、
+        グループに1つだけ残ったqubitを1qubitのセルに戻す"""
+        qubits = self.qubits[:-1][mask]
+        measured = set()
+        for qubit in qubits[qubits != 0]:
+            measured.add(self.store.group_of[qubit])
+            self.store.measure(qubit, self.random)
+        super().clear_cells(mask)
+        self.qubits[:-1][mask] = 0
+        if not measured:
+            return
+        ys, xs = np.nonzero(self.qubits)
+        for y, x in zip(ys, xs):
+            qubit = self.qubits[y, x]
+            if self.store.group_of[qubit] not in measured:
+                continue
+            amps = self.store.release(qubit)
+            if amps is not None:
+                self.qubits[y, x] = 0
+                self.amps[y, x] = amps
+                self.board[y, x] = nearest_values(amps)
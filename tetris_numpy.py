@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# NumPy board backend for quantum tetris
+#
+# The board is a small-integer ndarray of shape (rows + 1, cols), laid out
+# exactly like tetris_engine.new_board() (the last row is the floor).
+# Every cascade phase is a few whole-array operations, and all functions
+# work on the last two axes, so they also accept a stack of boards with
+# shape (..., rows + 1, cols).
+#
+# Requires numpy (pip install numpy).
+
+import numpy as np
+
+from tetris_engine import (
+    TetrisEngine,
+    cluster_thold,
+    cols,
+    labels_dict,
+    labels_dict_inv,
+    make_wall_mask,
+    new_board,
+    opperand_labels,
+    opperator_labels,
+    qstate_transition_dicts,
+    rows,
+    wall_width,
+)
+
+board_dtype = np.int8
+
+# ブロックの値ごとの種類判定表
+n_values = len(labels_dict)
+is_operand = np.array([labels_dict[v] in opperand_labels for v in range(n_values)])
+is_operator = np.array([labels_dict[v] in opperator_labels for v in range(n_values)])
+
+# gate_transition[ゲートの値, 量子状態の値] -> 作用後の量子状態の値
+gate_transition = np.tile(np.arange(n_values, dtype=board_dtype), (n_values, 1))
+for gate_type, qstate_transition_dict in qstate_transition_dicts.items():
+    for qstate_pre, qstate_post in qstate_transition_dict.items():
+        gate_transition[labels_dict_inv[gate_type], labels_dict_inv[qstate_pre]] = (
+            labels_dict_inv[qstate_post]
+        )
+
+
+def new_board_array(cols=cols, rows=rows):
+    "new_board(cols, rows)と同じ配置のndarrayボードを作成"
+    return np.array(new_board(cols, rows), dtype=board_dtype)
+
+
+def board_masks_array(board):
+    "tetris_engine.board_masksのndarray版 (各行のビットをnp.packbitsでまとめて作成)"
+    board = np.asarray(board)
+    packed = np.packbits(board != 0, axis=-1, bitorder="little")
+    mask = make_wall_mask(board.shape[-1])
+    return [
+        (int.from_bytes(row.tobytes(), "little") << wall_width) | mask for row in packed
+    ]
+
+
+def board_profile(board):
+    """全ての列のtetris_engine.column_profileを配列演算で計算
+    (各列の最上段のブロックの行のリスト, 各列のブロックの数のリスト) を出力"""
+    occupied = np.asarray(board)[1:] != 0
+    # 床があるので、どの列にも1行目以降にブロックがある
+    top = occupied.argmax(axis=0) + 1
+    filled = occupied[:-1].sum(axis=0)
+    return top.tolist(), filled.tolist()
+
+
+def can_settle(board):
+    "ボードごとに、いずれかのブロックが下に移動できるか判定"
+    falling = (board[..., 1:-2, :] != 0) & (board[..., 2:-1, :] == 0)
+    return falling.any(axis=(-2, -1))
+
+
+def settle_order(board):
+    """下詰めした後の各セルが、1行目から床の上までの何行目から来るかの表
+    最上段はjudge_can_settle/settle_boardの仕様どおり落下対象外"""
+    # 空セル(False)が上、ブロック(True)が下に並ぶ安定ソート
+    return np.argsort(board[..., 1:-1, :] != 0, axis=-2, kind="stable")
+
+
+def settle_board(board):
+    "浮いたブロックを列ごとに下詰めする"
+    body = board[..., 1:-1, :]
+    board[..., 1:-1, :] = np.take_along_axis(body, settle_order(board), axis=-2)
+    return board
+
+
+def gate_masks(board, operand=is_operand, operator=is_operator):
+    """作用するゲートの位置と、その真下のターゲットの位置を取得
+    どちらも床を除いた (..., rows, cols) のマスク
+    operand, operatorにはブロックの値ごとの種類判定表を渡す"""
+    body = board[..., :-1, :]
+    gates = operator[body]
+    # 真下が量子状態のゲートはターゲットに作用する (最下段の真下は床なので除外)
+    hits = gates & operand[board[..., 1:, :]]
+    hits[..., -1, :] = False
+    # 最下段のゲートはターゲットなしで削除
+    active = hits.copy()
+    active[..., -1, :] |= gates[..., -1, :]
+    return active, hits
+
+
+def operate_all_gates(board, masks=None):
+    "作用するゲートを全て同時に処理"
+    active, hits = gate_masks(board) if masks is None else masks
+    # ターゲットはゲートの1段下
+    targets = np.zeros(board.shape, dtype=bool)
+    targets[..., 1:, :] = hits
+    gates = np.zeros_like(board)
+    gates[..., 1:, :] = board[..., :-1, :]
+    board[targets] = gate_transition[gates[targets], board[targets]]
+    board[..., :-1, :][active] = 0
+    return board
+
+
+def cluster_labels(board):
+    """同一ブロックが隣接した連結成分のラベルを付ける
+    各セルのラベルは成分内で最小の(平坦化した)インデックス"""
+    body = board[..., :-1, :]
+    occupied = body != 0
+    eq_x = occupied[..., :, :-1] & (body[..., :, :-1] == body[..., :, 1:])
+    eq_y = occupied[..., :-1, :] & (body[..., :-1, :] == body[..., 1:, :])
+    return component_labels(eq_x, eq_y), occupied
+
+
+def component_labels(eq_x, eq_y):
+    """横方向の隣接eq_xと縦方向の隣接eq_yでつながった連結成分のラベルを付ける
+    eq_xは (..., h, w - 1), eq_yは (..., h - 1, w) のマスク"""
+    shape = eq_x.shape[:-1] + (eq_x.shape[-1] + 1,)
+    size = int(np.prod(shape))
+
+    # 隣接が同一ブロックでない方向からは伝搬しないよう番兵値を使う
+    sentinel = size
+    labels = np.arange(size, dtype=np.int32).reshape(shape)
+    while True:
+        new_labels = labels.copy()
+        # 隣接する同一ブロックのラベルの小さい方を伝搬
+        left = new_labels[..., :, :-1]
+        np.minimum(left, np.where(eq_x, labels[..., :, 1:], sentinel), out=left)
+        right = new_labels[..., :, 1:]
+        np.minimum(right, np.where(eq_x, labels[..., :, :-1], sentinel), out=right)
+        up = new_labels[..., :-1, :]
+        np.minimum(up, np.where(eq_y, labels[..., 1:, :], sentinel), out=up)
+        down = new_labels[..., 1:, :]
+        np.minimum(down, np.where(eq_y, labels[..., :-1, :], sentinel), out=down)
+        # ラベルの指す先のラベルへ飛ぶ (pointer jumping) ことで反復回数を削減
+        new_labels = new_labels.reshape(-1)[new_labels]
+        if np.array_equal(new_labels, labels):
+            return labels
+        labels = new_labels
+
+
+def cluster_mask(board, threthold=cluster_thold):
+    "threthold個以上の同一ブロックが隣接したクラスターのマスク(床を除く)"
+    labels, occupied = cluster_labels(board)
+    sizes = np.bincount(labels.reshape(-1), minlength=labels.size)
+    return occupied & (sizes[labels] >= threthold)
+
+
+def find_cluster(board, threthold=cluster_thold):
+    "クラスターの座標を(x, y)の配列で取得"
+    return np.argwhere(cluster_mask(board, threthold))[:, ::-1]
+
+
+class NumpyTetrisEngine(TetrisEngine):
+    "ボードをndarrayで保持し、連鎖の各段階をベクトル演算で処理するエンジン"
+
+    # ボード全体のベクトル演算の方が速いため、差分判定は使わない
+    incremental = False
+
+    def init_game(self):
+        super().init_game()
+        self.board = np.array(self.board, dtype=board_dtype)
+
+    def get_bitboard(self):
+        if self.bitboard is None:
+            self.bitboard = board_masks_array(self.board)
+        return self.bitboard
+
+    def get_skyline(self):
+        if self.skyline is None:
+            self.skyline, self.filled = board_profile(self.board)
+        return self.skyline
+
+    # columns, cellsは差分判定用の引数 (ボード全体を配列演算で処理するため使わない)
+    def judge_can_settle(self, board, columns=None):
+        return bool(can_settle(board))
+
+    def settle_board(self, board, columns=None):
+        return settle_board(board)
+
+    def gate_exist(self, board):
+        active, hits = gate_masks(board)
+        return bool(active.any())
+
+    def operate_all_gates(self, board):
+        return operate_all_gates(board)
+
+    def find_cluster(self, board, threthold=None, cells=None):
+        if threthold is None:
+            threthold = self.cluster_thold
+        return find_cluster(board, threthold)
+
+    def remove_clusters(self, board, clusters):
+        board[clusters[:, 1], clusters[:, 0]] = 0
+        return board
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Opt-in frame profiler for the pygame and Tk front ends
+#
+# FrameProfiler times named phases of every frame. tetris_pygame wraps its
+# own phases in spans:
+#
+#   input    pygame.event.get() and the key actions
+#   drop     the drop timer, soft drop and instant drop
+#   cascade  advancing the cascade animation
+#   draw     drawing the changed cells and the panel
+#   present  pygame.display.update
+#   idle     waiting for the next frame (Clock.tick)
+#
+# instrument() replaces methods of one object (the engine, the app) with
+# timed wrappers, so the cascade phases (settle_board, operate_all_gates,
+# find_cluster, ...) and the drawing helpers (draw_matrix, render_line, ...)
+# appear nested inside the phase that called them. A phase's time includes
+# the phases nested in it.
+#
+# The overlay shows, over the last frame_window frames, the p50/p99 of the
+# frame interval and of the busy time (the interval without idle), and the
+# mean/p99 time per frame of every phase. write_trace() exports the spans as
+# Chrome trace-event JSON (chrome://tracing or https://ui.perfetto.dev).
+# Only the last max_trace_events spans are kept.
+#
+# Profiling is off unless a FrameProfiler is passed in. Otherwise
+# null_profiler is used: its spans are a shared no-op context manager and it
+# instruments nothing, so the engine runs unwrapped.
+#
+# The Tk version (tetris.py) uses the same spans for its key and timer
+# events, one frame per event: input, drop, cascade (one step of the chain
+# reaction), draw (TetrisCanvas.update) and idle (the time between events).
+# The TetrisField methods are instrumented like the engine's.
+#
+# Usage:
+#   python tetris_pygame.py --profile
+#   python tetris_pygame.py --trace frames.json
+#   python tetris_replay.py night.qtr --realtime --trace frames.json
+#   python tetris.py --trace frames.json
+
+import contextlib
+import functools
+import json
+import os
+import time
+from collections import deque
+
+from tetris_stats import percentile
+
+# 統計を取る直近のフレーム数と、トレースに残すスパンの最大数
+frame_window = 120
+max_trace_events = 500000
+
+# 計測するエンジンのメソッド (エンジンにないものは無視する)
+engine_phases = [
+    "judge_can_settle",
+    "settle_board",
+    "settle_cells",
+    "gate_exist",
+    "get_operator_target",
+    "operate_all_gates",
+    "operate_gates",
+    "find_cluster",
+    "remove_clusters",
+    "clear_cells",
+    "save_turn",
+    "restore",
+]
+
+
+class Span(object):
+    "FrameProfiler.spanのコンテキストマネージャ"
+
+    __slots__ = ("profiler", "name", "start")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        profiler = self.profiler
+        if self.name not in profiler.parents:
+            profiler.parents[self.name] = profiler.stack[-1] if profiler.stack else None
+        profiler.stack.append(self.name)
+        self.start = profiler.clock()
+
+    def __exit__(self, *exc):
+        profiler = self.profiler
+        end = profiler.clock()
+        profiler.stack.pop()
+        profiler.record(self.name, self.start, end - self.start)
+
+
+class FrameProfiler(object):
+    "フレームごとに各段階の所要時間を記録し、統計とChromeのトレースを出力"
+
+    enabled = True
+
+    def __init__(
+        self, trace_path=None, window=frame_window, clock=time.perf_counter_ns
+    ):
+        """trace_path: finish()でChromeのトレースを書き出すファイル名 (Noneなら書き出さない)
+        clock: 時刻(ns)を返す関数"""
+        self.trace_path = trace_path
+        self.clock = clock
+        self.origin = clock()
+        # 各フレームの (間隔(ns), idleを除いた時間(ns), 段階名 -> 時間(ns))
+        self.frames = deque(maxlen=window)
+        # トレースのスパン (名前, 開始時刻(ns), 時間(ns))
+        self.events = deque(maxlen=max_trace_events)
+        # 段階名 -> 最初に計測した時に外側で計測していた段階名 (表示の順番用)
+        self.parents = {}
+        # 計測中の段階名のスタック
+        self.stack = []
+        self.current = {}
+        self.frame_start = None
+
+    def span(self, name):
+        "with文の間をnameの段階として計測"
+        return Span(self, name)
+
+    def record(self, name, start, duration):
+        self.current[name] = self.current.get(name, 0) + duration
+        self.events.append((name, start, duration))
+
+    def wrap(self, name, func):
+        "呼び出しをnameの段階として計測する関数"
+
+        @functools.wraps(func)
+        def timed(*args, **kwargs):
+            with self.span(name):
+                return func(*args, **kwargs)
+
+        return timed
+
+    def instrument(self, obj, names):
+        "objのメソッドnamesを計測するものに置き換える (objにないものは無視)"
+        for name in names:
+            method = getattr(obj, name, None)
+            if callable(method):
+                setattr(obj, name, self.wrap(name, method))
+
+    def begin_frame(self):
+        "新しいフレームを開始 (前のフレームの記録を確定する)"
+        now = self.clock()
+        if self.frame_start is not None:
+            interval = now - self.frame_start
+            busy = interval - self.current.get("idle", 0)
+            self.frames.append((interval, busy, self.current))
+            self.events.append(("frame", self.frame_start, interval))
+            self.current = {}
+        self.frame_start = now
+
+    def frame_stats(self):
+        """直近のフレームの (間隔のp50, p99, idleを除いた時間のp50, p99) (ms)
+        フレームがなければNone"""
+        if not self.frames:
+            return None
+        intervals = sorted(frame[0] for frame in self.frames)
+        busy = sorted(frame[1] for frame in self.frames)
+        return tuple(
+            percentile(values, q) / 1e6
+            for values in (intervals, busy)
+            for q in (0.5, 0.99)
+        )
+
+    def phase_stats(self):
+        """直近のフレームでの各段階の (名前, 入れ子の深さ, 1フレームの平均(ms), p99(ms))
+        のリスト (段階がなかったフレームは0として数える)
+        外側の段階の直後にその中で計測した段階が並ぶ木の順番で出力"""
+        n = len(self.frames)
+        names = set()
+        for frame in self.frames:
+            names.update(frame[2])
+        children = {}
+        for name, parent in self.parents.items():
+            children.setdefault(parent, []).append(name)
+        stats = []
+        pending = [(name, 0) for name in reversed(children.get(None, []))]
+        while pending:
+            name, depth = pending.pop()
+            # 直近のフレームにない段階は省き、その中の段階を1段浅く表示
+            shown = name in names
+            pending += [
+                (child, depth + shown) for child in reversed(children.get(name, []))
+            ]
+            if not shown:
+                continue
+            values = sorted(frame[2].get(name, 0) for frame in self.frames)
+            stats.append(
+                (name, depth, sum(values) / n / 1e6, percentile(values, 0.99) / 1e6)
+            )
+        return stats
+
+    def report_rows(self):
+        "統計の表示用の (名前, 1列目, 2列目) の文字列の行のリスト (時間はms)"
+        frame = self.frame_stats()
+        if frame is None:
+            return [("no frames yet", "", "")]
+        rows = [
+            ("ms", "p50", "p99"),
+            ("frame", "%.2f" % frame[0], "%.2f" % frame[1]),
+            ("busy", "%.2f" % frame[2], "%.2f" % frame[3]),
+            ("phase", "mean", "p99"),
+        ]
+        for name, depth, mean, p99 in self.phase_stats():
+            rows.append(("  " * depth + name, "%.2f" % mean, "%.2f" % p99))
+        return rows
+
+    def report(self):
+        "統計の表示用の行のリスト"
+        return ["%-22s %7s %7s" % row for row in self.report_rows()]
+
+    def trace_events(self):
+        "Chromeのtrace event形式のイベントのリスト (時刻はµs)"
+        pid = os.getpid()
+        events = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": 0,
+                "args": {"name": "quantum tetris"},
+            }
+        ]
+        for name, start, duration in self.events:
+            events.append(
+                {
+                    "name": name,
+                    "cat": "frame" if name == "frame" else "phase",
+                    "ph": "X",
+                    "ts": (start - self.origin) / 1e3,
+                    "dur": duration / 1e3,
+                    "pid": pid,
+                    "tid": 0,
+                }
+            )
+        return events
+
+    def write_trace(self, path):
+        with open(path, "w") as f:
+            json.dump({"traceEvents": self.trace_events()}, f)
+
+    def finish(self):
+        "最後のフレームを確定し、指定があればトレースを書き出す"
+        self.begin_frame()
+        if self.trace_path is not None:
+            self.write_trace(self.trace_path)
+
+
+class NullProfiler(object):
+    "計測しない時のFrameProfilerの代わり (何もしない)"
+
+    enabled = False
+
+    def span(self, name):
+        return null_span
+
+    def instrument(self, obj, names):
+        pass
+
+    def begin_frame(self):
+        pass
+
+    def finish(self):
+        pass
+
+
+null_span = contextlib.nullcontext()
+null_profiler = NullProfiler()
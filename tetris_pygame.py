@@ -11,20 +11,68 @@
 #          P - Pause game
 #          O - Display board while pausing
 #     Return - Instant drop
+#          U - Undo the last stone
 #
 # Have fun!
-
+#
+# --record FILE appends a replay of the session to FILE (see tetris_replay).
+# --cols N, --rows N and --cluster-thold N change the board and rules. Cells
+# shrink (down to one pixel) so that large boards fit in the window.
+# --profile shows per-phase frame timings next to the board and
+# --trace FILE also writes them as a Chrome trace on exit (see tetris_profile).
+# --capture-png DIR or --capture-raw FILE writes every changed frame with its
+# time (see tetris_capture). Without a display (no DISPLAY/WAYLAND_DISPLAY,
+# e.g. on CI) a capture renders on the SDL dummy video driver instead of
+# failing to open the window; no keys can be pressed there, so the stone
+# just falls until the game is over. To capture a recorded game, use
+# tetris_replay --headless.
+
+import os
+import random
 import sys
-from random import randrange as rand
+from collections import deque
+
+# --capture-raw -では標準出力はフレーム専用にするため、pygameの起動メッセージを出さない
+if "--capture-raw" in sys.argv[1:]:
+    os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+
+
+def has_display():
+    "ウィンドウを開けるディスプレイがあるか (X11/Waylandの環境変数で判定)"
+    if sys.platform in ("win32", "darwin"):
+        return True
+    return bool(os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+
+
+# ディスプレイのない環境でのキャプチャはオフスクリーン (SDLのdummyドライバ) で描画
+if __name__ == "__main__" and not has_display():
+    if {"--capture-png", "--capture-raw"} & set(sys.argv[1:]):
+        os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
 
 import pygame
 
+from tetris_engine import TetrisEngine, default_config, drop_delay
+from tetris_capture import open_capture
+from tetris_profile import FrameProfiler, engine_phases, null_profiler
+from tetris_replay import (
+    ReplayRecorder,
+    apply_event,
+    engine_actions,
+    finish_cascade,
+)
+
 # The configuration
-cell_size = 18
-cols = 10
-rows = 22
+cell_size = 18  # セルの大きさ(px) (大きな盤面ではmax_board_sizeに収まるよう縮小)
+max_board_size = (1600, 900)  # 盤面を表示する最大の幅と高さ(px)
+min_label_size = 12  # セルにラベルを表示する最小のセルの大きさ(px)
+panel_width = cell_size * 6  # 右側のNextとスコア表示の幅(px)
+panel_height = cell_size * 22  # 右側の表示に必要な高さ(px)
 maxfps = 30
-cluster_thold = 3
+cascade_interval = 300  # 連鎖反応の1段階を表示する時間(ms)
+input_buffer_size = 32  # 連鎖反応中に受け付けて保留するキー入力の数
+show_ghost = True  # 落下中のストーンの着地位置を表示するか
+profile_width = 260  # 計測結果の表示の幅(px) (計測する時のみ)
+profile_interval = 500  # 計測結果の表示を更新する間隔(ms)
 
 colors = [
     "#B5B5B5",  # dark gray [background 1]
@@ -36,120 +84,159 @@ colors = [
     "#8ADAC0",  # light green [Z gate]
     "#F0B4DC",  # light pink [X gate]
     "#B5B5B5",  # "#DEDEDE",  # light gray [background 2]
+    "#A58BD8",  # purple [i state] (statevector mode)
+    "#D98BC0",  # magenta [-i state] (statevector mode)
+    "#A7D672",  # green [S gate] (statevector mode)
+    "#E6C15A",  # mustard [Y gate] (statevector mode)
+    "#E88A8A",  # salmon [T gate] (statevector mode)
+    "#9AA8E8",  # lavender [Rx gate] (statevector mode)
+    "#6E6E9E",  # slate [entangled qubit] (entangled mode)
 ]
-
-# Define the shapes of the single parts
-tetris_shapes = [
-    [[1, 1, 1], [0, 1, 0]],
-    [[0, 1, 1], [1, 1, 0]],
-    [[1, 1, 0], [0, 1, 1]],
-    [[1, 0, 0], [1, 1, 1]],
-    [[0, 0, 1], [1, 1, 1]],
-    [[1, 1, 1, 1]],
-    [[1, 1], [1, 1]],
+# 表示用グリッドでゴーストのセルは ブロックの値 + ghost_offset で表す
+ghost_offset = len(colors)
+# 1フレームで描き直したセルがこの数を超えたら盤面全体を1つの領域として反映
+max_update_rects = 64
+# 計測する時に時間を測る描画のメソッドと、"drop"として測る操作
+drawing_phases = [
+    "draw_frame",
+    "draw_changed_cells",
+    "draw_panel",
+    "draw_matrix",
+    "render_line",
+    "show_gameover",
 ]
-
-labels_dict = {
-    0: None,
-    1: "0",
-    2: "1",
-    3: "+",
-    4: "-",
-    5: "H",
-    6: "Z",
-    7: "X",
-}
-
-opperand_labels = ["0", "1", "+", "-"]
-opperator_labels = ["H", "Z", "X"]
-labels_dict_inv = {v: k for k, v in labels_dict.items()}
-
-
-def rotate_clockwise(shape):
-    return [
-        [shape[y][x] for y in range(len(shape))]
-        for x in range(len(shape[0]) - 1, -1, -1)
-    ]
-
-
-def check_collision(board, shape, offset):
-    off_x, off_y = offset
-    for cy, row in enumerate(shape):
-        for cx, cell in enumerate(row):
-            try:
-                if cell and board[cy + off_y][cx + off_x]:
-                    return True
-            except IndexError:
-                return True
-    return False
-
-
-def join_matrixes(mat1, mat2, mat2_off):
-    off_x, off_y = mat2_off
-    for cy, row in enumerate(mat2):
-        for cx, val in enumerate(row):
-            mat1[cy + off_y - 1][cx + off_x] += val
-    return mat1
-
-
-def new_board():
-    board = [[0 for x in range(cols)] for y in range(rows)]
-    board += [[1 for x in range(cols)]]
-    return board
+drop_actions = {"tick", "down", "drop"}
+
+
+def fit_cell_size(cols, rows):
+    "幅cols, 高さrowsの盤面がmax_board_sizeに収まるセルの大きさ(px)"
+    max_width, max_height = max_board_size
+    return max(1, min(cell_size, max_width // cols, max_height // rows))
+
+
+class CascadeAnimation(object):
+    "連鎖反応を一定間隔ごとに1段階ずつ進める (描画・イベントループは止めない)"
+
+    def __init__(self, engine, interval=None):
+        self.engine = engine
+        self.interval = cascade_interval if interval is None else interval
+        # 次の段階に進む時刻 (Noneは連鎖の開始待ち)
+        self.next_time = None
+
+    def update(self, now):
+        "時刻now(ms)に進めるべき段階があれば1段階進める"
+        engine = self.engine
+        if not engine.board_updating:
+            self.next_time = None
+            return
+        if engine.paused:
+            return
+        # ストーンが着地した状態を1段階分表示してから連鎖を始める
+        if self.next_time is None:
+            self.next_time = now + self.interval
+            return
+        if now < self.next_time:
+            return
+        if engine.update_board() is None:
+            self.next_time = None
+        else:
+            self.next_time = now + self.interval
 
 
 class TetrisApp(object):
-    def __init__(self):
+    def __init__(
+        self,
+        engine_factory=TetrisEngine,
+        seed=None,
+        record=None,
+        config=default_config,
+        profiler=None,
+    ):
+        """engine_factory(on_level_change=..., seed=..., config=...)でゲームのエンジンを作成
+        record: 操作を記録するリプレイのファイル名 (追記する)
+        config: 盤面の大きさとルール (tetris_engine.TetrisConfig)
+        profiler: 各段階の時間を計測して表示するtetris_profile.FrameProfiler"""
         pygame.init()
         pygame.key.set_repeat(250, 25)
-        self.width = cell_size * (cols + 6)
-        self.height = cell_size * rows
-        self.rlim = cell_size * cols
-        self.bground_grid = [
-            [8 if x % 2 == y % 2 else 0 for x in range(cols)] for y in range(rows)
-        ]
+        # ゲームのルールと状態はエンジンが管理し、このクラスは描画と入力のみを担当
+        if record is not None and seed is None:
+            # 記録したゲームを再現できるようにseedを決めておく
+            seed = random.randrange(1 << 32)
+        self.engine = engine_factory(
+            on_level_change=self.set_drop_timer, seed=seed, config=config
+        )
+        # 画面の大きさはエンジンの盤面の大きさから決める
+        cols, rows = self.engine.cols, self.engine.rows
+        self.cell = fit_cell_size(cols, rows)
+        self.rlim = self.cell * cols
+        self.board_height = self.cell * rows
+        self.width = self.rlim + panel_width
+        self.height = max(self.board_height, panel_height)
+        self.profiler = null_profiler if profiler is None else profiler
+        if self.profiler.enabled:
+            self.width += profile_width
 
         self.default_font = pygame.font.SysFont("arial", 12)
         self.screen = pygame.display.set_mode((self.width, self.height))
+        self.recorder = None
+        if record is not None:
+            self.recorder = ReplayRecorder(
+                self.engine, open(record, "ab"), pygame.time.get_ticks()
+            )
+        # 描画のたびにフォントを描画しないよう、セルと背景の画像を事前に作成
+        # (Nextの表示は盤面のセルを縮小しても元の大きさで描く)
+        self.cell_sprites = self.make_sprites(self.cell)
+        self.panel_sprites = (
+            self.cell_sprites
+            if self.cell == cell_size
+            else self.make_sprites(cell_size)
+        )
+        self.background = self.make_background()
+        self.text_cache = {}
+        # 差分描画の対象領域と、前回画面に反映した内容
+        self.next_rect = pygame.Rect(
+            self.rlim + cell_size, 2 * cell_size, 4 * cell_size, 2 * cell_size
+        )
+        self.score_rect = pygame.Rect(
+            self.rlim + cell_size,
+            cell_size * 5,
+            self.width - self.rlim - cell_size,
+            14 * 5,
+        )
+        self.full_redraw = True
+        # 変化したフレームを書き出すtetris_capture.FrameCapture (Noneなら書き出さない)
+        # frame_timeはフレームの時刻(ms)、capture_pendingは前回キューが一杯で捨てたか
+        self.capture = None
+        self.capture_pending = False
+        self.frame_time = 0
+        if self.profiler.enabled:
+            self.profile_rect = pygame.Rect(
+                self.width - profile_width + 8, 2, profile_width - 8, self.height - 2
+            )
+            self.profiler.instrument(self.engine, engine_phases)
+            self.profiler.instrument(self, drawing_phases)
 
         # We do not need mouse movement  events, so we block them.
         pygame.event.set_blocked(pygame.MOUSEMOTION)
-        self.next_stone = tetris_shapes[rand(len(tetris_shapes))]
-        self.next_stone = [
-            [rand(1, +len(tetris_shapes) + 1) if i != 0 else 0 for i in col]
-            for col in self.next_stone
-        ]
-        self.init_game()
-
-    def new_stone(self):
-        self.stone = self.next_stone[:]
-
-        self.next_stone = tetris_shapes[rand(len(tetris_shapes))]
-        self.next_stone = [
-            [rand(1, len(tetris_shapes) + 1) if i != 0 else 0 for i in col]
-            for col in self.next_stone
-        ]
-        self.stone_x = int(cols / 2 - len(self.stone[0]) / 2)
-        self.stone_y = 0
-
-        if check_collision(self.board, self.stone, (self.stone_x, self.stone_y)):
-            self.gameover = True
-
-    def init_game(self):
-        self.board = new_board()
-        self.new_stone()
-        self.level = 1
-        self.score = 0
-        self.lines = 0
-        pygame.time.set_timer(pygame.USEREVENT + 1, 1000)
+
+    def set_drop_timer(self, level):
+        "レベルに応じて自動落下タイマーを設定"
+        pygame.time.set_timer(pygame.USEREVENT + 1, drop_delay(level))
+
+    def render_line(self, line):
+        "メッセージ1行の画像 (同じ文字列は再描画しない)"
+        text = self.text_cache.get(line)
+        if text is None:
+            if len(self.text_cache) > 256:
+                self.text_cache.clear()
+            text = self.default_font.render(line, False, (255, 255, 255), (0, 0, 0))
+            self.text_cache[line] = text
+        return text
 
     def disp_msg(self, msg, topleft):
         x, y = topleft
         for line in msg.splitlines():
-            self.screen.blit(
-                self.default_font.render(line, False, (255, 255, 255), (0, 0, 0)),
-                (x, y),
-            )
+            self.screen.blit(self.render_line(line), (x, y))
             y += 14
 
     def center_msg(self, msg):
@@ -170,351 +257,438 @@ class TetrisApp(object):
                 ),
             )
 
-    def judge_can_settle(self, board):
-        "ボード上の全ブロックのうちいずれかが下に移動できるか判定"
-        can_fall = False
-        for y in range(rows - 2, 0, -1):
-            for x in range(cols):
-                if (board[y][x] != 0) and (board[y + 1][x] == 0):
-                    can_fall = True
-                    break
-        return can_fall
-
-    def settle_board(self, board):
-        """クラスター削除後に浮いたブロックを落下"""
-        for x in range(cols):
-            for y in range(rows - 2, 0, -1):
-                if board[y][x] == 0:
-                    continue
-                # ブロックの下にスペースがあれば落としていく
-                for down_y in range(y + 1, rows):
-                    if board[down_y][x] == 0:
-                        board[down_y][x] = board[down_y - 1][x]
-                        board[down_y - 1][x] = 0
-                    else:
-                        break
-        return board
-
-    def get_operator_target(self, board):
-        "ゲートの(位置,種類)とターゲットの(位置,種類)ペアを取得"
-        # ゲートの真下のみ作用する仕様へ変更
-        operator_target_dict = {}
-        for y in range(rows):
-            for x in range(cols):
-                gate_type = labels_dict[board[y][x]]
-                if gate_type not in opperator_labels:
-                    continue
-                # ゲートの下側のみ作用する場合はリストサイズ1 (現行の挙動),
-                # 左右にも作用する場合は最大リストサイズ3 (将来の拡張用)
-                operands = []
-                # 下端の場合以外、下側に量子状態ブロックがあるかチェック
-                if y != rows - 1:
-                    qstate = labels_dict[board[y + 1][x]]
-                    if qstate in opperand_labels:
-                        operands.append((x, y + 1, qstate))
-                # 下端に接したゲートと量子状態に接したゲートは削除対象
-                if (y == rows - 1) or (len(operands) > 0):
-                    operator_target_dict[(x, y, gate_type)] = operands
-
-        return operator_target_dict
-
-    def gate_exist(self, board):
-        "フィールド上にゲートブロックが存在するか"
-        return len(self.get_operator_target(board)) > 0
-
-    def operate_gate(self, board, operator, targets):
-        "targetブロックにoperatorを作用"
-        # operator: ()
-        operator_x, operator_y, gate_type = operator
-
-        if gate_type == "H":
-            qstate_transition_dict = {"0": "+", "1": "-", "+": "0", "-": "1"}
-        elif gate_type == "X":
-            # 0 <-> 1
-            qstate_transition_dict = {"0": "1", "1": "0", "+": "+", "-": "-"}
-        elif gate_type == "Z":
-            qstate_transition_dict = {"0": "0", "1": "1", "+": "-", "-": "+"}
-
-        for target in targets:
-            target_x, target_y, qstate_pre = target
-            # targetの量子状態を更新
-            qstate_post = qstate_transition_dict[qstate_pre]
-            board[target_y][target_x] = labels_dict_inv[qstate_post]
-
-        # ゲートブロックの削除
-        board[operator_y][operator_x] = 0
-
-        return board
-
-    def operate_all_gates(self, board):
-        "ゲート処理を実行"
-        for operator, opperands in self.get_operator_target(board).items():
-            self.operate_gate(board, operator, opperands)
-        return board
-
-    def find_idential_adjacent(self, board, x, y):
-        """対象の座標(x,y)の隣接に同一ブロックがないかをチェック
-        クラスター候補となる座標のsetを出力"""
-        set_cluster_xy = {(x, y)}
-        while True:
-            pre_set_cluster_xy = set_cluster_xy.copy()
-            for xx, yy in pre_set_cluster_xy:
-                # 左端の場合以外で左側のブロック比較
-                if (xx != 0) and (board[yy][xx] == board[yy][xx - 1]):
-                    set_cluster_xy.add((xx - 1, yy))
-                # 右端の場合以外で右側のブロック比較
-                if (xx != cols - 1) and (board[yy][xx] == board[yy][xx + 1]):
-                    set_cluster_xy.add((xx + 1, yy))
-                # 上端の場合以外で上側のブロック比較
-                if (yy != 0) and (board[yy][xx] == board[yy - 1][xx]):
-                    set_cluster_xy.add((xx, yy - 1))
-                # 下端の場合以外で下側のブロック比較
-                if (yy != rows - 1) and (board[yy][xx] == board[yy + 1][xx]):
-                    set_cluster_xy.add((xx, yy + 1))
-            if len(pre_set_cluster_xy) == len(set_cluster_xy):
-                break
-
-        return set_cluster_xy
-
-    def find_cluster(self, board, threthold=cluster_thold):
-        """cluster_tholdをクラスター判定の基準とし、同一ブロックが隣接した全座標setを出力"""
-        clusters_cordinates = set()
-        for x in range(cols):
-            for y in range(rows):
-                if (board[y][x] == 0) or ((x, y) in clusters_cordinates):
-                    continue
-                else:
-                    cluster_candidate = self.find_idential_adjacent(board, x, y)
-                    if len(cluster_candidate) >= threthold:
-                        clusters_cordinates.update(cluster_candidate)
-        return clusters_cordinates
-
-    def delete_clusters(self, board, clusters):
-        """クラスターを削除"""
-        for x, y in clusters:
-            board[y][x] = 0
-            self.add_cl_clusters(1)
-        return board
-
-    def draw_matrix(self, matrix, offset):
-        off_x, off_y = offset
-        for y, row in enumerate(matrix):
-            for x, val in enumerate(row):
-
-                if val != 0:
-                    val_rec = val
-                elif (val == 0) and (off_x < cols):
-                    val_rec = self.bground_grid[off_y + y][off_x + x]
-                else:
-                    continue
-
-                pygame.draw.rect(
-                    self.screen,
-                    colors[val_rec],
-                    pygame.Rect(
-                        (off_x + x) * cell_size,
-                        (off_y + y) * cell_size,
-                        cell_size,
-                        cell_size,
-                    ),
-                    0,  # ここを4にしたら枠線になる
-                )
-
-                pygame.draw.rect(
-                    self.screen,
-                    (100, 100, 100),
-                    pygame.Rect(
-                        (off_x + x) * cell_size,
-                        (off_y + y) * cell_size,
-                        cell_size,
-                        cell_size,
-                    ),
-                    1,  # ここを4にしたら枠線になる
-                )
-
-                if val in labels_dict:
-                    text = self.default_font.render(labels_dict[val], True, "white")
-                    text_rect = text.get_rect(
-                        center=(
-                            (off_x + x + 0.5) * cell_size,
-                            (off_y + y + 0.5) * cell_size,
-                        )
-                    )
-                    self.screen.blit(text, text_rect)
-                    # self.screen.blit(
-                    #     self.default_font.render(
-                    #         labels_dict[val], True, "white"
-                    #     ),
-                    #     ((off_x + x) * cell_size, (off_y + y) * cell_size),
-                    # )
-
-    def update_matrix(self, show_stone=False, wait=True, update_score=False):
-        "連鎖反応時の逐次画面更新"
-        self.draw_matrix(self.bground_grid, (0, 0))
-        self.draw_matrix(self.board, (0, 0))
-        self.draw_matrix(self.next_stone, (cols + 1, 2))
+    def make_sprites(self, size):
+        "大きさsize(px)の全てのブロックの値とゴーストのセル画像のリスト"
+        sprites = [self.make_cell_sprite(val, size) for val in range(len(colors))]
+        sprites += [self.make_ghost_sprite(val, size) for val in range(len(colors))]
+        return sprites
+
+    def make_cell_sprite(self, val, size=cell_size):
+        """ブロックの値ごとのセル画像 (塗り, 枠線, ラベル) を作成
+        (小さなセルでは枠線とラベルを省く)"""
+        sprite = pygame.Surface((size, size)).convert()
+        sprite.fill(colors[val])
+        if size >= 4:
+            pygame.draw.rect(sprite, (100, 100, 100), sprite.get_rect(), 1)
+        label = self.engine.labels.get(val)
+        if label is not None and size >= min_label_size:
+            text = self.default_font.render(label, True, "white")
+            sprite.blit(text, text.get_rect(center=sprite.get_rect().center))
+        return sprite
+
+    def make_ghost_sprite(self, val, size=cell_size):
+        "ゴースト用のセル画像 (背景色にブロックの色の枠線)"
+        sprite = pygame.Surface((size, size)).convert()
+        sprite.fill(colors[0])
+        pygame.draw.rect(sprite, colors[val], sprite.get_rect(), min(2, size))
+        return sprite
+
+    def make_background(self):
+        """市松模様の背景を1枚の画像として合成
+        (模様は2行ごとの繰り返しなので、2行分を描いてから縦に並べる)"""
+        cols, rows = self.engine.cols, self.engine.rows
+        cell = self.cell
+        background = pygame.Surface((self.rlim, self.board_height)).convert()
+        background.blits(
+            [
+                (self.cell_sprites[8 if x % 2 == y % 2 else 0], (x * cell, y * cell))
+                for y in range(2)
+                for x in range(cols)
+            ],
+            False,
+        )
+        strip = background.subsurface((0, 0, self.rlim, 2 * cell)).copy()
+        background.blits([(strip, (0, y * cell)) for y in range(2, rows, 2)], False)
+        return background
+
+    def draw_matrix(self, matrix, topleft):
+        "値が0でないセルの画像を左上の位置topleft(px)から描画 (空セルは背景のまま)"
+        left, top = topleft
+        sprites = self.panel_sprites
+        self.screen.blits(
+            [
+                (sprites[val], (left + x * cell_size, top + y * cell_size))
+                for y, row in enumerate(matrix)
+                for x, val in enumerate(row)
+                if val != 0
+            ],
+            False,
+        )
+
+    def draw_frame(self):
+        "画面全体を描き直す (開始時とゲームオーバーからの復帰時)"
+        self.screen.fill((0, 0, 0))
+        self.screen.blit(self.background, (0, 0))
+        pygame.draw.line(
+            self.screen,
+            (255, 255, 255),
+            (self.rlim + 1, 0),
+            (self.rlim + 1, self.height - 1),
+        )
+        if self.profiler.enabled:
+            x = self.profile_rect.left - 7
+            pygame.draw.line(self.screen, (255, 255, 255), (x, 0), (x, self.height - 1))
+        self.disp_msg("Next:", (self.rlim + cell_size, 2))
+        self.disp_msg(
+            "Esc:   quit\nUp :   rotate\np   :   pause \nEnt:  drop",
+            (self.rlim + cell_size, cell_size * 18),
+        )
+        # 背景だけが描かれた状態を前回の表示とする
+        engine = self.engine
+        self.shown_view = [[0] * engine.cols for _ in range(engine.rows)]
+        self.shown_board = None
+        self.shown_overlay = {}
+        self.shown_next = None
+        self.shown_score = None
+        self.shown_profile = None
+        self.full_redraw = False
+        return [self.screen.get_rect()]
+
+    def compose_overlay(self, show_stone):
+        "ボードに重ねる落下中のストーンとその着地位置のゴーストの {(x, y): 表示する値}"
+        engine = self.engine
+        board = engine.board
+        cols, rows = engine.cols, engine.rows
+        overlay = {}
+        if show_stone and show_ghost:
+            ghost_y = engine.landing_y()
+            for cy, row in enumerate(engine.stone):
+                for cx, val in enumerate(row):
+                    y = ghost_y + cy
+                    x = engine.stone_x + cx
+                    if val != 0 and 0 <= y < rows and board[y][x] == 0:
+                        overlay[x, y] = val + ghost_offset
         if show_stone:
-            self.draw_matrix(self.stone, (self.stone_x, self.stone_y))
-
-        if update_score:
-            self.disp_msg(
-                "Score: %d\n\nLevel: %d\nDeleted: %d"
-                % (self.score, self.level, self.lines),
-                (self.rlim + cell_size, cell_size * 5),
-            )
+            for cy, row in enumerate(engine.stone):
+                for cx, val in enumerate(row):
+                    y = engine.stone_y + cy
+                    x = engine.stone_x + cx
+                    if val != 0 and 0 <= y < rows and 0 <= x < cols:
+                        overlay[x, y] = val
+        return overlay
+
+    def changed_board_cells(self):
+        """前回の描画からボードの値が変化したセルの座標のリスト
+        行ごとに比較して変化した行だけを調べるため、盤面が大きくても変化が少なければ速い"""
+        engine = self.engine
+        board = engine.board
+        cols, rows = engine.cols, engine.rows
+        shown = self.shown_board
+        if hasattr(board, "shape"):
+            # ndarrayのボード (tetris_numpyなど) は配列演算で比較する
+            if shown is None:
+                shown = self.shown_board = board[:rows].copy()
+                shown.fill(0)
+            changed = (board[:rows] != shown).any(axis=1).nonzero()[0]
+            cells = [
+                (x, y)
+                for y in changed.tolist()
+                for x in (board[y] != shown[y]).nonzero()[0].tolist()
+            ]
+            shown[changed] = board[changed]
+            return cells
+        if shown is None:
+            shown = self.shown_board = [[0] * cols for _ in range(rows)]
+        cells = []
+        for y in range(rows):
+            row = board[y]
+            old = shown[y]
+            if row != old:
+                cells.extend((x, y) for x in range(cols) if row[x] != old[x])
+                shown[y] = row[:]
+        return cells
+
+    def draw_changed_cells(self, overlay):
+        """ボードにoverlayを重ねた表示のうち、前回の表示から変化したセルだけを描き直し、
+        画面に反映するRectのリストを出力"""
+        board = self.engine.board
+        view = self.shown_view
+        cell = self.cell
+        cells = set(self.changed_board_cells())
+        cells.update(self.shown_overlay)
+        cells.update(overlay)
+        rects = []
+        for x, y in cells:
+            val = overlay.get((x, y))
+            if val is None:
+                val = int(board[y][x])
+            if val == view[y][x]:
+                continue
+            view[y][x] = val
+            rect = pygame.Rect(x * cell, y * cell, cell, cell)
+            self.screen.blit(self.background, rect, rect)
+            if val != 0:
+                self.screen.blit(self.cell_sprites[val], rect)
+            rects.append(rect)
+        self.shown_overlay = overlay
+        if len(rects) > max_update_rects:
+            rects = [pygame.Rect(0, 0, self.rlim, self.board_height)]
+        return rects
+
+    def draw_panel(self):
+        "右側のNextとスコア表示のうち、変化した部分だけを描き直す"
+        engine = self.engine
+        rects = []
+        if engine.next_stone != self.shown_next:
+            rect = self.next_rect
+            self.screen.fill((0, 0, 0), rect)
+            self.draw_matrix(engine.next_stone, rect.topleft)
+            self.shown_next = [list(row) for row in engine.next_stone]
+            rects.append(rect)
+        score = "Score: %d\n\nLevel: %d\nDeleted: %d\nMax Chain: %d" % (
+            engine.score,
+            engine.level,
+            engine.lines,
+            engine.max_chain,
+        )
+        if score != self.shown_score:
+            rect = self.score_rect
+            self.screen.fill((0, 0, 0), rect)
+            self.disp_msg(score, rect.topleft)
+            self.shown_score = score
+            rects.append(rect)
+        return rects
+
+    def draw_profile(self):
+        "計測結果の表示を一定間隔ごとに描き直す (計測しない時は何もしない)"
+        if not self.profiler.enabled:
+            return []
+        now = pygame.time.get_ticks()
+        if (
+            self.shown_profile is not None
+            and now - self.shown_profile < profile_interval
+        ):
+            return []
+        self.shown_profile = now
+        rect = self.profile_rect
+        self.screen.fill((0, 0, 0), rect)
+        rows = self.profiler.report_rows()[: rect.height // 14]
+        for i, (name, first, second) in enumerate(rows):
+            y = rect.top + i * 14
+            self.screen.blit(self.render_profile(name), (rect.left, y))
+            for text, right in ((first, rect.right - 60), (second, rect.right - 8)):
+                image = self.render_profile(text)
+                self.screen.blit(image, image.get_rect(topright=(right, y)))
+        return [rect]
+
+    def render_profile(self, text):
+        "計測結果の1項目の画像 (値は毎回変わるのでキャッシュしない)"
+        return self.default_font.render(text, False, (255, 255, 255), (0, 0, 0))
+
+    def update_matrix(self, show_stone=False):
+        "前回から変化した部分だけを描画して画面に反映"
+        with self.profiler.span("draw"):
+            rects = self.draw_frame() if self.full_redraw else []
+            rects += self.draw_changed_cells(self.compose_overlay(show_stone))
+            rects += self.draw_panel()
+            rects += self.draw_profile()
+        if rects:
+            with self.profiler.span("present"):
+                pygame.display.update(rects)
+        self.capture_frame(bool(rects))
+
+    def capture_frame(self, presented):
+        """画面に反映した内容があればフレームとして書き出す
+        (前回キューが一杯で捨てた場合は変化がなくても書き出す)"""
+        if self.capture is None or not (presented or self.capture_pending):
+            return
+        with self.profiler.span("capture"):
+            self.capture_pending = not self.capture.add(self.screen, self.frame_time)
+
+    def close_capture(self):
+        "最後に捨てたフレームがあれば待って書き出し、キャプチャを終了"
+        if self.capture_pending:
+            self.capture.add(self.screen, self.frame_time, block=True)
+            self.capture_pending = False
+        self.capture.close()
+
+    def show_gameover(self):
+        "ゲームオーバー画面を表示 (表示済みなら何もしない)"
+        if self.full_redraw:
+            return
+        self.screen.fill((0, 0, 0))
+        self.center_msg(
+            """Game Over!\nYour score: %d\nPress space to continue\nor u to undo"""
+            % self.engine.score
+        )
         pygame.display.update()
-        if wait:
-            pygame.time.wait(300)
-            pygame.event.clear()
-
-    def add_cl_clusters(self, n):
-        self.lines += n
-        self.score += n * self.level
-        if self.lines >= self.level * 6:
-            self.level += 1
-            newdelay = 1000 - 50 * (self.level - 1)
-            newdelay = 100 if newdelay < 100 else newdelay
-            pygame.time.set_timer(pygame.USEREVENT + 1, newdelay)
-
-    def move(self, delta_x):
-        if not self.gameover and not self.paused:
-            new_x = self.stone_x + delta_x
-            if new_x < 0:
-                new_x = 0
-            if new_x > cols - len(self.stone[0]):
-                new_x = cols - len(self.stone[0])
-            if not check_collision(self.board, self.stone, (new_x, self.stone_y)):
-                self.stone_x = new_x
+        self.capture_frame(True)
+        # ゲーム再開時には画面全体を描き直す
+        self.full_redraw = True
 
     def quit(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder.stream.close()
+        if self.capture is not None:
+            self.close_capture()
+        if self.profiler.enabled:
+            self.profiler.finish()
+            print("\n".join(self.profiler.report()), file=sys.stderr)
         self.center_msg("Exiting...")
         pygame.display.update()
         sys.exit()
 
-    def drop(self, manual):
-        if not self.gameover and not self.paused:
-            self.score += 1 if manual else 0
-            self.stone_y += 1
-            if check_collision(self.board, self.stone, (self.stone_x, self.stone_y)):
-                self.board = join_matrixes(
-                    self.board, self.stone, (self.stone_x, self.stone_y)
-                )
-                self.new_stone()
-                self.board_updating = True
-                cleared_rows = 0
-
-                self.add_cl_clusters(cleared_rows)
-                return True
-        return False
-
-    def insta_drop(self):
-        if not self.gameover and not self.paused:
-            while not self.drop(True):
-                pass
-
-    def rotate_stone(self):
-        if not self.gameover and not self.paused:
-            new_stone = rotate_clockwise(self.stone)
-            if not check_collision(self.board, new_stone, (self.stone_x, self.stone_y)):
-                self.stone = new_stone
-
-    def toggle_pause(self):
-        self.paused = not self.paused
-
-    def start_game(self):
-        if self.gameover:
-            self.init_game()
-            self.gameover = False
-
     def run(self):
+        engine = self.engine
+        # 操作名 -> 処理 (操作名はリプレイに記録する名前)
+        actions = engine_actions(engine)
+        actions["quit"] = self.quit
         key_actions = {
-            "ESCAPE": self.quit,
-            "LEFT": lambda: self.move(-1),
-            "RIGHT": lambda: self.move(+1),
-            "DOWN": lambda: self.drop(True),
-            "UP": self.rotate_stone,
-            "p": self.toggle_pause,
-            "SPACE": self.start_game,
-            "RETURN": self.insta_drop,
+            "ESCAPE": "quit",
+            "LEFT": "left",
+            "RIGHT": "right",
+            "DOWN": "down",
+            "UP": "rotate",
+            "p": "pause",
+            "SPACE": "start",
+            "RETURN": "drop",
+            "u": "undo",
         }
+        key_actions = {
+            getattr(pygame, "K_" + key): name for key, name in key_actions.items()
+        }
+
+        span = self.profiler.span
 
-        self.gameover = False
-        self.paused = False
-        # self.paused_display = False
-        self.board_updating = False
-        self.max_chain = 0
+        def dispatch(name):
+            # 連鎖中のundoは何もしないので記録しない (再生では連鎖を終えてから実行するため)
+            if self.recorder is not None and (name != "undo" or engine.can_undo()):
+                self.recorder.record(name, pygame.time.get_ticks())
+            with span("drop" if name in drop_actions else "input"):
+                actions[name]()
+
+        # 連鎖反応中でもすぐに処理するキー (undoは連鎖中には保留せず無視される)
+        immediate_keys = {pygame.K_ESCAPE, pygame.K_p, pygame.K_SPACE, pygame.K_u}
+        # 連鎖反応中のストーン操作は保留し、連鎖が終わってから順に処理
+        input_buffer = deque(maxlen=input_buffer_size)
+        animation = CascadeAnimation(engine)
 
         dont_burn_my_cpu = pygame.time.Clock()
+        start = pygame.time.get_ticks()
         while 1:
-            self.screen.fill((0, 0, 0))
-            if self.gameover:
-                self.center_msg(
-                    """Game Over!\nYour score: %d\nPress space to continue"""
-                    % self.score
-                )
+            self.profiler.begin_frame()
+            self.frame_time = pygame.time.get_ticks() - start
+            if engine.gameover:
+                self.show_gameover()
             else:
-                pygame.draw.line(
-                    self.screen,
-                    (255, 255, 255),
-                    (self.rlim + 1, 0),
-                    (self.rlim + 1, self.height - 1),
-                )
-                self.disp_msg("Next:", (self.rlim + cell_size, 2))
-                self.disp_msg(
-                    "Score: %d\n\nLevel: %d\nDeleted: %d\nMax Chain: %d"
-                    % (self.score, self.level, self.lines, self.max_chain),
-                    (self.rlim + cell_size, cell_size * 5),
-                )
-                self.disp_msg(
-                    "Esc:   quit\nUp :   rotate\np   :   pause \nEnt:  drop",
-                    (self.rlim + cell_size, cell_size * 18),
-                )
-                # 落下中のストーンがボードの一部となった時にwhileループが始動
-                chain = 0
-                while self.board_updating:
-                    self.update_matrix(show_stone=False, wait=True)
-                    # ブロック落下の処理
-                    if self.judge_can_settle(self.board):
-                        self.board = self.settle_board(self.board)
-                        self.update_matrix(show_stone=False, wait=True)
-                    # ゲートブロックの存在を確認
-                    elif self.gate_exist(self.board):
-                        self.board = self.operate_all_gates(self.board)
-                        self.update_matrix(show_stone=False, wait=True)
-                    # 同じブロックが隣接しているクラスターの存在を確認
-                    elif len(self.find_cluster(self.board)) > 0:
-                        clusters = self.find_cluster(self.board)
-                        self.board = self.delete_clusters(self.board, clusters)
-                        chain += 1
-                        self.max_chain = max(self.max_chain, chain)
-                        self.update_matrix(
-                            show_stone=False, wait=True, update_score=True
-                        )
-                    # ボードの更新が終わったら次のブロックを表示
-                    else:
-                        self.board_updating = False
-                        self.update_matrix(show_stone=True, wait=False)
-                        break
+                with span("cascade"):
+                    animation.update(pygame.time.get_ticks())
+                self.update_matrix(show_stone=not engine.board_updating)
 
-                self.update_matrix(show_stone=True, wait=False)
-
-            pygame.display.update()
-            # print(len(pygame.event.get()))
-            for event in pygame.event.get():
+            with span("input"):
+                events = pygame.event.get()
+            for event in events:
                 if event.type == pygame.USEREVENT + 1:
-                    self.drop(False)
+                    # 操作できない間の自動落下は何もしないので記録しない
+                    if engine.can_operate():
+                        dispatch("tick")
                 elif event.type == pygame.QUIT:
-                    self.quit()
-                elif event.type == pygame.KEYDOWN:
-                    for key in key_actions:
-                        if event.key == eval("pygame.K_" + key):
-                            key_actions[key]()
+                    dispatch("quit")
+                elif event.type == pygame.KEYDOWN and event.key in key_actions:
+                    if engine.board_updating and event.key not in immediate_keys:
+                        input_buffer.append(event.key)
                     else:
-                        break
-
-            dont_burn_my_cpu.tick(maxfps)
+                        dispatch(key_actions[event.key])
+
+            # 保留した入力は、新たな連鎖が始まるまで順に処理
+            while input_buffer and not engine.board_updating:
+                dispatch(key_actions[input_buffer.popleft()])
+
+            with span("idle"):
+                dont_burn_my_cpu.tick(maxfps)
+
+    def play_replay(self, replay, speed=1.0, fixed_step=False):
+        """tetris_replayのReplayを実時間(のspeed倍)で再生して描画
+        (エンジンはreplayのヘッダーで作成しておく。EscapeかウィンドウのQUITで終了)
+        fixed_step: 待たずに1フレームごとに1/maxfps秒ずつ時間を進める (画面のない環境用)
+        最後のイベントの後は連鎖の表示が終わるまで描画する"""
+        engine = self.engine
+        actions = engine_actions(engine)
+        animation = CascadeAnimation(engine, cascade_interval / speed)
+        span = self.profiler.span
+        # 自動落下は記録した"tick"で再現する
+        pygame.time.set_timer(pygame.USEREVENT + 1, 0)
+        start = pygame.time.get_ticks()
+        dont_burn_my_cpu = pygame.time.Clock()
+        events = iter(replay.events)
+        event = next(events, None)
+        frame = 0
+        while event is not None or (
+            engine.board_updating and not engine.paused and not engine.gameover
+        ):
+            self.profiler.begin_frame()
+            if fixed_step:
+                now = start + frame * 1000 / maxfps
+                frame += 1
+            else:
+                now = pygame.time.get_ticks()
+            self.frame_time = int((now - start) * speed)
+            # 時刻になったイベントを実行 (連鎖の表示が遅れていれば先に終える)
+            while event is not None and event[0] <= (now - start) * speed:
+                # 操作の前に終える連鎖の残りは、操作の時間に含めない
+                if event[1] != "piece":
+                    with span("cascade"):
+                        finish_cascade(engine)
+                with span("drop" if event[1] in drop_actions else "input"):
+                    apply_event(engine, actions, event[1], event[2])
+                event = next(events, None)
+            if engine.gameover:
+                self.show_gameover()
+            else:
+                with span("cascade"):
+                    animation.update(now)
+                self.update_matrix(show_stone=not engine.board_updating)
+            with span("input"):
+                window_events = pygame.event.get()
+            for e in window_events:
+                if e.type == pygame.QUIT or (
+                    e.type == pygame.KEYDOWN and e.key == pygame.K_ESCAPE
+                ):
+                    return engine
+            if not fixed_step:
+                with span("idle"):
+                    dont_burn_my_cpu.tick(maxfps)
+        # 連鎖が終わった状態を表示
+        if engine.gameover:
+            self.show_gameover()
+        else:
+            self.update_matrix(show_stone=not engine.board_updating)
+        return engine
 
 
 if __name__ == "__main__":
-    App = TetrisApp()
+    engine_factory = TetrisEngine
+    if "--statevector" in sys.argv[1:]:
+        # 振幅で量子状態を扱うモード (numpyが必要)
+        from tetris_quantum import StatevectorTetrisEngine
+
+        engine_factory = StatevectorTetrisEngine
+    elif "--entangled" in sys.argv[1:]:
+        # エンタングルしたストーンが出るモード (numpyが必要)
+        from tetris_entangled import EntangledTetrisEngine
+
+        engine_factory = EntangledTetrisEngine
+    record = None
+    if "--record" in sys.argv[1:]:
+        record = sys.argv[sys.argv.index("--record") + 1]
+    # 盤面の大きさとルール (指定がなければ既定値)
+    config = list(default_config)
+    for i, option in enumerate(["--cols", "--rows", "--cluster-thold"]):
+        if option in sys.argv[1:]:
+            config[i] = int(sys.argv[sys.argv.index(option) + 1])
+    # 各段階の時間を計測して表示 (--traceを指定すると終了時にトレースも書き出す)
+    profiler = None
+    if "--trace" in sys.argv[1:]:
+        profiler = FrameProfiler(sys.argv[sys.argv.index("--trace") + 1])
+    elif "--profile" in sys.argv[1:]:
+        profiler = FrameProfiler()
+    App = TetrisApp(engine_factory, record=record, config=config, profiler=profiler)
+    # 変化したフレームをPNGの連番か、RGBのバイト列 (-は標準出力) として書き出す
+    capture = {}
+    for option in ["--capture-png", "--capture-raw", "--capture-timestamps"]:
+        if option in sys.argv[1:]:
+            capture[option[len("--capture-") :]] = sys.argv[sys.argv.index(option) + 1]
+    if "png" in capture or "raw" in capture:
+        App.capture = open_capture(App.screen.get_size(), **capture)
     App.run()
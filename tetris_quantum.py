@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Statevector mode for quantum tetris
+#
+# Instead of looking gate results up in qstate_transition_dicts, every
+# qubit cell carries its 2-component complex amplitude. The amplitudes of
+# the whole board live in one (rows + 1, cols, 2) array next to the usual
+# value grid, and all gates that act in a cascade step are applied with
+# one batched 2x2 matrix multiply. Besides H/Z/X this mode has S, Y, T and
+# an Rx rotation (any 2x2 unitary can be used via gates=...). Two qubit
+# cells belong to the same cluster when their fidelity |<a|b>|^2 is within
+# a tolerance of 1, so the global phase does not matter.
+#
+# The value grid (StatevectorTetrisEngine.board) keeps working for
+# collisions and drawing: a qubit cell holds the value of the nearest
+# named state (0, 1, +, -, i, -i).
+#
+# Requires numpy (pip install numpy).
+
+import numpy as np
+
+from tetris_engine import (
+    TetrisEngine,
+    cluster_thold,
+    default_config,
+    labels_dict,
+    tetris_shapes,
+)
+from tetris_numpy import (
+    board_dtype,
+    board_masks_array,
+    board_profile,
+    can_settle,
+    component_labels,
+    gate_masks,
+    settle_order,
+)
+
+# 既存の値1-7に量子状態i, -iとゲートS, Y, T, Rx, エンタングルしたqubit Eを追加
+# (8はpygame版の背景色の番号なので使わない)
+quantum_labels_dict = dict(labels_dict)
+quantum_labels_dict.update(
+    {9: "i", 10: "-i", 11: "S", 12: "Y", 13: "T", 14: "Rx", 15: "E"}
+)
+quantum_labels_dict_inv = {v: k for k, v in quantum_labels_dict.items()}
+n_quantum_values = max(quantum_labels_dict) + 1
+
+# 隣接した量子状態を同一とみなす忠実度の許容誤差
+fidelity_tolerance = 1e-6
+
+sqrt_half = np.sqrt(0.5)
+state_vectors = {
+    "0": [1, 0],
+    "1": [0, 1],
+    "+": [sqrt_half, sqrt_half],
+    "-": [sqrt_half, -sqrt_half],
+    "i": [sqrt_half, 1j * sqrt_half],
+    "-i": [sqrt_half, -1j * sqrt_half],
+}
+
+
+def rx(theta):
+    "X軸周りの回転ゲート"
+    c, s = np.cos(theta / 2), np.sin(theta / 2)
+    return np.array([[c, -1j * s], [-1j * s, c]])
+
+
+def ry(theta):
+    "Y軸周りの回転ゲート"
+    c, s = np.cos(theta / 2), np.sin(theta / 2)
+    return np.array([[c, -s], [s, c]], dtype=complex)
+
+
+def rz(theta):
+    "Z軸周りの回転ゲート"
+    return np.diag([np.exp(-0.5j * theta), np.exp(0.5j * theta)])
+
+
+gate_matrices = {
+    "H": np.array([[1, 1], [1, -1]]) * sqrt_half,
+    "Z": np.diag([1, -1]),
+    "X": np.array([[0, 1], [1, 0]]),
+    "S": np.diag([1, 1j]),
+    "Y": np.array([[0, -1j], [1j, 0]]),
+    "T": np.diag([1, np.exp(0.25j * np.pi)]),
+    "Rx": rx(np.pi / 2),
+}
+
+# エンタングルしたqubitのセルの値 (状態はEntangledStateStoreが保持)
+entangled_value = quantum_labels_dict_inv["E"]
+
+# ブロックの値ごとの表
+# is_state: 1qubitの振幅を持つ量子状態, is_qubit: ゲートのターゲットになるセル
+is_state = np.zeros(n_quantum_values, dtype=bool)
+is_gate = np.zeros(n_quantum_values, dtype=bool)
+value_amplitudes = np.zeros((n_quantum_values, 2), dtype=complex)
+default_unitaries = np.tile(np.eye(2, dtype=complex), (n_quantum_values, 1, 1))
+for value, label in quantum_labels_dict.items():
+    if label in state_vectors:
+        is_state[value] = True
+        value_amplitudes[value] = state_vectors[label]
+    elif label in gate_matrices:
+        is_gate[value] = True
+        default_unitaries[value] = gate_matrices[label]
+is_qubit = is_state.copy()
+is_qubit[entangled_value] = True
+
+# ストーンのセルに割り当てる値と、表示用の値を決める名前付きの状態
+# (エンタングルしたqubitはストーンの生成時に量子状態のセルから作る)
+stone_values = [v for v in sorted(quantum_labels_dict) if is_state[v] or is_gate[v]]
+named_values = np.flatnonzero(is_state)
+
+
+def fidelity(a, b):
+    "振幅の配列a, bの対応する状態同士の忠実度 |<a|b>|^2"
+    return np.abs(np.sum(np.conj(a) * b, axis=-1)) ** 2
+
+
+def nearest_values(amps):
+    """各状態に最も近い名前付きの状態の値 (同じ近さなら値の小さい方)
+    (丸め誤差で同点の結果が一度に処理する状態の数に依存しないよう、丸めて比較する)"""
+    overlaps = np.abs(amps @ np.conj(value_amplitudes[named_values]).T) ** 2
+    overlaps = np.round(overlaps, 9)
+    return named_values[np.argmax(overlaps, axis=-1)].astype(board_dtype)
+
+
+def apply_unitaries(board, amps, ys, xs, unitaries=default_unitaries):
+    """(ys, xs)のゲートを1段下の量子状態に1回のバッチ行列積で適用"""
+    gates = unitaries[board[ys, xs]]
+    amps[ys + 1, xs] = np.einsum("nij,nj->ni", gates, amps[ys + 1, xs])
+    board[ys + 1, xs] = nearest_values(amps[ys + 1, xs])
+
+
+def apply_gates(board, amps, unitaries=default_unitaries):
+    """作用するゲートを全てのターゲットに適用し、ゲートを削除
+    作用したゲートがあるかを出力"""
+    active, hits = gate_masks(board, is_state, is_gate)
+    if not active.any():
+        return False
+    # ターゲットはゲートの1段下
+    ys, xs = np.nonzero(hits)
+    apply_unitaries(board, amps, ys, xs, unitaries)
+    board[:-1][active] = 0
+    amps[:-1][active] = 0
+    return True
+
+
+def cluster_mask(board, amps, threthold=cluster_thold, tolerance=fidelity_tolerance):
+    """threthold個以上の同一ブロックが隣接したクラスターのマスク(床を除く)
+    量子状態は忠実度が1 - tolerance以上、それ以外(ゲートなど)は同じ値なら同一とみなす"""
+    body = board[:-1]
+    body_amps = amps[:-1]
+    state = is_state[body]
+    gate = ~state & (body != 0)
+
+    def same(a, b, amp_a, amp_b, state_a, state_b, gate_a, gate_b):
+        same_state = state_a & state_b & (fidelity(amp_a, amp_b) >= 1 - tolerance)
+        return same_state | (gate_a & gate_b & (a == b))
+
+    eq_x = same(
+        body[:, :-1],
+        body[:, 1:],
+        body_amps[:, :-1],
+        body_amps[:, 1:],
+        state[:, :-1],
+        state[:, 1:],
+        gate[:, :-1],
+        gate[:, 1:],
+    )
+    eq_y = same(
+        body[:-1],
+        body[1:],
+        body_amps[:-1],
+        body_amps[1:],
+        state[:-1],
+        state[1:],
+        gate[:-1],
+        gate[1:],
+    )
+    labels = component_labels(eq_x, eq_y)
+    sizes = np.bincount(labels.reshape(-1), minlength=labels.size)
+    return (body != 0) & (sizes[labels] >= threthold)
+
+
+class StatevectorTetrisEngine(TetrisEngine):
+    "量子状態のセルごとに振幅を持ち、ゲートを行列として作用させるエンジン"
+
+    labels = quantum_labels_dict
+    # 連鎖の各段階はボード全体のベクトル演算で処理する
+    incremental = False
+
+    def __init__(
+        self,
+        on_level_change=None,
+        seed=None,
+        tolerance=fidelity_tolerance,
+        gates=None,
+        config=default_config,
+    ):
+        """tolerance: クラスター判定の忠実度の許容誤差
+        gates: ゲートのラベル -> 2x2のユニタリ行列 (既定の行列を置き換える)
+        config: 盤面の大きさとルール (tetris_engine.TetrisConfig)"""
+        self.tolerance = tolerance
+        self.unitaries = default_unitaries.copy()
+        for label, matrix in (gates or {}).items():
+            self.unitaries[quantum_labels_dict_inv[label]] = matrix
+        super().__init__(on_level_change, seed, config)
+
+    def make_stone(self):
+        "量子状態とゲートを拡張した値でストーンを生成"
+        rand = self.random.randrange
+        shape = tetris_shapes[rand(len(tetris_shapes))]
+        return [
+            [stone_values[rand(len(stone_values))] if cell else 0 for cell in row]
+            for row in shape
+        ]
+
+    def init_game(self):
+        super().init_game()
+        self.board = np.array(self.board, dtype=board_dtype)
+        # 各セルの振幅 (量子状態以外のセルは0)
+        self.amps = np.zeros(self.board.shape + (2,), dtype=complex)
+
+    def get_bitboard(self):
+        if self.bitboard is None:
+            self.bitboard = board_masks_array(self.board)
+        return self.bitboard
+
+    def get_skyline(self):
+        if self.skyline is None:
+            self.skyline, self.filled = board_profile(self.board)
+        return self.skyline
+
+    def snapshot_extra(self):
+        return self.amps.copy()
+
+    def restore_extra(self, extra):
+        self.amps[...] = extra
+
+    def drop(self, manual):
+        stone, x, y = self.stone, self.stone_x, self.stone_y
+        landed = super().drop(manual)
+        if landed:
+            # 置いたストーンの量子状態のセルに振幅を設定
+            for cy, row in enumerate(stone):
+                for cx, val in enumerate(row):
+                    if is_state[val]:
+                        self.amps[y + cy, x + cx] = value_amplitudes[val]
+        return landed
+
+    def cascade_step(self, board, dirty=None):
+        """連鎖反応を1段階だけ進める (振幅はself.ampsにあるため自身のボードのみ)"""
+        if board is not self.board:
+            raise ValueError("StatevectorTetrisEngine can only advance its own board")
+        # ブロック落下の処理
+        if can_settle(board):
+            self.settle_cells(settle_order(board))
+            return "settle", 0
+        # ゲートブロックの処理
+        if self.operate_gates():
+            return "gate", 0
+        # 同じブロックが隣接しているクラスターの削除
+        mask = cluster_mask(board, self.amps, self.cluster_thold, self.tolerance)
+        if mask.any():
+            self.clear_cells(mask)
+            return "cluster", int(mask.sum())
+        return None, 0
+
+    def settle_cells(self, order):
+        "セルごとの配列をsettle_orderの順番に並べ替えて下詰めする"
+        self.board[1:-1] = np.take_along_axis(self.board[1:-1], order, axis=0)
+        self.amps[1:-1] = np.take_along_axis(self.amps[1:-1], order[..., None], axis=0)
+
+    def operate_gates(self):
+        "作用するゲートを全て処理し、処理したゲートがあるかを出力"
+        return apply_gates(self.board, self.amps, self.unitaries)
+
+    def clear_cells(self, mask):
+        "床を除いたマスクmaskのセルを削除"
+        self.board[:-1][mask] = 0
+        self.amps[:-1][mask] = 0
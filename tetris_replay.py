@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Compact deterministic replays for quantum tetris
+#
+# A game is fully determined by the engine seed and the actions applied to
+# it, so a replay stores only those. A log file is a sequence of game
+# records (recording appends, so one file can hold a whole night of games).
+# Every integer is an unsigned LEB128 varint:
+#
+#   record := "QTRP" header event* end
+#   header := format_version rules_version cols rows cluster_thold seed
+#             start_time len(engine_name) engine_name
+#
+# cols, rows and cluster_thold are the TetrisConfig of the recorded game,
+# so a replay is played back on a board of the size it was recorded on.
+#   event  := (delta_ms << 4 | code) [arg]
+#
+# delta_ms is the time since the previous event, so an action is usually
+# one or two bytes. The codes are action_names (the key actions of
+# tetris_pygame, "tick" for the drop timer and "place" for a whole
+# placement by a bot, arg = rotation * cols + x), "piece" (arg =
+# stone_code of each new next_stone, checked on replay so a log of other
+# rules fails instead of drifting) and "end".
+#
+# Replaying re-executes the actions on a fresh engine. A cascade in
+# progress is finished before the next action, as the front end does
+# (stone actions are buffered until the cascade ends, and the other
+# actions do not depend on how far it got).
+#
+# Usage:
+#   python tetris_pygame.py --record night.qtr
+#   python tetris_selfplay.py --games 1000 --agent bot --record night.qtr
+#   python tetris_replay.py night.qtr              # no rendering, full speed
+#   python tetris_replay.py night.qtr --realtime   # pygame, real time
+#   python tetris_replay.py night.qtr --realtime --trace frames.json
+#
+# --profile and --trace FILE time the frames of a real-time replay (see
+# tetris_profile), so a stutter seen in a recorded game can be reproduced.
+#
+# --capture-png DIR or --capture-raw FILE renders one game as a clip (see
+# tetris_capture). With --headless it renders on the SDL dummy video driver
+# without a display and as fast as possible, one frame of game time per step:
+#   python tetris_replay.py night.qtr --game 3 --headless --capture-png clip/
+
+import argparse
+import importlib
+import os
+import sys
+import time
+from collections import namedtuple
+
+from tetris_engine import TetrisConfig, rules_version, shape_masks, spawn_shapes
+
+magic = b"QTRP"
+format_version = 1
+
+# 記録する操作 (リストの番号がログの操作コード)
+action_names = [
+    "left",
+    "right",
+    "down",
+    "rotate",
+    "pause",
+    "start",
+    "drop",
+    "undo",
+    "tick",
+    "quit",
+    "place",
+]
+action_codes = {name: code for code, name in enumerate(action_names)}
+piece_code = 14
+end_code = 15
+# 引数を持つイベントのコード
+arg_codes = {action_codes["place"], piece_code}
+
+# ヘッダーのエンジン名 -> エンジンのモジュール
+# (numpyが必要なモードは、そのログを再生する時だけimportする)
+engine_modules = {
+    "TetrisEngine": "tetris_engine",
+    "NumpyTetrisEngine": "tetris_numpy",
+    "StatevectorTetrisEngine": "tetris_quantum",
+    "EntangledTetrisEngine": "tetris_entangled",
+}
+
+ReplayHeader = namedtuple(
+    "ReplayHeader",
+    [
+        "format_version",
+        "rules_version",
+        "cols",
+        "rows",
+        "cluster_thold",
+        "seed",
+        "start_time",
+        "engine",
+    ],
+)
+# eventsは (記録開始からの時刻ms, 操作名, 引数) のリスト
+Replay = namedtuple("Replay", ["header", "events"])
+
+
+class ReplayError(ValueError):
+    "ログが壊れているか、現在のルールで再生できない"
+
+
+def write_varint(out, value):
+    "非負整数をLEB128のvarintとしてbytearray outに追加"
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, pos):
+    "data[pos:]のvarintを読み、(値, 次の位置) を出力"
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ReplayError("truncated replay log")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def stone_code(stone):
+    "出現時のストーンを 形の番号と各セルの値(4bitずつ) を並べた整数に符号化"
+    code = spawn_shapes[shape_masks(stone)]
+    for row in stone:
+        for val in row:
+            if val:
+                code = code << 4 | int(val)
+    return code
+
+
+def engine_actions(engine):
+    "操作名 -> エンジンを操作する関数 (placeは引数があるためapply_eventで処理)"
+    return {
+        "left": lambda: engine.move(-1),
+        "right": lambda: engine.move(+1),
+        "down": lambda: engine.drop(True),
+        "rotate": engine.rotate_stone,
+        "pause": engine.toggle_pause,
+        "start": engine.start_game,
+        "drop": engine.insta_drop,
+        "undo": engine.undo,
+        "tick": lambda: engine.drop(False),
+        "quit": lambda: None,
+    }
+
+
+class ReplayRecorder(object):
+    "エンジンに対する操作を1ゲーム分の記録としてstreamに書き込む"
+
+    # 書き込みをまとめるバイト数
+    flush_size = 4096
+
+    def __init__(self, engine, stream, now=0):
+        """作成した直後のエンジンengineの記録を開始 (engineはseedの指定が必要)
+        now: 記録開始の時刻(ms)"""
+        if not isinstance(engine.seed, int) or engine.seed < 0:
+            raise ValueError("recording needs an engine with a non-negative int seed")
+        self.engine = engine
+        self.stream = stream
+        self.out = bytearray(magic)
+        for value in (
+            format_version,
+            rules_version,
+            engine.cols,
+            engine.rows,
+            engine.cluster_thold,
+            engine.seed,
+            int(time.time()),
+        ):
+            write_varint(self.out, value)
+        name = type(engine).__name__.encode("ascii")
+        write_varint(self.out, len(name))
+        self.out += name
+        self.last_time = now
+        self.next_stone = None
+
+    def write_event(self, code, now, arg=None):
+        delta = max(0, int(now - self.last_time))
+        self.last_time += delta
+        write_varint(self.out, delta << 4 | code)
+        if arg is not None:
+            write_varint(self.out, arg)
+        if len(self.out) >= self.flush_size:
+            self.flush()
+
+    def write_pieces(self):
+        "前回の記録以降にnext_stoneが変わっていれば記録"
+        if self.engine.next_stone is not self.next_stone:
+            self.next_stone = self.engine.next_stone
+            self.write_event(piece_code, self.last_time, stone_code(self.next_stone))
+
+    def record(self, name, now, arg=None):
+        "操作nameを時刻now(ms)に実行したことを記録 (操作の直前に呼ぶ)"
+        self.write_pieces()
+        self.write_event(action_codes[name], now, arg)
+
+    def record_placement(self, rotation, x, now):
+        "place_stone(rotation, x)を記録 (xは移動の結果が同じ範囲に丸める)"
+        cols = self.engine.cols
+        x = min(max(x, 0), cols - 1)
+        self.record("place", now, rotation * cols + x)
+
+    def flush(self):
+        self.stream.write(bytes(self.out))
+        self.out.clear()
+
+    def close(self):
+        "記録を終了して書き込む (streamは閉じない)"
+        self.write_pieces()
+        self.write_event(end_code, self.last_time)
+        self.flush()
+
+
+def parse_replays(data):
+    "ログのバイト列を先頭から読み、各ゲームのReplayを順に出力"
+    pos = 0
+    while pos < len(data):
+        if data[pos : pos + len(magic)] != magic:
+            raise ReplayError("no replay record at byte %d" % pos)
+        pos += len(magic)
+        fields = []
+        for _ in range(len(ReplayHeader._fields) - 1):
+            value, pos = read_varint(data, pos)
+            fields.append(value)
+        size, pos = read_varint(data, pos)
+        header = ReplayHeader(*fields, data[pos : pos + size].decode("ascii"))
+        pos += size
+        if header.format_version != format_version:
+            raise ReplayError("unknown replay format %d" % header.format_version)
+        events = []
+        t = 0
+        while True:
+            value, pos = read_varint(data, pos)
+            t += value >> 4
+            code = value & 0xF
+            if code == end_code:
+                break
+            arg = None
+            if code in arg_codes:
+                arg, pos = read_varint(data, pos)
+            if code == piece_code:
+                events.append((t, "piece", arg))
+            elif code < len(action_names):
+                events.append((t, action_names[code], arg))
+            else:
+                raise ReplayError("unknown event code %d" % code)
+        yield Replay(header, events)
+
+
+def load_replays(path):
+    "ログファイルの全てのゲームのReplayのリスト"
+    with open(path, "rb") as f:
+        return list(parse_replays(f.read()))
+
+
+def header_config(header):
+    "ヘッダーに記録したゲームの盤面の大きさとルール"
+    return TetrisConfig(header.cols, header.rows, header.cluster_thold)
+
+
+def make_engine(header, on_level_change=None):
+    """ヘッダーの盤面の大きさとルール、seedでエンジンを作成
+    (記録時とルールのバージョンが違えばReplayError)"""
+    if header.rules_version != rules_version:
+        raise ReplayError(
+            "replay was recorded with rules_version %d, this build has %d"
+            % (header.rules_version, rules_version)
+        )
+    if header.engine not in engine_modules:
+        raise ReplayError("unknown engine %r" % header.engine)
+    module = importlib.import_module(engine_modules[header.engine])
+    try:
+        return getattr(module, header.engine)(
+            on_level_change, header.seed, config=header_config(header)
+        )
+    except ValueError as e:
+        raise ReplayError("cannot create the recorded board: %s" % e)
+
+
+def finish_cascade(engine):
+    "連鎖中なら最後まで進める (front endと同様に、ポーズ中とゲームオーバー後は進めない)"
+    if engine.board_updating and not engine.paused and not engine.gameover:
+        engine.resolve_board()
+
+
+def apply_event(engine, actions, name, arg):
+    "1つのイベントを再実行 (actionsはengine_actions(engine))"
+    if name == "piece":
+        if stone_code(engine.next_stone) != arg:
+            raise ReplayError("next stone differs from the replay log")
+        return
+    finish_cascade(engine)
+    if name == "place":
+        rotation, x = divmod(arg, engine.cols)
+        engine.place_stone(rotation, x)
+    else:
+        actions[name]()
+
+
+def play_replay(replay, engine=None):
+    "ログの操作を最大速度で再実行し、最後の状態のエンジンを出力"
+    if engine is None:
+        engine = make_engine(replay.header)
+    actions = engine_actions(engine)
+    for t, name, arg in replay.events:
+        apply_event(engine, actions, name, arg)
+    finish_cascade(engine)
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description="quantum tetris replay player")
+    parser.add_argument("log")
+    parser.add_argument("--game", type=int, default=None, help="play only game N")
+    parser.add_argument(
+        "--realtime", action="store_true", help="render with pygame in real time"
+    )
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument(
+        "--profile", action="store_true", help="show frame timings (--realtime)"
+    )
+    parser.add_argument(
+        "--trace", default=None, help="write frame timings as a Chrome trace"
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="render offscreen in fixed steps (SDL dummy video driver)",
+    )
+    parser.add_argument("--capture-png", default=None, help="write frames as PNGs")
+    parser.add_argument(
+        "--capture-raw", default=None, help="write frames as raw RGB (- for stdout)"
+    )
+    parser.add_argument(
+        "--capture-timestamps", default=None, help="file for the frame times"
+    )
+    args = parser.parse_args()
+    capture = args.capture_png is not None or args.capture_raw is not None
+
+    replays = load_replays(args.log)
+    if args.game is not None:
+        replays = [replays[args.game]]
+    if capture and len(replays) > 1:
+        parser.error("capturing needs --game N when the log holds several games")
+    if args.realtime or args.headless or capture:
+        if args.headless:
+            os.environ["SDL_VIDEODRIVER"] = "dummy"
+        if args.capture_raw == "-":
+            # 標準出力はフレーム専用にするため、pygameの起動メッセージを出さない
+            os.environ["PYGAME_HIDE_SUPPORT_PROMPT"] = "1"
+        from tetris_capture import open_capture
+        from tetris_profile import FrameProfiler
+        from tetris_pygame import TetrisApp
+
+        # 全てのゲームを1つのプロファイラで計測
+        profiler = None
+        if args.profile or args.trace:
+            profiler = FrameProfiler(args.trace)
+        for replay in replays:
+            app = TetrisApp(
+                lambda on_level_change, seed, config: make_engine(
+                    replay.header, on_level_change
+                ),
+                profiler=profiler,
+            )
+            if capture:
+                app.capture = open_capture(
+                    app.screen.get_size(),
+                    args.capture_png,
+                    args.capture_raw,
+                    args.capture_timestamps,
+                )
+            app.play_replay(replay, args.speed, fixed_step=args.headless)
+            if capture:
+                app.close_capture()
+                print(
+                    "%d frames captured (%d unchanged, %d dropped)"
+                    % (
+                        app.capture.emitted,
+                        app.capture.duplicates,
+                        app.capture.dropped,
+                    ),
+                    file=sys.stderr,
+                )
+        if profiler is not None:
+            profiler.finish()
+            print("\n".join(profiler.report()), file=sys.stderr)
+        return
+
+    start = time.perf_counter()
+    events = 0
+    for i, replay in enumerate(replays):
+        engine = play_replay(replay)
+        events += len(replay.events)
+        print(
+            "game %-4d seed %-10d events %-6d score %-6d max_chain %-3d level %-3d%s"
+            % (
+                i,
+                replay.header.seed,
+                len(replay.events),
+                engine.score,
+                engine.max_chain,
+                engine.level,
+                " gameover" if engine.gameover else "",
+            )
+        )
+    elapsed = time.perf_counter() - start
+    print(
+        "%d games, %d events in %.2fs (%.0f events/s)"
+        % (len(replays), events, elapsed, events / elapsed if elapsed else 0.0)
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Seeded self-play runner for quantum tetris
+#
+# Plays headless games (tetris_engine.TetrisEngine) with a pluggable agent
+# across a multiprocessing pool. Each game is fully determined by its seed
+# (stone sequence and agent decisions), so a seed list gives the same
+# results on any number of workers.
+#
+# Usage:
+#   python tetris_selfplay.py --games 1000 --seed 0 --processes 8
+#
+# An agent is a picklable factory called as agent_factory(seed). It returns
+# a callable that receives the engine and returns (rotation, x), which is
+# then played with TetrisEngine.place_stone.
+#
+# Workers are started with the "spawn" method, so they do not inherit the
+# threads of the parent (e.g. SDL's timer thread after pygame.init()).
+#
+# --record FILE appends a replay of every game to FILE (see tetris_replay).
+# --cols/--rows/--cluster-thold change the board and rules of every game.
+
+import argparse
+import io
+import multiprocessing
+import os
+import random
+import time
+from collections import namedtuple
+
+from tetris_ai import PlacementBot
+from tetris_engine import TetrisConfig, TetrisEngine, default_config
+from tetris_replay import ReplayRecorder
+
+GameResult = namedtuple(
+    "GameResult",
+    [
+        "seed",
+        "score",
+        "max_chain",
+        "level",
+        "lines",
+        "stones",
+        "elapsed",
+        "worker",
+        "replay",
+    ],
+)
+
+
+class RandomAgent(object):
+    "ランダムに回転回数とx座標を選ぶエージェント"
+
+    def __init__(self, seed):
+        # ストーンの乱数とは別の系列にする
+        self.random = random.Random("agent-%d" % seed)
+
+    def __call__(self, engine):
+        return self.random.randrange(4), self.random.randrange(engine.cols)
+
+
+# --agentで選べるエージェント
+agents = {"random": RandomAgent, "bot": PlacementBot}
+
+
+def play_game(
+    seed,
+    agent_factory=RandomAgent,
+    max_stones=None,
+    engine_factory=None,
+    record=False,
+    config=default_config,
+):
+    """seedで決まる1ゲームをゲームオーバー (またはmax_stones個) までプレイ
+    recordがTrueならGameResult.replayにリプレイのバイト列を入れる
+    configはengine_factoryを省略した場合のTetrisEngineの盤面の大きさとルール"""
+    start = time.perf_counter()
+    if engine_factory is None:
+        engine = TetrisEngine(seed=seed, config=config)
+    else:
+        engine = engine_factory(seed)
+    agent = agent_factory(seed)
+    recorder = ReplayRecorder(engine, io.BytesIO()) if record else None
+    stones = 0
+    while not engine.gameover:
+        if max_stones is not None and stones >= max_stones:
+            break
+        rotation, x = agent(engine)
+        if recorder is not None:
+            now = (time.perf_counter() - start) * 1000
+            recorder.record_placement(rotation, x, now)
+        engine.place_stone(rotation, x)
+        stones += 1
+    replay = None
+    if recorder is not None:
+        recorder.close()
+        replay = recorder.stream.getvalue()
+    return GameResult(
+        seed,
+        engine.score,
+        engine.max_chain,
+        engine.level,
+        engine.lines,
+        stones,
+        time.perf_counter() - start,
+        os.getpid(),
+        replay,
+    )
+
+
+def play_game_args(args):
+    return play_game(*args)
+
+
+def run_selfplay(
+    seeds,
+    agent_factory=RandomAgent,
+    max_stones=None,
+    engine_factory=None,
+    processes=None,
+    chunksize=1,
+    record=False,
+    config=default_config,
+):
+    """seedsの各ゲームをプロセスプールでプレイし、seedsの順にGameResultを出力
+    processes=1の場合はプールを使わずに実行"""
+    tasks = [
+        (seed, agent_factory, max_stones, engine_factory, record, config)
+        for seed in seeds
+    ]
+    if processes == 1:
+        return [play_game_args(task) for task in tasks]
+    with multiprocessing.get_context("spawn").Pool(processes) as pool:
+        return list(pool.imap(play_game_args, tasks, chunksize))
+
+
+def summarize(results, wall_time=None):
+    "結果を集計 (ワーカーごとのゲーム数/秒を含む)"
+    n = len(results)
+    summary = {
+        "games": n,
+        "mean_score": sum(r.score for r in results) / n if n else 0.0,
+        "max_score": max((r.score for r in results), default=0),
+        "max_chain": max((r.max_chain for r in results), default=0),
+        "mean_level": sum(r.level for r in results) / n if n else 0.0,
+        "max_level": max((r.level for r in results), default=0),
+        "stones": sum(r.stones for r in results),
+    }
+    workers = {}
+    for r in results:
+        games, elapsed = workers.get(r.worker, (0, 0.0))
+        workers[r.worker] = (games + 1, elapsed + r.elapsed)
+    summary["games_per_sec_per_worker"] = {
+        worker: games / elapsed if elapsed else float("inf")
+        for worker, (games, elapsed) in sorted(workers.items())
+    }
+    if wall_time is not None:
+        summary["wall_time"] = wall_time
+        summary["games_per_sec"] = n / wall_time if wall_time else float("inf")
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="quantum tetris self-play runner")
+    parser.add_argument("--games", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0, help="first game seed")
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--max-stones", type=int, default=None)
+    parser.add_argument("--agent", choices=sorted(agents), default="random")
+    parser.add_argument("--record", default=None, help="append replays to this file")
+    parser.add_argument("--cols", type=int, default=default_config.cols)
+    parser.add_argument("--rows", type=int, default=default_config.rows)
+    parser.add_argument(
+        "--cluster-thold", type=int, default=default_config.cluster_thold
+    )
+    args = parser.parse_args()
+
+    seeds = range(args.seed, args.seed + args.games)
+    start = time.perf_counter()
+    results = run_selfplay(
+        seeds,
+        agent_factory=agents[args.agent],
+        max_stones=args.max_stones,
+        processes=args.processes,
+        record=args.record is not None,
+        config=TetrisConfig(args.cols, args.rows, args.cluster_thold),
+    )
+    summary = summarize(results, time.perf_counter() - start)
+    if args.record is not None:
+        with open(args.record, "ab") as f:
+            for r in results:
+                f.write(r.replay)
+        summary["replay_bytes"] = sum(len(r.replay) for r in results)
+    per_worker = summary.pop("games_per_sec_per_worker")
+    for key, value in summary.items():
+        print("%-12s %s" % (key, value))
+    for worker, rate in per_worker.items():
+        print("worker %-6d %.1f games/s" % (worker, rate))
+
+
+if __name__ == "__main__":
+    main()
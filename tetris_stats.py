@@ -0,0 +1,13 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Small statistics helpers shared by the benchmark and the frame profiler
+#
+# Kept apart from tetris_bench so that the game front end (tetris_pygame
+# through tetris_profile) does not depend on the benchmark script.
+
+
+def percentile(sorted_values, q):
+    "昇順に並んだ値のq分位点 (0 <= q <= 1、補間はしない)"
+    index = min(len(sorted_values) - 1, int(q * len(sorted_values)))
+    return sorted_values[index]